@@ -0,0 +1,490 @@
+"""Helpers shared by the PV-diesel (hybrids_pv.py) and wind-diesel (hybrids_wind.py) hybrid models
+"""
+
+import hashlib
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Result of the hourly dispatch simulation of one sizing grid. All arrays have the shape of the sizing grid
+# (battery sizes, renewable capacities, diesel capacities) and do not depend on any cost or price parameter.
+# Configurations whose simulation was stopped once they went over the LPSP or diesel share limits keep the
+# diesel_share and lpsp reached at that point, which are already over the limits, and NaN for the other results.
+DispatchResult = namedtuple('DispatchResult', ['renewable_capacity',  # kW of PV panels or wind turbines
+                                               'battery_size',  # kWh of storage
+                                               'diesel_capacity',  # kW of diesel generator
+                                               'diesel_share',  # share of the demand met by the diesel generator
+                                               'battery_life',  # years
+                                               'lpsp',  # loss of power supply probability
+                                               'fuel_usage',  # litres of diesel per year
+                                               'excess_gen',  # share of the demand generated in excess
+                                               'peak_load'])  # kW, highest hourly load of the load curve
+
+
+def load_curve(tier, energy_per_hh):
+    """Hourly load curve of one household over the year (8760 values, kWh)
+
+    Arguments
+    ---------
+    tier : int
+        Tier of the multi-tier framework (1-5)
+    energy_per_hh : float
+        Annual demand per household (kWh)
+    """
+    # the values below define the load curve for the five tiers. The values reflect the share of the daily demand
+    # expected in each hour of the day (sum of all values for one tier = 1)
+    tier5_load_curve = [0.021008403, 0.021008403, 0.021008403, 0.021008403, 0.027310924, 0.037815126,
+                        0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.042016807,
+                        0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.046218487, 0.050420168,
+                        0.067226891, 0.084033613, 0.073529412, 0.052521008, 0.033613445, 0.023109244]
+    tier4_load_curve = [0.017167382, 0.017167382, 0.017167382, 0.017167382, 0.025751073, 0.038626609,
+                        0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.042918455,
+                        0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.0472103, 0.051502146,
+                        0.068669528, 0.08583691, 0.075107296, 0.053648069, 0.034334764, 0.021459227]
+    tier3_load_curve = [0.013297872, 0.013297872, 0.013297872, 0.013297872, 0.019060284, 0.034574468,
+                        0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.044326241,
+                        0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.048758865, 0.053191489,
+                        0.070921986, 0.088652482, 0.077570922, 0.055407801, 0.035460993, 0.019946809]
+    tier2_load_curve = [0.010224949, 0.010224949, 0.010224949, 0.010224949, 0.019427403, 0.034764826,
+                        0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.040899796,
+                        0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.04601227, 0.056237219,
+                        0.081799591, 0.102249489, 0.089468303, 0.06390593, 0.038343558, 0.017893661]
+    tier1_load_curve = [0, 0, 0, 0, 0.012578616, 0.031446541, 0.037735849, 0.037735849, 0.037735849,
+                        0.037735849, 0.037735849, 0.037735849, 0.037735849, 0.037735849, 0.037735849,
+                        0.037735849, 0.044025157, 0.062893082, 0.100628931, 0.125786164, 0.110062893,
+                        0.078616352, 0.044025157, 0.012578616]
+
+    if tier == 1:
+        load_curve = tier1_load_curve * 365
+    elif tier == 2:
+        load_curve = tier2_load_curve * 365
+    elif tier == 3:
+        load_curve = tier3_load_curve * 365
+    elif tier == 4:
+        load_curve = tier4_load_curve * 365
+    else:
+        load_curve = tier5_load_curve * 365
+
+    return np.array(load_curve) * energy_per_hh / 365
+
+
+def profile_hash(*curves):
+    """Fingerprint of one or more hourly time series, used to recognise a profile between calls
+
+    Arguments
+    ---------
+    curves : numpy.ndarray
+        Hourly profiles, e.g. the GHI and temperature curves
+    """
+    digest = hashlib.sha1()
+    for curve in curves:
+        curve = np.ascontiguousarray(curve, dtype=float)
+        digest.update(str(curve.shape).encode())
+        digest.update(curve.tobytes())
+    return digest.hexdigest()
+
+
+def representative_days(profiles, days, iterations=50):
+    """Clusters the days of the year into a smaller number of representative days
+
+    The days are grouped with k-means on their hourly profiles, starting from groups of days with a similar
+    daily total so that the result does not depend on a random seed. Each group is represented by its member
+    closest to the group average, weighted by the number of days in the group.
+
+    Arguments
+    ---------
+    profiles : list
+        Hourly profiles of the year the days are compared on, e.g. GHI and temperature. Each profile is scaled by
+        its standard deviation, so that they weigh alike
+    days : int
+        Number of representative days
+    iterations : int
+        Maximum number of k-means iterations
+
+    Returns
+    -------
+    representatives : numpy.ndarray
+        Index of each representative day in the year, in chronological order
+    weights : numpy.ndarray
+        Number of days of the year represented by each representative day
+    """
+    features = []
+    for profile in profiles:
+        profile = np.asarray(profile, dtype=float).reshape(-1, 24)
+        spread = profile.std()
+        features.append(profile / spread if spread > 0 else profile)
+    features = np.hstack(features)
+    n = len(features)
+    days = min(days, n)
+
+    labels = np.empty(n, dtype=int)
+    labels[np.argsort(features.sum(axis=1), kind='stable')] = np.arange(n) * days // n
+    for _ in range(iterations):
+        groups = np.unique(labels)
+        centres = np.array([features[labels == group].mean(axis=0) for group in groups])
+        distances = ((features[:, np.newaxis, :] - centres[np.newaxis, :, :]) ** 2).sum(axis=2)
+        new_labels = groups[distances.argmin(axis=1)]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    representatives = []
+    weights = []
+    for group in np.unique(labels):
+        members = np.flatnonzero(labels == group)
+        centre = features[members].mean(axis=0)
+        representatives.append(members[((features[members] - centre) ** 2).sum(axis=1).argmin()])
+        weights.append(len(members))
+    order = np.argsort(representatives)
+    return np.array(representatives)[order], np.array(weights, dtype=float)[order]
+
+
+def representative_hours(representatives):
+    """Hours of the year (index of the hourly profiles) of the representative days, in the order simulated"""
+    return (np.asarray(representatives)[:, np.newaxis] * 24 + np.arange(24)).ravel()
+
+
+def over_limits(unmet_demand, annual_diesel_gen, energy_per_hh, lpsp_max=None, diesel_limit=None):
+    """Systems whose loss of power supply or diesel share is over the limits of a feasible configuration
+
+    Both unmet demand and diesel generation only add up over the year, so a system over the limits at some hour
+    is infeasible whatever happens in the rest of the year.
+
+    Arguments
+    ---------
+    unmet_demand, annual_diesel_gen : numpy.ndarray
+        kWh of demand not met and kWh generated by the diesel generator so far
+    energy_per_hh : float
+        kWh/household/year
+    lpsp_max : float
+        Maximum loss of power supply probability. Not checked if None
+    diesel_limit : float
+        Maximum share of the demand met by the diesel generator. Not checked if None
+    """
+    over = np.zeros(np.shape(unmet_demand), dtype=bool)
+    if lpsp_max is not None:
+        over |= unmet_demand / energy_per_hh > lpsp_max
+    if diesel_limit is not None:
+        over |= annual_diesel_gen / energy_per_hh > diesel_limit
+    return over
+
+
+def work_buffers(n, floats, booleans):
+    """Preallocated float and boolean arrays of n elements, which the dispatch kernels overwrite every hour"""
+    return [np.empty(n) for _ in range(floats)] + [np.empty(n, dtype=bool) for _ in range(booleans)]
+
+
+class DispatchStore:
+    """Keeps the results of the hourly hybrid dispatch simulations
+
+    The dispatch of a hybrid system only depends on the load curve (tier), the renewable resource, the hourly
+    profile and the sizing grid. The results can therefore be re-used for every year and scenario, so that only
+    the costing step is repeated when prices, discount rate or unit costs change.
+    """
+
+    def __init__(self):
+        self._results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def get(self, key):
+        """Returns the stored DispatchResult for key, or None if it has not been simulated yet"""
+        return self._results.get(key)
+
+    def put(self, key, result):
+        """Stores a DispatchResult. The arrays are made read-only since they are shared between callers"""
+        for array in result:
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+        self._results[key] = result
+        return result
+
+    def fetch(self, key, simulate):
+        """Returns the stored result for key, running simulate() and storing its result if needed
+
+        Arguments
+        ---------
+        key : tuple
+            (model, profile hash, energy per household, tier, resource, sizing grid, feasibility limits)
+        simulate : callable
+            Function without arguments returning a DispatchResult
+        """
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            result = self.put(key, simulate())
+        else:
+            self.hits += 1
+        return result
+
+    def clear(self):
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Store used by default by the hybrid models, shared by all years and scenarios run in the same process
+dispatch_store = DispatchStore()
+
+# Hourly profiles of the worker processes, set once when each worker starts
+_worker_profile = {}
+
+
+def _init_worker(profile):
+    _worker_profile.clear()
+    _worker_profile.update(profile)
+
+
+def _simulate_chunk(simulate, pairs, arguments):
+    return simulate(pairs=pairs, **_worker_profile, **arguments)
+
+
+def simulate_pairs(simulate, pairs, profile, arguments, workers=1, chunk_size=None):
+    """Simulates the dispatch of a list of (tier, resource) pairs, optionally spread over several processes
+
+    With more than one worker the pairs are split in chunks that are simulated by a ProcessPoolExecutor. The hourly
+    profiles are sent to each worker once, when it starts, instead of with every chunk. Every system is simulated
+    independently of the others, so the results do not depend on the number of workers or the chunk size.
+
+    Arguments
+    ---------
+    simulate : callable
+        Module-level function called as simulate(pairs=..., **profile, **arguments), returning one DispatchResult
+        per pair
+    pairs : list
+        (tier, resource) pairs to simulate
+    profile : dict
+        Hourly profiles passed to simulate
+    arguments : dict
+        Other arguments passed to simulate
+    workers : int
+        Number of processes. With 1 the pairs are simulated in the calling process
+    chunk_size : int
+        Number of pairs simulated together by a worker. By default the pairs are spread evenly over the workers
+
+    Returns
+    -------
+    list
+        DispatchResult of each pair
+    """
+    if workers <= 1 or len(pairs) <= 1:
+        return simulate(pairs=pairs, **profile, **arguments)
+
+    if chunk_size is None:
+        chunk_size = -(-len(pairs) // workers)
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_init_worker,
+                             initargs=(profile,)) as executor:
+        results = executor.map(_simulate_chunk, [simulate] * len(chunks), chunks, [arguments] * len(chunks))
+        return [result for chunk in results for result in chunk]
+
+
+class LcoeEnvelope:
+    """Lowest LCOE of a set of hybrid configurations as a function of the diesel price
+
+    The LCOE of every configuration is a line in the diesel price (intercept + slope * price), since only the fuel
+    costs depend on it. The lowest LCOE over all configurations is the lower envelope of these lines, which is built
+    once and then evaluated for any price with a binary search instead of re-costing every configuration.
+
+    Arguments
+    ---------
+    intercept : numpy.ndarray
+        LCOE of each configuration at a diesel price of 0 (USD/kWh)
+    slope : numpy.ndarray
+        Increase of the LCOE of each configuration per USD/litre of diesel, same shape as intercept
+    """
+
+    def __init__(self, intercept, slope):
+        self.shape = np.shape(intercept)
+        self.intercept = np.asarray(intercept, dtype=float).ravel()
+        self.slope = np.asarray(slope, dtype=float).ravel()
+
+        # A configuration with an undefined LCOE is returned for every price, as np.argmin would do
+        undefined = np.isnan(self.intercept) | np.isnan(self.slope)
+        self.undefined = int(np.argmax(undefined)) if undefined.any() else None
+
+        # Lines sorted from the steepest to the flattest slope, the lowest intercept (and index) first among
+        # parallel lines. Only lines that are the lowest somewhere are kept on the envelope.
+        a, b = self.intercept, self.slope
+        hull = []
+        for k in np.lexsort((np.arange(len(a)), a, -b)):
+            if undefined[k] or (len(hull) > 0 and b[hull[-1]] == b[k]):
+                continue
+            while len(hull) >= 2 and \
+                    (a[k] - a[hull[-2]]) * (b[hull[-2]] - b[hull[-1]]) < \
+                    (a[hull[-1]] - a[hull[-2]]) * (b[hull[-2]] - b[k]):
+                hull.pop()
+            hull.append(k)
+        self.lines = np.array(hull, dtype=int)
+        # Price at which the envelope moves from one line to the next
+        self.breakpoints = (a[self.lines[1:]] - a[self.lines[:-1]]) / (b[self.lines[:-1]] - b[self.lines[1:]])
+
+    def evaluate(self, prices):
+        """Lowest LCOE and the flat index of the configuration reaching it for each diesel price
+
+        Ties are resolved towards the lowest flat index, like np.argmin over all configurations.
+        """
+        prices = np.asarray(prices, dtype=float).ravel()
+        if self.undefined is not None:
+            return np.full(len(prices), np.nan), np.full(len(prices), self.undefined)
+
+        # The neighbouring lines are compared as well, for prices at or very close to a breakpoint
+        segment = np.searchsorted(self.breakpoints, prices)
+        candidates = np.clip(segment[:, None] + np.array([-1, 0, 1]), 0, len(self.lines) - 1)
+        candidates = self.lines[candidates]
+        values = self.intercept[candidates] + self.slope[candidates] * prices[:, None]
+        best = np.lexsort((candidates, values), axis=1)[:, 0]
+
+        rows = np.arange(len(prices))
+        return values[rows, best], candidates[rows, best]
+
+
+class SizingSearch:
+    """Coarse-to-fine search of the cheapest feasible sizing of one hybrid system
+
+    The search starts with a coarse grid spanning the sizing bounds. In every following round the neighbours of the
+    cheapest feasible configuration found so far are evaluated, at half the spacing of the coarse grid at first. The
+    spacing is halved again whenever the cheapest configuration does not move. The search stops when the budget of
+    evaluated configurations is used, when the spacing is below the resolution or when no configuration of the
+    coarse grid is feasible.
+
+    Arguments
+    ---------
+    lower, upper : list
+        Bounds of the sizing variables, e.g. (renewable capacity, diesel capacity, battery size)
+    points : list
+        Number of points of the coarse grid along each variable (at least 2)
+    budget : int
+        Maximum number of configurations evaluated
+    resolution : float
+        Smallest spacing, as share of the range of each variable
+    """
+
+    def __init__(self, lower, upper, points=(5, 5, 3), budget=150, resolution=0.01):
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.budget = budget
+        self.step = (self.upper - self.lower) / (np.asarray(points) - 1)
+        self.min_step = resolution * (self.upper - self.lower)
+
+        self.sizes = np.empty((0, len(self.lower)))
+        self.lcoe = np.empty(0)
+        self.feasible = np.empty(0, dtype=bool)
+        self.results = None
+        self._evaluated = set()
+
+        axes = [np.linspace(low, high, n) for low, high, n in zip(self.lower, self.upper, points)]
+        self.candidates = np.array(np.meshgrid(*axes, indexing='ij')).reshape(len(axes), -1).T[:budget]
+
+    @property
+    def done(self):
+        return len(self.candidates) == 0
+
+    @property
+    def used(self):
+        """Number of configurations evaluated so far"""
+        return len(self.lcoe)
+
+    @property
+    def best(self):
+        """Position of the cheapest configuration evaluated, feasible ones first and the earliest among ties"""
+        return np.lexsort((self.lcoe, ~self.feasible))[0]
+
+    def _key(self, size):
+        span = np.where(self.upper > self.lower, self.upper - self.lower, 1)
+        return tuple(np.round((size - self.lower) / span * 1e9).astype(np.int64))
+
+    def update(self, lcoe, feasible, results):
+        """Records the evaluation of the current candidates and sets the candidates of the next round
+
+        Arguments
+        ---------
+        lcoe : numpy.ndarray
+            LCOE of each candidate
+        feasible : numpy.ndarray
+            Whether each candidate meets the LPSP and diesel share limits
+        results : numpy.ndarray
+            Other results kept for each candidate (e.g. investment, capacity), shape (candidates, number of results)
+        """
+        results = np.asarray(results, dtype=float)
+        first_round = self.used == 0
+        previous_best = None if first_round else self.best
+        self.sizes = np.vstack((self.sizes, self.candidates))
+        self.lcoe = np.append(self.lcoe, lcoe)
+        self.feasible = np.append(self.feasible, feasible)
+        self.results = results if self.results is None else np.vstack((self.results, results))
+        self._evaluated.update(self._key(size) for size in self.candidates)
+
+        self.candidates = np.empty((0, len(self.lower)))
+        if not self.feasible.any():
+            return
+
+        # The spacing is kept while the cheapest configuration moves and halved once it stays in place
+        best = self.sizes[self.best]
+        if first_round or self.best == previous_best:
+            self.step = self.step / 2
+        offsets = np.array(list(itertools.product((-1, 0, 1), repeat=len(best))))
+        while self.used < self.budget and np.any(self.step > self.min_step):
+            neighbours = np.clip(best + offsets * self.step, self.lower, self.upper)
+            new = {}
+            for size in neighbours:
+                key = self._key(size)
+                if key not in self._evaluated and key not in new:
+                    new[key] = size
+            if len(new) > 0:
+                self.candidates = np.array(list(new.values()))[:self.budget - self.used]
+                break
+            self.step = self.step / 2
+
+
+def search_sizes(searches, simulate, cost):
+    """Runs sizing searches side by side, simulating the candidates of each round in one batch
+
+    Arguments
+    ---------
+    searches : dict
+        SizingSearch for each (tier, resource, diesel price) key. Searches with the same tier and resource share the
+        simulated configurations, so that a configuration proposed by several of them is simulated once
+    simulate : callable
+        simulate(systems, sizes) returns the dispatch results of a batch of configurations, shape (configurations,
+        number of results), where systems lists the (tier, resource) of each configuration
+    cost : callable
+        cost(key, sizes, dispatch) returns the lcoe, feasibility and other results of the candidates of one search
+
+    Returns
+    -------
+    int
+        Number of configurations simulated
+    """
+    simulated = {}
+    simulations = 0
+    while True:
+        active = [key for key, search in searches.items() if not search.done]
+        if len(active) == 0:
+            return simulations
+
+        missing = {}
+        for key in active:
+            for size in searches[key].candidates:
+                configuration = key[:2] + tuple(size)
+                if configuration not in simulated:
+                    missing[configuration] = size
+        if len(missing) > 0:
+            systems = [configuration[:2] for configuration in missing]
+            dispatch = simulate(systems, np.array(list(missing.values())))
+            simulated.update(zip(missing, dispatch))
+            simulations += len(missing)
+
+        for key in active:
+            sizes = searches[key].candidates
+            dispatch = np.array([simulated[key[:2] + tuple(size)] for size in sizes])
+            searches[key].update(*cost(key, sizes, dispatch))
@@ -3,6 +3,15 @@ import numpy as np
 import pandas as pd
 import os
 
+try:
+    from onsset.hybrids_common import DispatchResult, LcoeEnvelope, SizingSearch, dispatch_store, load_curve, \
+        over_limits, profile_hash, representative_days, representative_hours, search_sizes, simulate_pairs, \
+        work_buffers
+except ImportError:
+    from hybrids_common import DispatchResult, LcoeEnvelope, SizingSearch, dispatch_store, load_curve, \
+        over_limits, profile_hash, representative_days, representative_hours, search_sizes, simulate_pairs, \
+        work_buffers
+
 #logging.basicConfig(format='%(asctime)s\t\t%(message)s', level=logging.DEBUG)
 
 
@@ -17,206 +26,128 @@ def read_environmental_data(path):
 #  ghi_curve, temp = read_environmental_data()
 
 
-def pv_diesel_hybrid(
-        energy_per_hh,  # kWh/household/year as defined
-        ghi,  # highest annual GHI value encountered in the GIS data
-        ghi_curve,
-        temp,
-        tier,
-        start_year,
-        end_year,
-        discount_rate,
-        battery_cost,  # =139 battery capital capital cost, USD/kWh of storage capacity
-        pv_cost,  # =534,  # PV panel capital cost, USD/kW peak power
-        diesel_cost,  # 150, # diesel generator capital cost, USD/kW rated power
-        inverter_cost, # 80 + 142
-        pv_life,  # 25
-        diesel_life,  # 10
-        pv_no=10,  # number of PV panel sizes simulated
-        diesel_no=10,  # number of diesel generators simulated
-        diesel_range=[0.7]
-
-):
-    n_chg = 0.92  # charge efficiency of battery
-    n_dis = 0.92  # discharge efficiency of battery
-    lpsp_max = 0.05  # maximum loss of load allowed over the year, in share of kWh
-    pv_om = 0.015  # annual OM cost of PV panels
-    diesel_om = 0.1  # annual OM cost of diesel generator
-    k_t = 0.005  # temperature factor of PV panels
-    inverter_life = 10
-    inv_eff = 0.92  # inverter_efficiency
-    charge_controller_cost = 0
-
-
-    ghi = ghi_curve * ghi * 1000 / ghi_curve.sum()
-    hour_numbers = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23) * 365
-    dod_max = 0.8  # maximum depth of discharge of battery
-
-    def load_curve(tier, energy_per_hh):
-        # the values below define the load curve for the five tiers. The values reflect the share of the daily demand
-        # expected in each hour of the day (sum of all values for one tier = 1)
-        tier5_load_curve = [0.021008403, 0.021008403, 0.021008403, 0.021008403, 0.027310924, 0.037815126,
-                            0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.042016807,
-                            0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.046218487, 0.050420168,
-                            0.067226891, 0.084033613, 0.073529412, 0.052521008, 0.033613445, 0.023109244]
-        tier4_load_curve = [0.017167382, 0.017167382, 0.017167382, 0.017167382, 0.025751073, 0.038626609,
-                            0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.042918455,
-                            0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.0472103, 0.051502146,
-                            0.068669528, 0.08583691, 0.075107296, 0.053648069, 0.034334764, 0.021459227]
-        tier3_load_curve = [0.013297872, 0.013297872, 0.013297872, 0.013297872, 0.019060284, 0.034574468,
-                            0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.044326241,
-                            0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.048758865, 0.053191489,
-                            0.070921986, 0.088652482, 0.077570922, 0.055407801, 0.035460993, 0.019946809]
-        tier2_load_curve = [0.010224949, 0.010224949, 0.010224949, 0.010224949, 0.019427403, 0.034764826,
-                            0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.040899796,
-                            0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.04601227, 0.056237219,
-                            0.081799591, 0.102249489, 0.089468303, 0.06390593, 0.038343558, 0.017893661]
-        tier1_load_curve = [0, 0, 0, 0, 0.012578616, 0.031446541, 0.037735849, 0.037735849, 0.037735849,
-                            0.037735849, 0.037735849, 0.037735849, 0.037735849, 0.037735849, 0.037735849,
-                            0.037735849, 0.044025157, 0.062893082, 0.100628931, 0.125786164, 0.110062893,
-                            0.078616352, 0.044025157, 0.012578616]
-
-        if tier == 1:
-            load_curve = tier1_load_curve * 365
-        elif tier == 2:
-            load_curve = tier2_load_curve * 365
-        elif tier == 3:
-            load_curve = tier3_load_curve * 365
-        elif tier == 4:
-            load_curve = tier4_load_curve * 365
-        else:
-            load_curve = tier5_load_curve * 365
-
-        return np.array(load_curve) * energy_per_hh / 365
-
-    load_curve = load_curve(tier, energy_per_hh)
-
-    def pv_diesel_capacities(pv_capacity, battery_size, diesel_capacity, pv_no, diesel_no, battery_no):
-        dod = np.zeros(shape=(24, battery_no, pv_no, diesel_no))
-        battery_use = np.zeros(shape=(24, battery_no, pv_no, diesel_no))  # Stores the amount of battery discharge during the day
-        fuel_result = np.zeros(shape=(battery_no, pv_no, diesel_no))
-        battery_life = np.zeros(shape=(battery_no, pv_no, diesel_no))
-        soc = np.ones(shape=(battery_no, pv_no, diesel_no)) * 0.5
-        unmet_demand = np.zeros(shape=(battery_no, pv_no, diesel_no))
-        excess_gen = np.zeros(shape=(battery_no, pv_no, diesel_no))  # TODO
-        annual_diesel_gen = np.zeros(shape=(battery_no, pv_no, diesel_no))
-        dod_max = np.ones(shape=(battery_no, pv_no, diesel_no)) * 0.6
-
-        for i in range(8760):
-
-            # Battery self-discharge (0.02% per hour)
-            battery_use[hour_numbers[i], :, :] = 0.0002 * soc
-            soc *= 0.9998
-
-            # Calculation of PV gen and net load
-            t_cell = temp[i] + 0.0256 * ghi[i]  # PV cell temperature
-            pv_gen = pv_capacity * 0.9 * ghi[i] / 1000 * (1 - k_t * (t_cell - 25))  # PV generation in the hour
-            net_load = load_curve[hour_numbers[i]] - pv_gen * inv_eff  # remaining load not met by PV panels
-
-            # Dispatchable energy from battery available to meet load
-            battery_dispatchable = soc * battery_size * n_dis * inv_eff
-            # Energy required to fully charge battery
-            battery_chargeable = (1 - soc) * battery_size / n_chg / inv_eff
-
-            # Below is the dispatch strategy for the diesel generator as described in word document
-
-            if 4 < hour_numbers[i] <= 17:
-                # During the morning and day, the batteries are dispatched primarily.
-                # The diesel generator, if needed, is run at the lowest possible capacity
-
-                # Minimum diesel capacity to cover the net load after batteries.
-                # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
-                min_diesel = np.minimum(
-                    np.maximum(net_load - battery_dispatchable, 0.4 * diesel_capacity),
-                    diesel_capacity)
-
-                diesel_gen = np.where(net_load > battery_dispatchable, min_diesel, 0)
-
-            elif 17 > hour_numbers[i] > 23:
-                # During the evening, the diesel generator is dispatched primarily, at max_diesel.
-                # Batteries are dispatched if diesel generation is insufficient.
-
-                #  Maximum amount of diesel needed to supply load and charge battery
-                # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
-                max_diesel = np.maximum(
-                    np.minimum(net_load + battery_chargeable, diesel_capacity),
-                    0.4 * diesel_capacity)
-
-                diesel_gen = np.where(net_load > 0, max_diesel, 0)
-            else:
-                # During night, batteries are dispatched primarily.
-                # The diesel generator is used at max_diesel if load is larger than battery capacity
-
-                #  Maximum amount of diesel needed to supply load and charge battery
-                # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
-                max_diesel = np.maximum(
-                    np.minimum(net_load + battery_chargeable, diesel_capacity),
-                    0.4 * diesel_capacity)
-
-                diesel_gen = np.where(net_load > battery_dispatchable, max_diesel, 0)
-
-            fuel_result += np.where(diesel_gen > 0, diesel_capacity * 0.08145 + diesel_gen * 0.246, 0)
-            annual_diesel_gen += diesel_gen
-
-            # Reamining load after diesel generator
-            net_load = net_load - diesel_gen
-
-            # If diesel generation is used, but is smaller than load, battery is discharged
-            soc -= np.where((net_load > 0) & (diesel_gen > 0),
-                            net_load / n_dis / inv_eff / battery_size,
-                            0)
-
-            # If diesel generation is used, and is larger than load, battery is charged
-            soc -= np.where((net_load < 0) & (diesel_gen > 0),
-                            net_load * n_chg * inv_eff / battery_size,
-                            0)
-
-            # If net load is positive and no diesel is used, battery is discharged
-            soc -= np.where((net_load > 0) & (diesel_gen == 0),
-                            net_load / n_dis / battery_size,
-                            0)
-
-            # If net load is negative, and no diesel has been used, excess PV gen is used to charge battery
-            soc -= np.where((net_load < 0) & (diesel_gen == 0),
-                            net_load * n_chg / battery_size,
-                            0)
-
-
-            # The amount of battery discharge in the hour is stored (measured in State Of Charge)
-            battery_use[hour_numbers[i], :, :] = \
-                np.minimum(np.where(net_load > 0,
-                                    net_load / n_dis / battery_size,
-                                    0),
-                           soc)
-
-            # If State of charge is negative, that means there's demand that could not be met.
-            unmet_demand += np.where(soc < 0,
-                                     -soc / n_dis * battery_size,
-                                     0)
-            soc = np.maximum(soc, 0)
-
-            # If State of Charge is larger than 1, that means there was excess PV/diesel generation
-            excess_gen += np.where(soc > 1,
-                                   (soc - 1) / n_chg * battery_size,
-                                   0)
-            # TODO
-            soc = np.minimum(soc, 1)
-
-            dod[hour_numbers[i], :, :] = 1 - soc  # The depth of discharge in every hour of the day is stored
-            if hour_numbers[i] == 23:  # The battery wear during the last day is calculated
-                battery_used = np.where(dod.max(axis=0) > 0, 1, 0)
-                battery_life += battery_use.sum(axis=0) / (
-                        531.52764 * np.maximum(0.1, dod.max(axis=0) * dod_max) ** -1.12297) * battery_used
-
-        condition = unmet_demand / energy_per_hh  # LPSP is calculated
-        excess_gen = excess_gen / energy_per_hh
-        battery_life = np.round(1 / battery_life)
-        diesel_share = annual_diesel_gen / energy_per_hh
-
-        return diesel_share, battery_life, condition, fuel_result, excess_gen
-
-    # This section creates the range of PV capacities, diesel capacities and battery sizes to be simulated
-    ref = 5 * load_curve[19]
+def pv_diesel_dispatch(energy_per_hh, ghi, ghi_curve, temp, tier, pv_no=10, diesel_no=10, store=dispatch_store,
+                       lpsp_max=0.05, diesel_limit=0.5, days=None):
+    """Simulates the hourly operation of all PV panel, battery and diesel generator sizes for one tier and GHI value
+
+    Only the physics of the system is simulated here. The results do not depend on diesel price, discount rate or
+    unit costs and are kept in the dispatch store, so that later years and scenarios only redo the costing.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    ghi : float
+        Annual GHI value (kWh/m2/year)
+    ghi_curve : numpy.ndarray
+        Hourly GHI profile
+    temp : numpy.ndarray
+        Hourly temperature profile
+    tier : int
+    pv_no : int
+        Number of PV panel sizes simulated
+    diesel_no : int
+        Number of diesel generator sizes simulated
+    store : DispatchStore or None
+        Where simulated results are kept. If None the dispatch is always simulated
+    lpsp_max, diesel_limit : float
+        Limits of a feasible configuration. Configurations going over them are not simulated any further. If None
+        all configurations are simulated for the whole year
+    days : int
+        If given, only this number of representative days of the year is simulated (see representative_days),
+        which is much faster but approximates the results of the whole year
+
+    Returns
+    -------
+    DispatchResult
+    """
+
+    def simulate():
+        return _pv_diesel_dispatch(energy_per_hh, [(tier, ghi)], ghi_curve, temp, pv_no, diesel_no, lpsp_max,
+                                   diesel_limit, days)[0]
+
+    if store is None:
+        return simulate()
+
+    key = ('pv', profile_hash(ghi_curve, temp), energy_per_hh, tier, ghi, (pv_no, diesel_no),
+           (lpsp_max, diesel_limit), days)
+    return store.fetch(key, simulate)
+
+
+def pv_diesel_dispatch_table(energy_per_hh, ghi_values, ghi_curve, temp, tiers=(1, 2, 3, 4, 5), pv_no=10,
+                             diesel_no=10, store=dispatch_store, workers=1, chunk_size=None, lpsp_max=0.05,
+                             diesel_limit=0.5, days=None):
+    """Simulates the dispatch of every combination of tier and GHI value in one pass over the 8760 hours
+
+    All sizing grids are stacked along one axis and simulated together, which is much faster than simulating each
+    tier and GHI value on its own. Combinations already in the store are not simulated again.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    ghi_values : list
+        Annual GHI values (kWh/m2/year)
+    ghi_curve : numpy.ndarray
+        Hourly GHI profile
+    temp : numpy.ndarray
+        Hourly temperature profile
+    tiers : list
+    pv_no : int
+        Number of PV panel sizes simulated
+    diesel_no : int
+        Number of diesel generator sizes simulated
+    store : DispatchStore or None
+        Where simulated results are kept. If None all combinations are simulated
+    workers : int
+        Number of processes simulating the combinations
+    chunk_size : int
+        Number of combinations simulated together by one process
+    lpsp_max, diesel_limit : float
+        Limits of a feasible configuration. Configurations going over them are not simulated any further. If None
+        all configurations are simulated for the whole year
+    days : int
+        If given, only this number of representative days of the year is simulated (see representative_days),
+        which is much faster but approximates the results of the whole year
+
+    Returns
+    -------
+    dict
+        DispatchResult for each (tier, ghi) pair
+    """
+
+    def simulate(pairs):
+        return simulate_pairs(_pv_diesel_dispatch, pairs, {'ghi_curve': ghi_curve, 'temp': temp},
+                              {'energy_per_hh': energy_per_hh, 'pv_no': pv_no, 'diesel_no': diesel_no,
+                               'lpsp_max': lpsp_max, 'diesel_limit': diesel_limit, 'days': days},
+                              workers, chunk_size)
+
+    pairs = list(dict.fromkeys((tier, ghi) for tier in tiers for ghi in ghi_values))
+    if store is None:
+        return dict(zip(pairs, simulate(pairs)))
+
+    profile = profile_hash(ghi_curve, temp)
+    keys = {pair: ('pv', profile, energy_per_hh, pair[0], pair[1], (pv_no, diesel_no), (lpsp_max, diesel_limit),
+                   days) for pair in pairs}
+    missing = [pair for pair in pairs if keys[pair] not in store]
+    if len(missing) > 0:
+        simulated = simulate(missing)
+        for pair, result in zip(missing, simulated):
+            store.misses += 1
+            store.put(keys[pair], result)
+
+    return {pair: store.get(keys[pair]) for pair in pairs}
+
+
+def pv_diesel_sizes(load_curve_hh, energy_per_hh, pv_no, diesel_no):
+    """Creates the range of PV capacities, diesel capacities and battery sizes to be simulated for one load curve
+
+    Returns
+    -------
+    pv_panel_size, battery_size, diesel_capacity : numpy.ndarray
+        Arrays of shape (battery sizes, pv_no, diesel_no)
+    """
+    ref = 5 * load_curve_hh[19]
 
     battery_sizes = [0.5 * energy_per_hh / 365, energy_per_hh / 365, 2 * energy_per_hh / 365]
     pv_caps = []
@@ -228,7 +159,7 @@ def pv_diesel_hybrid(
         pv_caps.append(ref * (pv_no - i) / pv_no)
 
     for j in range(diesel_no):
-        diesel_caps.append(j * max(load_curve) / diesel_no)
+        diesel_caps.append(j * max(load_curve_hh) / diesel_no)
 
     pv_caps = np.outer(np.array(pv_caps), pv_extend)
     diesel_caps = np.outer(diesel_extend, np.array(diesel_caps))
@@ -245,63 +176,441 @@ def pv_diesel_hybrid(
         pv_panel_size[j, :, :] = pv_caps
         diesel_capacity[j, :, :] = diesel_caps
 
-    # For the number of diesel, pv and battery capacities the lpsp, battery lifetime, fuel usage and LPSP is calculated
+    return pv_panel_size, battery_size, diesel_capacity
+
+
+def pv_diesel_capacities(pv_capacity, battery_size, diesel_capacity, load_by_hour, ghi, ghi_index, temp,
+                         energy_per_hh, lpsp_max=None, diesel_limit=None, keep=None, day_weights=None):
+    """Hourly dispatch of a batch of PV-diesel-battery systems over one year
+
+    Every system of the batch is one element along the single axis of the capacity arrays. Systems of different
+    tiers and GHI values can be mixed in one batch, since the load and GHI of each system are looked up per hour.
+
+    Arguments
+    ---------
+    pv_capacity, battery_size, diesel_capacity : numpy.ndarray
+        Sizes of the systems, shape (n,)
+    load_by_hour : numpy.ndarray
+        Load in each hour of the day for each system, shape (24, n)
+    ghi : numpy.ndarray
+        Hourly GHI for each annual GHI value simulated, shape (hours, number of GHI values)
+    ghi_index : numpy.ndarray
+        Column of ghi used by each system, shape (n,)
+    temp : numpy.ndarray
+        Hourly temperature profile
+    energy_per_hh : float
+        kWh/household/year
+    lpsp_max, diesel_limit : float
+        If given, systems that go over the loss of power supply probability or the diesel share limit are not
+        simulated after the end of that day. Their diesel_share and lpsp are the values reached at that point,
+        already over the limits, and their other results are NaN
+    keep : numpy.ndarray
+        Boolean mask of the systems simulated for the whole year even if they go over the limits
+    day_weights : numpy.ndarray
+        Number of days of the year that each simulated day stands for, when the hourly profiles only hold some
+        representative days (see representative_days). The state of charge is carried from one simulated day to
+        the next and the annual totals are weighted. If None every simulated day counts once
+
+    Returns
+    -------
+    diesel_share, battery_life, lpsp, fuel_usage, excess_gen : numpy.ndarray
+    """
+    n_chg = 0.92  # charge efficiency of battery
+    n_dis = 0.92  # discharge efficiency of battery
+    k_t = 0.005  # temperature factor of PV panels
+    inv_eff = 0.92  # inverter_efficiency
+
+    hour_numbers = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23) * \
+        (len(ghi) // 24)
+
+    shape = pv_capacity.shape
+    dod = np.zeros(shape=(24,) + shape)
+    battery_use = np.zeros(shape=(24,) + shape)  # Stores the amount of battery discharge during the day
+    fuel_result = np.zeros(shape=shape)
+    battery_life = np.zeros(shape=shape)
+    soc = np.ones(shape=shape) * 0.5
+    unmet_demand = np.zeros(shape=shape)
+    excess_gen = np.zeros(shape=shape)  # TODO
+    annual_diesel_gen = np.zeros(shape=shape)
+    dod_max = np.ones(shape=shape) * 0.6
+
+    # Systems still simulated, as positions in the batch. Systems over the limits are recorded at the end of the day
+    # and dropped from the batch once they make up 2% of it, so that the arrays are not copied every day
+    active = np.arange(shape[0])
+    stop_infeasible = lpsp_max is not None or diesel_limit is not None
+    keep = np.zeros(shape=shape, dtype=bool) if keep is None else np.asarray(keep)
+    stopped = np.zeros(shape=shape, dtype=bool)
+    total_unmet_demand = np.full(shape, np.nan)
+    total_diesel_gen = np.full(shape, np.nan)
+
+    # Terms that only depend on the size of each system
+    pv_rating = pv_capacity * 0.9
+    diesel_min_load = 0.4 * diesel_capacity
+    diesel_fixed_fuel = diesel_capacity * 0.08145
+
+    # Work arrays overwritten every hour, so that the hourly update does not allocate any array. The operations are
+    # done in the same order as in the plain expressions they replace, which keeps the results bit for bit the same
+    ghi_hour, t_factor, pv_gen, net_load, battery_dispatchable, battery_chargeable, diesel_gen, discharge, work, \
+        positive, negative, diesel_on, diesel_off, mask = work_buffers(shape[0], 9, 5)
+
+    for i in range(len(hour_numbers)):
+        hour = hour_numbers[i]
+        weight = None if day_weights is None else day_weights[i // 24]
+
+        # Battery self-discharge (0.02% per hour)
+        soc *= 0.9998
+
+        # Calculation of PV gen and net load
+        np.take(ghi[i], ghi_index, out=ghi_hour, mode='clip')
+        np.multiply(ghi_hour, 0.0256, out=t_factor)
+        np.add(temp[i], t_factor, out=t_factor)  # PV cell temperature
+        t_factor -= 25
+        t_factor *= k_t
+        np.subtract(1, t_factor, out=t_factor)
+        np.multiply(pv_rating, ghi_hour, out=pv_gen)
+        pv_gen /= 1000
+        pv_gen *= t_factor  # PV generation in the hour
+        pv_gen *= inv_eff
+        np.subtract(load_by_hour[hour], pv_gen, out=net_load)  # remaining load not met by PV panels
+
+        # Dispatchable energy from battery available to meet load
+        np.multiply(soc, battery_size, out=battery_dispatchable)
+        battery_dispatchable *= n_dis
+        battery_dispatchable *= inv_eff
+
+        # Below is the dispatch strategy for the diesel generator as described in word document
+
+        if 4 < hour <= 17:
+            # During the morning and day, the batteries are dispatched primarily.
+            # The diesel generator, if needed, is run at the lowest possible capacity
+
+            # Minimum diesel capacity to cover the net load after batteries.
+            # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
+            np.subtract(net_load, battery_dispatchable, out=work)
+            np.maximum(work, diesel_min_load, out=work)
+            np.minimum(work, diesel_capacity, out=work)
+
+            np.greater(net_load, battery_dispatchable, out=mask)
+
+        elif 17 > hour > 23:
+            # During the evening, the diesel generator is dispatched primarily, at max_diesel.
+            # Batteries are dispatched if diesel generation is insufficient.
+
+            # Energy required to fully charge battery
+            np.subtract(1, soc, out=battery_chargeable)
+            battery_chargeable *= battery_size
+            battery_chargeable /= n_chg
+            battery_chargeable /= inv_eff
+
+            #  Maximum amount of diesel needed to supply load and charge battery
+            # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
+            np.add(net_load, battery_chargeable, out=work)
+            np.minimum(work, diesel_capacity, out=work)
+            np.maximum(work, diesel_min_load, out=work)
+
+            np.greater(net_load, 0, out=mask)
+        else:
+            # During night, batteries are dispatched primarily.
+            # The diesel generator is used at max_diesel if load is larger than battery capacity
+
+            # Energy required to fully charge battery
+            np.subtract(1, soc, out=battery_chargeable)
+            battery_chargeable *= battery_size
+            battery_chargeable /= n_chg
+            battery_chargeable /= inv_eff
+
+            #  Maximum amount of diesel needed to supply load and charge battery
+            # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
+            np.add(net_load, battery_chargeable, out=work)
+            np.minimum(work, diesel_capacity, out=work)
+            np.maximum(work, diesel_min_load, out=work)
+
+            np.greater(net_load, battery_dispatchable, out=mask)
+
+        diesel_gen.fill(0)
+        np.copyto(diesel_gen, work, where=mask)
+
+        np.greater(diesel_gen, 0, out=diesel_on)
+        np.equal(diesel_gen, 0, out=diesel_off)
+        np.multiply(diesel_gen, 0.246, out=work)
+        np.add(diesel_fixed_fuel, work, out=work)
+        if weight is not None:
+            work *= weight
+        np.add(fuel_result, work, out=fuel_result, where=diesel_on)
+        if weight is None:
+            annual_diesel_gen += diesel_gen
+        else:
+            np.multiply(diesel_gen, weight, out=work)
+            annual_diesel_gen += work
+
+        # Reamining load after diesel generator
+        net_load -= diesel_gen
+        np.greater(net_load, 0, out=positive)
+        np.less(net_load, 0, out=negative)
+
+        # If diesel generation is used, but is smaller than load, battery is discharged
+        np.logical_and(positive, diesel_on, out=mask)
+        np.divide(net_load, n_dis, out=work)
+        work /= inv_eff
+        work /= battery_size
+        np.subtract(soc, work, out=soc, where=mask)
+
+        # If diesel generation is used, and is larger than load, battery is charged
+        np.logical_and(negative, diesel_on, out=mask)
+        np.multiply(net_load, n_chg, out=work)
+        work *= inv_eff
+        work /= battery_size
+        np.subtract(soc, work, out=soc, where=mask)
+
+        # If net load is positive and no diesel is used, battery is discharged
+        np.logical_and(positive, diesel_off, out=mask)
+        np.divide(net_load, n_dis, out=discharge)
+        discharge /= battery_size
+        np.subtract(soc, discharge, out=soc, where=mask)
+
+        # If net load is negative, and no diesel has been used, excess PV gen is used to charge battery
+        np.logical_and(negative, diesel_off, out=mask)
+        np.multiply(net_load, n_chg, out=work)
+        work /= battery_size
+        np.subtract(soc, work, out=soc, where=mask)
+
+        # The amount of battery discharge in the hour is stored (measured in State Of Charge)
+        battery_use[hour].fill(0)
+        np.copyto(battery_use[hour], discharge, where=positive)
+        np.minimum(battery_use[hour], soc, out=battery_use[hour])
+
+        # If State of charge is negative, that means there's demand that could not be met.
+        np.less(soc, 0, out=mask)
+        np.negative(soc, out=work)
+        work /= n_dis
+        work *= battery_size
+        if weight is not None:
+            work *= weight
+        np.add(unmet_demand, work, out=unmet_demand, where=mask)
+        np.maximum(soc, 0, out=soc)
+
+        # If State of Charge is larger than 1, that means there was excess PV/diesel generation
+        np.greater(soc, 1, out=mask)
+        np.subtract(soc, 1, out=work)
+        work /= n_chg
+        work *= battery_size
+        if weight is not None:
+            work *= weight
+        np.add(excess_gen, work, out=excess_gen, where=mask)
+        # TODO
+        np.minimum(soc, 1, out=soc)
+
+        np.subtract(1, soc, out=dod[hour])  # The depth of discharge in every hour of the day is stored
+        if hour == 23:  # The battery wear during the last day is calculated
+            battery_used = np.where(dod.max(axis=0) > 0, 1, 0)
+            wear = battery_use.sum(axis=0) / (
+                    531.52764 * np.maximum(0.1, dod.max(axis=0) * dod_max) ** -1.12297) * battery_used
+            battery_life += wear if weight is None else wear * weight
+
+            if stop_infeasible:
+                # The results of a system are recorded on the first day it is over the limits, so that they do not
+                # depend on the other systems of the batch
+                over = over_limits(unmet_demand, annual_diesel_gen, energy_per_hh, lpsp_max, diesel_limit) & ~keep
+                new = over & ~stopped
+                total_unmet_demand[active[new]] = unmet_demand[new]
+                total_diesel_gen[active[new]] = annual_diesel_gen[new]
+                stopped |= over
+
+                if stopped.sum() > 0.02 * len(active):
+                    running = ~stopped
+                    active = active[running]
+                    pv_rating, battery_size, diesel_capacity, diesel_min_load, diesel_fixed_fuel, load_by_hour, \
+                        ghi_index, keep, stopped, dod, battery_use, fuel_result, battery_life, soc, unmet_demand, \
+                        excess_gen, annual_diesel_gen, dod_max = (np.compress(running, array, axis=-1) for array in (
+                            pv_rating, battery_size, diesel_capacity, diesel_min_load, diesel_fixed_fuel,
+                            load_by_hour, ghi_index, keep, stopped, dod, battery_use, fuel_result, battery_life, soc,
+                            unmet_demand, excess_gen, annual_diesel_gen, dod_max))
+                    ghi_hour, t_factor, pv_gen, net_load, battery_dispatchable, battery_chargeable, diesel_gen, \
+                        discharge, work, positive, negative, diesel_on, diesel_off, mask = \
+                        work_buffers(len(active), 9, 5)
+
+    running = active[~stopped]
+    total_unmet_demand[running] = unmet_demand[~stopped]
+    total_diesel_gen[running] = annual_diesel_gen[~stopped]
+    total_fuel = np.full(shape, np.nan)
+    total_fuel[running] = fuel_result[~stopped]
+    total_battery_life = np.full(shape, np.nan)
+    total_battery_life[running] = battery_life[~stopped]
+    total_excess_gen = np.full(shape, np.nan)
+    total_excess_gen[running] = excess_gen[~stopped]
+
+    condition = total_unmet_demand / energy_per_hh  # LPSP is calculated
+    excess_gen = total_excess_gen / energy_per_hh
+    battery_life = np.round(1 / total_battery_life)
+    diesel_share = total_diesel_gen / energy_per_hh
+
+    return diesel_share, battery_life, condition, total_fuel, excess_gen
+
+
+def _pv_diesel_dispatch(energy_per_hh, pairs, ghi_curve, temp, pv_no, diesel_no, lpsp_max=None, diesel_limit=None,
+                        days=None):
+    """Simulates the sizing grids of a list of (tier, ghi) pairs in one batch and returns a DispatchResult per pair"""
+    ghi_values = list(dict.fromkeys(ghi for tier, ghi in pairs))
+    ghi = ghi_curve * np.array(ghi_values, dtype=float) * 1000 / ghi_curve.sum()
+
+    day_weights = None
+    if days is not None:
+        # The profiles are scaled on the whole year before only the representative days are kept
+        representatives, day_weights = representative_days([ghi_curve, temp], days)
+        hours = representative_hours(representatives)
+        ghi = ghi[hours]
+        temp = temp[hours]
+
+    load_curves = {tier: load_curve(tier, energy_per_hh) for tier in set(tier for tier, ghi_value in pairs)}
+    sizes = {tier: pv_diesel_sizes(load_curves[tier], energy_per_hh, pv_no, diesel_no) for tier in load_curves}
+    grid_shape = sizes[pairs[0][0]][0].shape
+    grid_size = sizes[pairs[0][0]][0].size
+
+    pv_capacity = np.concatenate([sizes[tier][0].ravel() for tier, ghi_value in pairs])
+    battery_size = np.concatenate([sizes[tier][1].ravel() for tier, ghi_value in pairs])
+    diesel_capacity = np.concatenate([sizes[tier][2].ravel() for tier, ghi_value in pairs])
+    load_by_hour = np.repeat(np.array([load_curves[tier][:24] for tier, ghi_value in pairs]).T, grid_size, axis=1)
+    ghi_index = np.repeat([ghi_values.index(ghi_value) for tier, ghi_value in pairs], grid_size)
+    # The first configuration of each grid is reported when none is feasible, so it is always simulated in full
+    keep = np.arange(len(pv_capacity)) % grid_size == 0
+
     diesel_share, battery_life, lpsp, fuel_usage, excess_gen = \
-        pv_diesel_capacities(pv_panel_size, battery_size, diesel_capacity, pv_no, diesel_no, len(battery_sizes))
+        pv_diesel_capacities(pv_capacity, battery_size, diesel_capacity, load_by_hour, ghi, ghi_index, temp,
+                             energy_per_hh, lpsp_max, diesel_limit, keep, day_weights)
     battery_life = np.minimum(20, battery_life)
 
-    def calculate_hybrid_lcoe(diesel_price):
-        # Necessary information for calculation of LCOE is defined
-        project_life = end_year - start_year
-        generation = np.ones(project_life) * energy_per_hh
-        generation[0] = 0
+    results = []
+    for n, (tier, ghi_value) in enumerate(pairs):
+        batch = slice(n * grid_size, (n + 1) * grid_size)
+        pv_panel_size, battery_sizes, diesel_caps = sizes[tier]
+        results.append(DispatchResult(pv_panel_size.copy(), battery_sizes.copy(), diesel_caps.copy(),
+                                      diesel_share[batch].reshape(grid_shape),
+                                      battery_life[batch].reshape(grid_shape),
+                                      lpsp[batch].reshape(grid_shape),
+                                      fuel_usage[batch].reshape(grid_shape),
+                                      excess_gen[batch].reshape(grid_shape),
+                                      max(load_curves[tier])))
+    return results
+
+
+def pv_diesel_lcoe_lines(pv_panel_size, battery_size, diesel_capacity, battery_life, fuel_usage, peak_load,
+                         energy_per_hh, start_year, end_year, discount_rate, battery_cost, pv_cost, diesel_cost,
+                         inverter_cost, pv_life, diesel_life):
+    """LCOE of PV-diesel-battery configurations as a line in the diesel price, and their investment
+
+    The LCOE of each configuration is intercept + slope * diesel price, since only the fuel costs depend on the price.
+    All size and dispatch arrays can have any shape, as long as they broadcast together. The battery is bought with
+    the nominal capacity battery_size / dod_max, so that battery_size can be discharged within the maximum depth of
+    discharge.
+
+    Returns
+    -------
+    lcoe_intercept, lcoe_slope, investment : numpy.ndarray
+    """
+    pv_om = 0.015  # annual OM cost of PV panels
+    diesel_om = 0.1  # annual OM cost of diesel generator
+    inverter_life = 10
+    charge_controller_cost = 0
+
+    dod_max = 0.8  # maximum depth of discharge of battery
+
+    # Necessary information for calculation of LCOE is defined
+    project_life = end_year - start_year
+    generation = np.ones(project_life) * energy_per_hh
+    generation[0] = 0
+
+    # Calculate LCOE
+    shape = np.broadcast(pv_panel_size, battery_size, diesel_capacity, battery_life, fuel_usage).shape
+    sum_costs = np.zeros(shape)
+    sum_fuel = np.zeros(shape)
+    sum_el_gen = np.zeros(shape)
+    investment = np.zeros(shape)
+
+    for year in range(project_life + 1):
+        salvage = np.zeros(shape)
 
-        # Calculate LCOE
-        sum_costs = np.zeros((len(battery_sizes), pv_no, diesel_no))
-        sum_el_gen = np.zeros((len(battery_sizes), pv_no, diesel_no))
-        investment = np.zeros((len(battery_sizes), pv_no, diesel_no))
+        om_costs = pv_panel_size * (pv_cost + charge_controller_cost) * pv_om + \
+            diesel_capacity * diesel_cost * diesel_om
 
-        for year in range(project_life + 1):
-            salvage = np.zeros((len(battery_sizes), pv_no, diesel_no))
+        inverter_investment = np.where(year % inverter_life == 0, peak_load * inverter_cost, 0)
+        diesel_investment = np.where(year % diesel_life == 0, diesel_capacity * diesel_cost, 0)
+        pv_investment = np.where(year % pv_life == 0, pv_panel_size * (pv_cost + charge_controller_cost), 0)
+        battery_investment = np.where(year % battery_life == 0, battery_size * battery_cost / dod_max, 0)
 
-            fuel_costs = fuel_usage * diesel_price
-            om_costs = (pv_panel_size * (pv_cost + charge_controller_cost) * pv_om + diesel_capacity * diesel_cost * diesel_om)
+        if year == project_life:
+            salvage = (1 - (project_life % battery_life) / battery_life) * battery_cost * battery_size / dod_max + \
+                      (1 - (project_life % diesel_life) / diesel_life) * diesel_capacity * diesel_cost + \
+                      (1 - (project_life % pv_life) / pv_life) * pv_panel_size * (pv_cost + charge_controller_cost) + \
+                      (1 - (project_life % inverter_life) / inverter_life) * peak_load * inverter_cost
 
-            inverter_investment = np.where(year % inverter_life == 0, max(load_curve) * inverter_cost, 0)
-            diesel_investment = np.where(year % diesel_life == 0, diesel_capacity * diesel_cost, 0)
-            pv_investment = np.where(year % pv_life == 0, pv_panel_size * (pv_cost + charge_controller_cost), 0)
-            battery_investment = np.where(year % battery_life == 0, battery_size * battery_cost / dod_max, 0)  # TODO Include dod_max here?
+        investment += diesel_investment + pv_investment + battery_investment + inverter_investment - salvage
 
-            if year == project_life:
-                salvage = (1 - (project_life % battery_life) / battery_life) * battery_cost * battery_size / dod_max + \
-                          (1 - (project_life % diesel_life) / diesel_life) * diesel_capacity * diesel_cost + \
-                          (1 - (project_life % pv_life) / pv_life) * pv_panel_size * (pv_cost + charge_controller_cost) + \
-                          (1 - (project_life % inverter_life) / inverter_life) * max(load_curve) * inverter_cost
+        sum_costs += (om_costs + battery_investment + diesel_investment + pv_investment - salvage) / \
+            ((1 + discount_rate) ** year)
+        sum_fuel += fuel_usage / ((1 + discount_rate) ** year)
 
-            investment += diesel_investment + pv_investment + battery_investment + inverter_investment - salvage
+        if year > 0:
+            sum_el_gen += energy_per_hh / ((1 + discount_rate) ** year)
 
-            sum_costs += (fuel_costs + om_costs + battery_investment + diesel_investment + pv_investment - salvage) / ((1 + discount_rate) ** year)
+    return sum_costs / sum_el_gen, sum_fuel / sum_el_gen, investment
 
-            if year > 0:
-                sum_el_gen += energy_per_hh / ((1 + discount_rate) ** year)
 
-        return sum_costs / sum_el_gen, investment
+def pv_diesel_hybrid(
+        energy_per_hh,  # kWh/household/year as defined
+        ghi,  # highest annual GHI value encountered in the GIS data
+        ghi_curve,
+        temp,
+        tier,
+        start_year,
+        end_year,
+        discount_rate,
+        battery_cost,  # =139 battery capital capital cost, USD/kWh of storage capacity
+        pv_cost,  # =534,  # PV panel capital cost, USD/kW peak power
+        diesel_cost,  # 150, # diesel generator capital cost, USD/kW rated power
+        inverter_cost, # 80 + 142
+        pv_life,  # 25
+        diesel_life,  # 10
+        pv_no=10,  # number of PV panel sizes simulated
+        diesel_no=10,  # number of diesel generators simulated
+        diesel_range=[0.7],
+        days=None  # number of representative days simulated, None for the whole year
 
-    diesel_limit = 0.5
+):
+    lpsp_max = 0.05  # maximum loss of load allowed over the year, in share of kWh
+    diesel_limit = 0.5  # maximum share of the demand met by the diesel generator
+
+    # The hourly dispatch is simulated (or re-used from earlier calls), only the costing below depends on prices
+    dispatch = pv_diesel_dispatch(energy_per_hh, ghi, ghi_curve, temp, tier, pv_no, diesel_no, lpsp_max=lpsp_max,
+                                  diesel_limit=diesel_limit, days=days)
+    pv_panel_size = dispatch.renewable_capacity
+    battery_size = dispatch.battery_size
+    diesel_capacity = dispatch.diesel_capacity
+    diesel_share = dispatch.diesel_share
+    battery_life = dispatch.battery_life
+    lpsp = dispatch.lpsp
+    fuel_usage = dispatch.fuel_usage
+    peak_load = dispatch.peak_load
+
+    lcoe_intercept, lcoe_slope, investment = \
+        pv_diesel_lcoe_lines(pv_panel_size, battery_size, diesel_capacity, battery_life, fuel_usage, peak_load,
+                             energy_per_hh, start_year, end_year, discount_rate, battery_cost, pv_cost, diesel_cost,
+                             inverter_cost, pv_life, diesel_life)
 
     min_lcoe_range = []
     investment_range = []
     capacity_range = []
     ren_share_range = []
 
-    for d in diesel_range:
+    infeasible = (lpsp > lpsp_max) | (diesel_share > diesel_limit)
+    lcoe_intercept = np.where(infeasible, 99, lcoe_intercept)
+    lcoe_slope = np.where(infeasible, 0, lcoe_slope)
 
-        lcoe, investment = calculate_hybrid_lcoe(d)
-        lcoe = np.where(lpsp > lpsp_max, 99, lcoe)
-        lcoe = np.where(diesel_share > diesel_limit, 99, lcoe)
+    # The lowest LCOE over all configurations is found on the lower envelope of the LCOE lines
+    envelope = LcoeEnvelope(lcoe_intercept, lcoe_slope)
+    min_lcoes, min_lcoe_indices = envelope.evaluate(diesel_range)
 
-        min_lcoe = np.min(lcoe)
-        min_lcoe_combination = np.unravel_index(np.argmin(lcoe, axis=None), lcoe.shape)
+    for min_lcoe, min_lcoe_index in zip(min_lcoes, min_lcoe_indices):
+        min_lcoe_combination = np.unravel_index(min_lcoe_index, envelope.shape)
         ren_share = 1 - diesel_share[min_lcoe_combination]
         capacity = pv_panel_size[min_lcoe_combination] + diesel_capacity[min_lcoe_combination]
         ren_capacity = pv_panel_size[min_lcoe_combination] / capacity
@@ -313,3 +622,124 @@ def pv_diesel_hybrid(
         ren_share_range.append(ren_share)
 
     return min_lcoe_range, investment_range, capacity_range, ren_share_range  # , ren_capacity, excess_gen
+
+
+def pv_diesel_search_table(energy_per_hh, ghi_values, ghi_curve, temp, tiers, diesel_range, start_year, end_year,
+                           discount_rate, battery_cost, pv_cost, diesel_cost, inverter_cost, pv_life, diesel_life,
+                           budget=150, lpsp_max=0.05, diesel_limit=0.5):
+    """Adaptive sizing of the PV hybrid system of every tier, GHI value and diesel price
+
+    Instead of the fixed sizing grid of pv_diesel_hybrid, the PV capacity, diesel capacity and battery size are
+    refined around the cheapest feasible configuration (see SizingSearch) within a budget of configurations per
+    search. The bounds of the search are those of the fixed grid, with the diesel capacity up to the peak load.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    ghi_values : list
+        Annual GHI values (kWh/m2/year)
+    ghi_curve : numpy.ndarray
+        Hourly GHI profile
+    temp : numpy.ndarray
+        Hourly temperature profile
+    tiers : list
+    diesel_range : list
+        Diesel prices (USD/litre)
+    budget : int
+        Maximum number of configurations evaluated for each tier, GHI value and diesel price
+    lpsp_max, diesel_limit : float
+        Limits of a feasible configuration
+
+    Returns
+    -------
+    table : numpy.ndarray
+        LCOE, investment, capacity and renewable share of the cheapest configuration found for each tier, diesel
+        price and GHI value, shape (4, tiers, diesel prices, GHI values)
+    simulations : int
+        Number of configurations simulated
+    """
+    tiers = list(tiers)
+    ghi = ghi_curve * np.array(ghi_values, dtype=float) * 1000 / ghi_curve.sum()
+    load_curves = {tier: load_curve(tier, energy_per_hh) for tier in tiers}
+
+    searches = {}
+    for tier in tiers:
+        ref = 5 * load_curves[tier][19]
+        lower = [ref / 10, 0, 0.5 * energy_per_hh / 365]
+        upper = [ref, max(load_curves[tier]), 2 * energy_per_hh / 365]
+        for g_index in range(len(ghi_values)):
+            for d_index in range(len(diesel_range)):
+                searches[tier, g_index, d_index] = SizingSearch(lower, upper, budget=budget)
+
+    def simulate(systems, sizes):
+        load_by_hour = np.array([load_curves[tier][:24] for tier, g_index in systems]).T
+        ghi_index = np.array([g_index for tier, g_index in systems])
+        diesel_share, battery_life, lpsp, fuel_usage, excess_gen = \
+            pv_diesel_capacities(sizes[:, 0], sizes[:, 2], sizes[:, 1], load_by_hour, ghi, ghi_index, temp,
+                                 energy_per_hh)
+        return np.column_stack((diesel_share, np.minimum(20, battery_life), lpsp, fuel_usage))
+
+    def cost(key, sizes, dispatch):
+        tier, g_index, d_index = key
+        diesel_share, battery_life, lpsp, fuel_usage = dispatch.T
+        lcoe_intercept, lcoe_slope, investment = \
+            pv_diesel_lcoe_lines(sizes[:, 0], sizes[:, 2], sizes[:, 1], battery_life, fuel_usage,
+                                 max(load_curves[tier]), energy_per_hh, start_year, end_year, discount_rate,
+                                 battery_cost, pv_cost, diesel_cost, inverter_cost, pv_life, diesel_life)
+        feasible = ~((lpsp > lpsp_max) | (diesel_share > diesel_limit))
+        lcoe = np.where(feasible, lcoe_intercept + lcoe_slope * diesel_range[d_index], 99)
+        return lcoe, feasible, np.column_stack((investment, sizes[:, 0] + sizes[:, 1], 1 - diesel_share))
+
+    simulations = search_sizes(searches, simulate, cost)
+
+    table = np.zeros((4, len(tiers), len(diesel_range), len(ghi_values)))
+    for (tier, g_index, d_index), search in searches.items():
+        best = search.best
+        table[0, tiers.index(tier), d_index, g_index] = search.lcoe[best]
+        table[1:, tiers.index(tier), d_index, g_index] = search.results[best]
+    return table, simulations
+
+
+def pv_diesel_days_error(energy_per_hh, ghi_values, ghi_curve, temp, tiers, diesel_range, start_year, end_year,
+                         discount_rate, battery_cost, pv_cost, diesel_cost, inverter_cost, pv_life, diesel_life, days):
+    """Deviation of the least-cost LCOE simulated on representative days from the one of the whole year
+
+    Both dispatches of the calibration sample are kept in the dispatch store, so the sample is not simulated again
+    when the same GHI values are used afterwards.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    ghi_values : list
+        Annual GHI values of the calibration sample (kWh/m2/year)
+    ghi_curve, temp : numpy.ndarray
+        Hourly GHI and temperature profiles
+    tiers : list
+    diesel_range : list
+        Diesel prices of the calibration sample (USD/l)
+    days : int
+        Number of representative days
+
+    Returns
+    -------
+    dict
+        Largest relative deviation of the LCOE over the sample, for each tier
+    """
+    pv_diesel_dispatch_table(energy_per_hh, ghi_values, ghi_curve, temp, tiers)
+    pv_diesel_dispatch_table(energy_per_hh, ghi_values, ghi_curve, temp, tiers, days=days)
+
+    deviation = {}
+    for tier in tiers:
+        full = []
+        reduced = []
+        for ghi in ghi_values:
+            full += pv_diesel_hybrid(energy_per_hh, ghi, ghi_curve, temp, tier, start_year, end_year, discount_rate,
+                                     battery_cost, pv_cost, diesel_cost, inverter_cost, pv_life, diesel_life,
+                                     diesel_range=diesel_range)[0]
+            reduced += pv_diesel_hybrid(energy_per_hh, ghi, ghi_curve, temp, tier, start_year, end_year,
+                                        discount_rate, battery_cost, pv_cost, diesel_cost, inverter_cost, pv_life,
+                                        diesel_life, diesel_range=diesel_range, days=days)[0]
+        deviation[tier] = np.max(np.abs(np.array(reduced) - np.array(full)) / np.array(full))
+    return deviation
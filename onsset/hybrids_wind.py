@@ -3,6 +3,15 @@ import numpy as np
 import pandas as pd
 import os
 
+try:
+    from onsset.hybrids_common import DispatchResult, LcoeEnvelope, SizingSearch, dispatch_store, load_curve, \
+        over_limits, profile_hash, representative_days, representative_hours, search_sizes, simulate_pairs, \
+        work_buffers
+except ImportError:
+    from hybrids_common import DispatchResult, LcoeEnvelope, SizingSearch, dispatch_store, load_curve, \
+        over_limits, profile_hash, representative_days, representative_hours, search_sizes, simulate_pairs, \
+        work_buffers
+
 #logging.basicConfig(format='%(asctime)s\t\t%(message)s', level=logging.DEBUG)
 
 
@@ -16,201 +25,146 @@ def read_wind_environmental_data():
 wind_curve = read_wind_environmental_data()
 
 
-def wind_diesel_hybrid(
-        energy_per_hh,  # kWh/household/year as defined
-        wind_speed, # annual average wind speed
-        wind_curve,
-        tier,
-        start_year,
-        end_year,
-        battery_cost,  # =139 battery capital capital cost, USD/kWh of storage capacity
-        wind_cost,  # =2800,  # PV panel capital cost, USD/kW peak power
-        diesel_cost,  # 150, # diesel generator capital cost, USD/kW rated power
-        inverter_cost,  # 80+142
-        wind_life,  # 20
-        diesel_life,  # 10
-        inverter_life,
-        discount_rate,
-        wind_no=10,  # number of wind panel sizes simulated
-        diesel_no=10,  # number of diesel generators simulated
-        diesel_range=[0.7]
-):
-    n_chg = 0.92  # charge efficiency of battery
-    n_dis = 0.92  # discharge efficiency of battery
-    lpsp_max = 0.05  # maximum loss of load allowed over the year, in share of kWh
-    wind_om = 0.015  # annual OM cost of wind panels
-    diesel_om = 0.1  # annual OM cost of diesel generator
-    k_t = 0.005  # temperature factor of wind panels
-    inverter_life = 10
-    inverter_efficiency = 0.92
+def wind_diesel_dispatch(energy_per_hh, wind_speed, wind_curve, tier, wind_no=10, diesel_no=10,
+                         store=dispatch_store, lpsp_max=0.05, diesel_limit=0.5, days=None):
+    """Simulates the hourly operation of all wind turbine, battery and diesel generator sizes for one tier and
+    wind speed
+
+    Only the physics of the system is simulated here. The results do not depend on diesel price, discount rate or
+    unit costs and are kept in the dispatch store, so that later years and scenarios only redo the costing.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    wind_speed : float
+        Annual average wind speed (m/s)
+    wind_curve : numpy.ndarray
+        Hourly wind speed profile
+    tier : int
+    wind_no : int
+        Number of wind turbine sizes simulated
+    diesel_no : int
+        Number of diesel generator sizes simulated
+    store : DispatchStore or None
+        Where simulated results are kept. If None the dispatch is always simulated
+    lpsp_max, diesel_limit : float
+        Limits of a feasible configuration. Configurations going over them are not simulated any further. If None
+        all configurations are simulated for the whole year
+    days : int
+        If given, only this number of representative days of the year is simulated (see representative_days),
+        which is much faster but approximates the results of the whole year
+
+    Returns
+    -------
+    DispatchResult
+    """
+
+    def simulate():
+        return _wind_diesel_dispatch(energy_per_hh, [(tier, wind_speed)], wind_curve, wind_no, diesel_no, lpsp_max,
+                                     diesel_limit, days)[0]
+
+    if store is None:
+        return simulate()
+
+    key = ('wind', profile_hash(wind_curve), energy_per_hh, tier, wind_speed, (wind_no, diesel_no),
+           (lpsp_max, diesel_limit), days)
+    return store.fetch(key, simulate)
+
+
+def wind_diesel_dispatch_table(energy_per_hh, wind_speeds, wind_curve, tiers=(1, 2, 3, 4, 5), wind_no=10,
+                               diesel_no=10, store=dispatch_store, workers=1, chunk_size=None, lpsp_max=0.05,
+                               diesel_limit=0.5, days=None):
+    """Simulates the dispatch of every combination of tier and wind speed in one pass over the 8760 hours
+
+    All sizing grids are stacked along one axis and simulated together, which is much faster than simulating each
+    tier and wind speed on its own. Combinations already in the store are not simulated again.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    wind_speeds : list
+        Annual average wind speeds (m/s)
+    wind_curve : numpy.ndarray
+        Hourly wind speed profile
+    tiers : list
+    wind_no : int
+        Number of wind turbine sizes simulated
+    diesel_no : int
+        Number of diesel generator sizes simulated
+    store : DispatchStore or None
+        Where simulated results are kept. If None all combinations are simulated
+    workers : int
+        Number of processes simulating the combinations
+    chunk_size : int
+        Number of combinations simulated together by one process
+    lpsp_max, diesel_limit : float
+        Limits of a feasible configuration. Configurations going over them are not simulated any further. If None
+        all configurations are simulated for the whole year
+    days : int
+        If given, only this number of representative days of the year is simulated (see representative_days),
+        which is much faster but approximates the results of the whole year
+
+    Returns
+    -------
+    dict
+        DispatchResult for each (tier, wind_speed) pair
+    """
+
+    def simulate(pairs):
+        return simulate_pairs(_wind_diesel_dispatch, pairs, {'wind_curve': wind_curve},
+                              {'energy_per_hh': energy_per_hh, 'wind_no': wind_no, 'diesel_no': diesel_no,
+                               'lpsp_max': lpsp_max, 'diesel_limit': diesel_limit, 'days': days},
+                              workers, chunk_size)
+
+    pairs = list(dict.fromkeys((tier, wind_speed) for tier in tiers for wind_speed in wind_speeds))
+    if store is None:
+        return dict(zip(pairs, simulate(pairs)))
+
+    profile = profile_hash(wind_curve)
+    keys = {pair: ('wind', profile, energy_per_hh, pair[0], pair[1], (wind_no, diesel_no),
+                   (lpsp_max, diesel_limit), days) for pair in pairs}
+    missing = [pair for pair in pairs if keys[pair] not in store]
+    if len(missing) > 0:
+        simulated = simulate(missing)
+        for pair, result in zip(missing, simulated):
+            store.misses += 1
+            store.put(keys[pair], result)
+
+    return {pair: store.get(keys[pair]) for pair in pairs}
+
+
+def wind_power_curve(wind_curve, wind_speed):
+    """Hourly output of one 600 kW wind turbine for a wind speed profile scaled to the given annual average
+
+    Arguments
+    ---------
+    wind_curve : numpy.ndarray
+        Hourly wind speed profile
+    wind_speed : float
+        Annual average wind speed (m/s)
+    """
+    p_curve = [0, 0, 0, 0, 30, 77, 135, 208, 287, 371, 450, 514, 558,
+               582, 594, 598, 600, 600, 600, 600, 600, 600, 600, 600, 600]
 
     wind_curve = wind_curve * wind_speed / np.average(wind_curve)
+    wind_curve = np.round(wind_curve)
+    for i in range(len(p_curve)):
+        #  wind_power = np.where(wind_curve == i, p_curve[i], wind_power)
+        wind_curve = np.where(wind_curve == i, p_curve[i], wind_curve)
+    return wind_curve
 
-    hour_numbers = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23) * 365
-    dod_max = 0.8  # maximum depth of discharge of battery
-
-    def load_curve(tier, energy_per_hh):
-        # the values below define the load curve for the five tiers. The values reflect the share of the daily demand
-        # expected in each hour of the day (sum of all values for one tier = 1)
-        tier5_load_curve = [0.021008403, 0.021008403, 0.021008403, 0.021008403, 0.027310924, 0.037815126,
-                            0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.042016807,
-                            0.042016807, 0.042016807, 0.042016807, 0.042016807, 0.046218487, 0.050420168,
-                            0.067226891, 0.084033613, 0.073529412, 0.052521008, 0.033613445, 0.023109244]
-        tier4_load_curve = [0.017167382, 0.017167382, 0.017167382, 0.017167382, 0.025751073, 0.038626609,
-                            0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.042918455,
-                            0.042918455, 0.042918455, 0.042918455, 0.042918455, 0.0472103, 0.051502146,
-                            0.068669528, 0.08583691, 0.075107296, 0.053648069, 0.034334764, 0.021459227]
-        tier3_load_curve = [0.013297872, 0.013297872, 0.013297872, 0.013297872, 0.019060284, 0.034574468,
-                            0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.044326241,
-                            0.044326241, 0.044326241, 0.044326241, 0.044326241, 0.048758865, 0.053191489,
-                            0.070921986, 0.088652482, 0.077570922, 0.055407801, 0.035460993, 0.019946809]
-        tier2_load_curve = [0.010224949, 0.010224949, 0.010224949, 0.010224949, 0.019427403, 0.034764826,
-                            0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.040899796,
-                            0.040899796, 0.040899796, 0.040899796, 0.040899796, 0.04601227, 0.056237219,
-                            0.081799591, 0.102249489, 0.089468303, 0.06390593, 0.038343558, 0.017893661]
-        tier1_load_curve = [0, 0, 0, 0, 0.012578616, 0.031446541, 0.037735849, 0.037735849, 0.037735849,
-                            0.037735849, 0.037735849, 0.037735849, 0.037735849, 0.037735849, 0.037735849,
-                            0.037735849, 0.044025157, 0.062893082, 0.100628931, 0.125786164, 0.110062893,
-                            0.078616352, 0.044025157, 0.012578616]
-
-        if tier == 1:
-            load_curve = tier1_load_curve * 365
-        elif tier == 2:
-            load_curve = tier2_load_curve * 365
-        elif tier == 3:
-            load_curve = tier3_load_curve * 365
-        elif tier == 4:
-            load_curve = tier4_load_curve * 365
-        else:
-            load_curve = tier5_load_curve * 365
-
-        return np.array(load_curve) * energy_per_hh / 365
-
-    load_curve = load_curve(tier, energy_per_hh)
-
-    def wind_diesel_capacities(wind_capacity, battery_size, diesel_capacity, wind_no, diesel_no, battery_no, wind_curve):
-        dod = np.zeros(shape=(24, battery_no, wind_no, diesel_no))
-        battery_use = np.zeros(shape=(24, battery_no, wind_no, diesel_no))  # Stores the amount of battery discharge during the day
-        fuel_result = np.zeros(shape=(battery_no, wind_no, diesel_no))
-        battery_life = np.zeros(shape=(battery_no, wind_no, diesel_no))
-        soc = np.ones(shape=(battery_no, wind_no, diesel_no)) * 0.5
-        unmet_demand = np.zeros(shape=(battery_no, wind_no, diesel_no))
-        excess_gen = np.zeros(shape=(battery_no, wind_no, diesel_no)) # TODO
-        annual_diesel_gen = np.zeros(shape=(battery_no, wind_no, diesel_no))
-        dod_max = np.ones(shape=(battery_no, wind_no, diesel_no)) * 0.6
-
-        p_rated = 600
-        es = 0.85  # losses in wind electricity
-        u_arr = range(1, 26)
-        p_curve = [0, 0, 0, 0, 30, 77, 135, 208, 287, 371, 450, 514, 558,
-                   582, 594, 598, 600, 600, 600, 600, 600, 600, 600, 600, 600]
-        wind_power = np.zeros(8760)
-        wind_curve = np.round(wind_curve)
-        for i in range(len(p_curve)):
-            #  wind_power = np.where(wind_curve == i, p_curve[i], wind_power)
-            wind_curve = np.where(wind_curve == i, p_curve[i], wind_curve)
-        # wind_power = wind_power[:, 0]
-        wind_power = wind_curve
-
-        for i in range(8760):
-
-            # Battery self-discharge (0.02% per hour)
-            battery_use[hour_numbers[i], :, :] = 0.0002 * soc
-            soc *= 0.9998
-
-            # Calculation of wind gen and net load
-            wind_gen = wind_power[i] * wind_capacity / p_rated
-            net_load = load_curve[hour_numbers[i]] - wind_gen  # remaining load not met by wind panels
-
-            # Dispatchable energy from battery available to meet load
-            battery_dispatchable = soc * battery_size * n_dis
-            # Energy required to fully charge battery
-            battery_chargeable = (1 - soc) * battery_size / n_chg
-
-            # Below is the dispatch strategy for the diesel generator as described in word document
-
-            if 4 < hour_numbers[i] <= 17:
-                # During the morning and day, the batteries are dispatched primarily.
-                # The diesel generator, if needed, is run at the lowest possible capacity
-
-                # Minimum diesel capacity to cover the net load after batteries.
-                # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
-                min_diesel = np.minimum(
-                    np.maximum(net_load - battery_dispatchable, 0.4 * diesel_capacity),
-                    diesel_capacity)
-
-                diesel_gen = np.where(net_load > battery_dispatchable, min_diesel, 0)
-
-            elif 17 > hour_numbers[i] > 23:
-                # During the evening, the diesel generator is dispatched primarily, at max_diesel.
-                # Batteries are dispatched if diesel generation is insufficient.
-
-                #  Maximum amount of diesel needed to supply load and charge battery
-                # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
-                max_diesel = np.maximum(
-                    np.minimum(net_load + battery_chargeable, diesel_capacity),
-                    0.4 * diesel_capacity)
-
-                diesel_gen = np.where(net_load > 0, max_diesel, 0)
-            else:
-                # During night, batteries are dispatched primarily.
-                # The diesel generator is used at max_diesel if load is larger than battery capacity
-
-                #  Maximum amount of diesel needed to supply load and charge battery
-                # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
-                max_diesel = np.maximum(
-                    np.minimum(net_load + battery_chargeable, diesel_capacity),
-                    0.4 * diesel_capacity)
 
-                diesel_gen = np.where(net_load > battery_dispatchable, max_diesel, 0)
+def wind_diesel_sizes(load_curve_hh, energy_per_hh, wind_no, diesel_no):
+    """Creates the range of wind capacities, diesel capacities and battery sizes to be simulated for one load curve
 
-            fuel_result += np.where(diesel_gen > 0, diesel_capacity * 0.08145 + diesel_gen * 0.246, 0)
-            annual_diesel_gen += diesel_gen
-
-            # Reamining load after diesel generator
-            net_load = net_load - diesel_gen
-
-            # If diesel generation is larger than load, battery is charged
-            # If diesel generation is smaller than load, battery is discharged
-            soc -= np.where(net_load > 0,
-                            net_load / n_dis / battery_size,
-                            net_load * n_chg / battery_size)
-
-            # The amount of battery discharge in the hour is stored (measured in State Of Charge)
-            battery_use[hour_numbers[i], :, :] = \
-                np.minimum(np.where(net_load > 0,
-                                    net_load / n_dis / battery_size,
-                                    0),
-                           soc)
-
-            # If State of charge is negative, that means there's demand that could not be met.
-            unmet_demand += np.where(soc < 0,
-                                     -soc / n_dis * battery_size,
-                                     0)
-            soc = np.maximum(soc, 0)
-
-            # If State of Charge is larger than 1, that means there was excess wind/diesel generation
-            excess_gen += np.where(soc > 1,
-                                   (soc - 1) / n_chg * battery_size,
-                                   0)
-            # TODO
-            soc = np.minimum(soc, 1)
-
-            dod[hour_numbers[i], :, :] = 1 - soc  # The depth of discharge in every hour of the day is stored
-            if hour_numbers[i] == 23:  # The battery wear during the last day is calculated
-                battery_used = np.where(dod.max(axis=0) > 0, 1, 0)
-                battery_life += battery_use.sum(axis=0) / (
-                        531.52764 * np.maximum(0.1, dod.max(axis=0) * dod_max) ** -1.12297) * battery_used
-
-        condition = unmet_demand / energy_per_hh  # LPSP is calculated
-        excess_gen = excess_gen / energy_per_hh
-        battery_life = np.round(1 / battery_life)
-        diesel_share = annual_diesel_gen / energy_per_hh
-
-        return diesel_share, battery_life, condition, fuel_result, excess_gen
-
-    # This section creates the range of wind capacities, diesel capacities and battery sizes to be simulated
-    ref = 5 * load_curve[19]
+    Returns
+    -------
+    wind_panel_size, battery_size, diesel_capacity : numpy.ndarray
+        Arrays of shape (battery sizes, wind_no, diesel_no)
+    """
+    ref = 5 * load_curve_hh[19]
 
     battery_sizes = [0.5 * energy_per_hh / 365, energy_per_hh / 365, 2 * energy_per_hh / 365]
     wind_caps = []
@@ -222,7 +176,7 @@ def wind_diesel_hybrid(
         wind_caps.append(ref * (wind_no - i) / wind_no)
 
     for j in range(diesel_no):
-        diesel_caps.append(j * max(load_curve) / diesel_no)
+        diesel_caps.append(j * max(load_curve_hh) / diesel_no)
 
     wind_caps = np.outer(np.array(wind_caps), wind_extend)
     diesel_caps = np.outer(diesel_extend, np.array(diesel_caps))
@@ -239,62 +193,406 @@ def wind_diesel_hybrid(
         wind_panel_size[j, :, :] = wind_caps
         diesel_capacity[j, :, :] = diesel_caps
 
-    # For the number of diesel, wind and battery capacities the lpsp, battery lifetime, fuel usage and LPSP is calculated
+    return wind_panel_size, battery_size, diesel_capacity
+
+
+def wind_diesel_capacities(wind_capacity, battery_size, diesel_capacity, load_by_hour, wind_power, wind_index,
+                           energy_per_hh, lpsp_max=None, diesel_limit=None, keep=None, day_weights=None):
+    """Hourly dispatch of a batch of wind-diesel-battery systems over one year
+
+    Every system of the batch is one element along the single axis of the capacity arrays. Systems of different
+    tiers and wind speeds can be mixed in one batch, since the load and wind power of each system are looked up
+    per hour.
+
+    Arguments
+    ---------
+    wind_capacity, battery_size, diesel_capacity : numpy.ndarray
+        Sizes of the systems, shape (n,)
+    load_by_hour : numpy.ndarray
+        Load in each hour of the day for each system, shape (24, n)
+    wind_power : numpy.ndarray
+        Hourly turbine output for each wind speed simulated, shape (hours, number of wind speeds)
+    wind_index : numpy.ndarray
+        Column of wind_power used by each system, shape (n,)
+    energy_per_hh : float
+        kWh/household/year
+    lpsp_max, diesel_limit : float
+        If given, systems that go over the loss of power supply probability or the diesel share limit are not
+        simulated after the end of that day. Their diesel_share and lpsp are the values reached at that point,
+        already over the limits, and their other results are NaN
+    keep : numpy.ndarray
+        Boolean mask of the systems simulated for the whole year even if they go over the limits
+    day_weights : numpy.ndarray
+        Number of days of the year that each simulated day stands for, when the hourly profiles only hold some
+        representative days (see representative_days). The state of charge is carried from one simulated day to
+        the next and the annual totals are weighted. If None every simulated day counts once
+
+    Returns
+    -------
+    diesel_share, battery_life, lpsp, fuel_usage, excess_gen : numpy.ndarray
+    """
+    n_chg = 0.92  # charge efficiency of battery
+    n_dis = 0.92  # discharge efficiency of battery
+    p_rated = 600
+
+    hour_numbers = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23) * \
+        (len(wind_power) // 24)
+
+    shape = wind_capacity.shape
+    dod = np.zeros(shape=(24,) + shape)
+    battery_use = np.zeros(shape=(24,) + shape)  # Stores the amount of battery discharge during the day
+    fuel_result = np.zeros(shape=shape)
+    battery_life = np.zeros(shape=shape)
+    soc = np.ones(shape=shape) * 0.5
+    unmet_demand = np.zeros(shape=shape)
+    excess_gen = np.zeros(shape=shape)  # TODO
+    annual_diesel_gen = np.zeros(shape=shape)
+    dod_max = np.ones(shape=shape) * 0.6
+
+    # Systems still simulated, as positions in the batch. Systems over the limits are recorded at the end of the day
+    # and dropped from the batch once they make up 2% of it, so that the arrays are not copied every day
+    active = np.arange(shape[0])
+    stop_infeasible = lpsp_max is not None or diesel_limit is not None
+    keep = np.zeros(shape=shape, dtype=bool) if keep is None else np.asarray(keep)
+    stopped = np.zeros(shape=shape, dtype=bool)
+    total_unmet_demand = np.full(shape, np.nan)
+    total_diesel_gen = np.full(shape, np.nan)
+
+    # Terms that only depend on the size of each system
+    diesel_min_load = 0.4 * diesel_capacity
+    diesel_fixed_fuel = diesel_capacity * 0.08145
+
+    # Work arrays overwritten every hour, so that the hourly update does not allocate any array. The operations are
+    # done in the same order as in the plain expressions they replace, which keeps the results bit for bit the same
+    wind_gen, net_load, battery_dispatchable, battery_chargeable, diesel_gen, discharge, work, positive, mask = \
+        work_buffers(shape[0], 7, 2)
+
+    for i in range(len(hour_numbers)):
+        hour = hour_numbers[i]
+        weight = None if day_weights is None else day_weights[i // 24]
+
+        # Battery self-discharge (0.02% per hour)
+        soc *= 0.9998
+
+        # Calculation of wind gen and net load
+        np.take(wind_power[i], wind_index, out=wind_gen, mode='clip')
+        wind_gen *= wind_capacity
+        wind_gen /= p_rated
+        np.subtract(load_by_hour[hour], wind_gen, out=net_load)  # remaining load not met by wind panels
+
+        # Dispatchable energy from battery available to meet load
+        np.multiply(soc, battery_size, out=battery_dispatchable)
+        battery_dispatchable *= n_dis
+
+        # Below is the dispatch strategy for the diesel generator as described in word document
+
+        if 4 < hour <= 17:
+            # During the morning and day, the batteries are dispatched primarily.
+            # The diesel generator, if needed, is run at the lowest possible capacity
+
+            # Minimum diesel capacity to cover the net load after batteries.
+            # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
+            np.subtract(net_load, battery_dispatchable, out=work)
+            np.maximum(work, diesel_min_load, out=work)
+            np.minimum(work, diesel_capacity, out=work)
+
+            np.greater(net_load, battery_dispatchable, out=mask)
+
+        elif 17 > hour > 23:
+            # During the evening, the diesel generator is dispatched primarily, at max_diesel.
+            # Batteries are dispatched if diesel generation is insufficient.
+
+            # Energy required to fully charge battery
+            np.subtract(1, soc, out=battery_chargeable)
+            battery_chargeable *= battery_size
+            battery_chargeable /= n_chg
+
+            #  Maximum amount of diesel needed to supply load and charge battery
+            # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
+            np.add(net_load, battery_chargeable, out=work)
+            np.minimum(work, diesel_capacity, out=work)
+            np.maximum(work, diesel_min_load, out=work)
+
+            np.greater(net_load, 0, out=mask)
+        else:
+            # During night, batteries are dispatched primarily.
+            # The diesel generator is used at max_diesel if load is larger than battery capacity
+
+            # Energy required to fully charge battery
+            np.subtract(1, soc, out=battery_chargeable)
+            battery_chargeable *= battery_size
+            battery_chargeable /= n_chg
+
+            #  Maximum amount of diesel needed to supply load and charge battery
+            # Diesel genrator limited by lowest possible capacity (40%) and rated capacity
+            np.add(net_load, battery_chargeable, out=work)
+            np.minimum(work, diesel_capacity, out=work)
+            np.maximum(work, diesel_min_load, out=work)
+
+            np.greater(net_load, battery_dispatchable, out=mask)
+
+        diesel_gen.fill(0)
+        np.copyto(diesel_gen, work, where=mask)
+
+        np.greater(diesel_gen, 0, out=mask)
+        np.multiply(diesel_gen, 0.246, out=work)
+        np.add(diesel_fixed_fuel, work, out=work)
+        if weight is not None:
+            work *= weight
+        np.add(fuel_result, work, out=fuel_result, where=mask)
+        if weight is None:
+            annual_diesel_gen += diesel_gen
+        else:
+            np.multiply(diesel_gen, weight, out=work)
+            annual_diesel_gen += work
+
+        # Reamining load after diesel generator
+        net_load -= diesel_gen
+        np.greater(net_load, 0, out=positive)
+
+        # If diesel generation is larger than load, battery is charged
+        # If diesel generation is smaller than load, battery is discharged
+        np.divide(net_load, n_dis, out=discharge)
+        discharge /= battery_size
+        np.multiply(net_load, n_chg, out=work)
+        work /= battery_size
+        np.copyto(work, discharge, where=positive)
+        soc -= work
+
+        # The amount of battery discharge in the hour is stored (measured in State Of Charge)
+        battery_use[hour].fill(0)
+        np.copyto(battery_use[hour], discharge, where=positive)
+        np.minimum(battery_use[hour], soc, out=battery_use[hour])
+
+        # If State of charge is negative, that means there's demand that could not be met.
+        np.less(soc, 0, out=mask)
+        np.negative(soc, out=work)
+        work /= n_dis
+        work *= battery_size
+        if weight is not None:
+            work *= weight
+        np.add(unmet_demand, work, out=unmet_demand, where=mask)
+        np.maximum(soc, 0, out=soc)
+
+        # If State of Charge is larger than 1, that means there was excess wind/diesel generation
+        np.greater(soc, 1, out=mask)
+        np.subtract(soc, 1, out=work)
+        work /= n_chg
+        work *= battery_size
+        if weight is not None:
+            work *= weight
+        np.add(excess_gen, work, out=excess_gen, where=mask)
+        # TODO
+        np.minimum(soc, 1, out=soc)
+
+        np.subtract(1, soc, out=dod[hour])  # The depth of discharge in every hour of the day is stored
+        if hour == 23:  # The battery wear during the last day is calculated
+            battery_used = np.where(dod.max(axis=0) > 0, 1, 0)
+            wear = battery_use.sum(axis=0) / (
+                    531.52764 * np.maximum(0.1, dod.max(axis=0) * dod_max) ** -1.12297) * battery_used
+            battery_life += wear if weight is None else wear * weight
+
+            if stop_infeasible:
+                # The results of a system are recorded on the first day it is over the limits, so that they do not
+                # depend on the other systems of the batch
+                over = over_limits(unmet_demand, annual_diesel_gen, energy_per_hh, lpsp_max, diesel_limit) & ~keep
+                new = over & ~stopped
+                total_unmet_demand[active[new]] = unmet_demand[new]
+                total_diesel_gen[active[new]] = annual_diesel_gen[new]
+                stopped |= over
+
+                if stopped.sum() > 0.02 * len(active):
+                    running = ~stopped
+                    active = active[running]
+                    wind_capacity, battery_size, diesel_capacity, diesel_min_load, diesel_fixed_fuel, \
+                        load_by_hour, wind_index, keep, stopped, dod, battery_use, fuel_result, battery_life, soc, \
+                        unmet_demand, excess_gen, annual_diesel_gen, dod_max = \
+                        (np.compress(running, array, axis=-1) for array in (
+                            wind_capacity, battery_size, diesel_capacity, diesel_min_load, diesel_fixed_fuel,
+                            load_by_hour, wind_index, keep, stopped, dod, battery_use, fuel_result, battery_life, soc,
+                            unmet_demand, excess_gen, annual_diesel_gen, dod_max))
+                    wind_gen, net_load, battery_dispatchable, battery_chargeable, diesel_gen, discharge, work, \
+                        positive, mask = work_buffers(len(active), 7, 2)
+
+    running = active[~stopped]
+    total_unmet_demand[running] = unmet_demand[~stopped]
+    total_diesel_gen[running] = annual_diesel_gen[~stopped]
+    total_fuel = np.full(shape, np.nan)
+    total_fuel[running] = fuel_result[~stopped]
+    total_battery_life = np.full(shape, np.nan)
+    total_battery_life[running] = battery_life[~stopped]
+    total_excess_gen = np.full(shape, np.nan)
+    total_excess_gen[running] = excess_gen[~stopped]
+
+    condition = total_unmet_demand / energy_per_hh  # LPSP is calculated
+    excess_gen = total_excess_gen / energy_per_hh
+    battery_life = np.round(1 / total_battery_life)
+    diesel_share = total_diesel_gen / energy_per_hh
+
+    return diesel_share, battery_life, condition, total_fuel, excess_gen
+
+
+def _wind_diesel_dispatch(energy_per_hh, pairs, wind_curve, wind_no, diesel_no, lpsp_max=None, diesel_limit=None,
+                          days=None):
+    """Simulates the sizing grids of a list of (tier, wind_speed) pairs in one batch and returns a DispatchResult
+    per pair"""
+    wind_speeds = list(dict.fromkeys(wind_speed for tier, wind_speed in pairs))
+    wind_power = np.hstack([wind_power_curve(wind_curve, wind_speed).reshape(len(wind_curve), -1)
+                            for wind_speed in wind_speeds])
+
+    day_weights = None
+    if days is not None:
+        # The turbine output is calculated on the whole year before only the representative days are kept
+        representatives, day_weights = representative_days([wind_curve], days)
+        wind_power = wind_power[representative_hours(representatives)]
+
+    load_curves = {tier: load_curve(tier, energy_per_hh) for tier in set(tier for tier, wind_speed in pairs)}
+    sizes = {tier: wind_diesel_sizes(load_curves[tier], energy_per_hh, wind_no, diesel_no) for tier in load_curves}
+    grid_shape = sizes[pairs[0][0]][0].shape
+    grid_size = sizes[pairs[0][0]][0].size
+
+    wind_capacity = np.concatenate([sizes[tier][0].ravel() for tier, wind_speed in pairs])
+    battery_size = np.concatenate([sizes[tier][1].ravel() for tier, wind_speed in pairs])
+    diesel_capacity = np.concatenate([sizes[tier][2].ravel() for tier, wind_speed in pairs])
+    load_by_hour = np.repeat(np.array([load_curves[tier][:24] for tier, wind_speed in pairs]).T, grid_size, axis=1)
+    wind_index = np.repeat([wind_speeds.index(wind_speed) for tier, wind_speed in pairs], grid_size)
+    # The first configuration of each grid is reported when none is feasible, so it is always simulated in full
+    keep = np.arange(len(wind_capacity)) % grid_size == 0
+
     diesel_share, battery_life, lpsp, fuel_usage, excess_gen = \
-        wind_diesel_capacities(wind_panel_size, battery_size, diesel_capacity, wind_no, diesel_no, len(battery_sizes), wind_curve)
+        wind_diesel_capacities(wind_capacity, battery_size, diesel_capacity, load_by_hour, wind_power, wind_index,
+                               energy_per_hh, lpsp_max, diesel_limit, keep, day_weights)
     battery_life = np.minimum(20, battery_life)
 
-    def calculate_hybrid_lcoe(diesel_price):
-        # Necessary information for calculation of LCOE is defined
-        project_life = end_year - start_year
-        generation = np.ones(project_life) * energy_per_hh
-        generation[0] = 0
+    results = []
+    for n, (tier, wind_speed) in enumerate(pairs):
+        batch = slice(n * grid_size, (n + 1) * grid_size)
+        wind_panel_size, battery_sizes, diesel_caps = sizes[tier]
+        results.append(DispatchResult(wind_panel_size.copy(), battery_sizes.copy(), diesel_caps.copy(),
+                                      diesel_share[batch].reshape(grid_shape),
+                                      battery_life[batch].reshape(grid_shape),
+                                      lpsp[batch].reshape(grid_shape),
+                                      fuel_usage[batch].reshape(grid_shape),
+                                      excess_gen[batch].reshape(grid_shape),
+                                      max(load_curves[tier])))
+    return results
+
+
+def wind_diesel_lcoe_lines(wind_panel_size, battery_size, diesel_capacity, battery_life, fuel_usage, peak_load,
+                           energy_per_hh, start_year, end_year, discount_rate, battery_cost, wind_cost, diesel_cost,
+                           inverter_cost, wind_life, diesel_life):
+    """LCOE of wind-diesel-battery configurations as a line in the diesel price, and their investment
+
+    The LCOE of each configuration is intercept + slope * diesel price, since only the fuel costs depend on the price.
+    All size and dispatch arrays can have any shape, as long as they broadcast together. The battery is bought with
+    the nominal capacity battery_size / dod_max, so that battery_size can be discharged within the maximum depth of
+    discharge.
+
+    Returns
+    -------
+    lcoe_intercept, lcoe_slope, investment : numpy.ndarray
+    """
+    wind_om = 0.015  # annual OM cost of wind panels
+    diesel_om = 0.1  # annual OM cost of diesel generator
+    inverter_life = 10
+
+    dod_max = 0.8  # maximum depth of discharge of battery
 
-        # Calculate LCOE
-        sum_costs = np.zeros((len(battery_sizes), wind_no, diesel_no))
-        sum_el_gen = np.zeros((len(battery_sizes), wind_no, diesel_no))
-        investment = np.zeros((len(battery_sizes), wind_no, diesel_no))
+    # Necessary information for calculation of LCOE is defined
+    project_life = end_year - start_year
+    generation = np.ones(project_life) * energy_per_hh
+    generation[0] = 0
 
-        for year in range(project_life + 1):
-            salvage = np.zeros((len(battery_sizes), wind_no, diesel_no))
+    # Calculate LCOE
+    shape = np.broadcast(wind_panel_size, battery_size, diesel_capacity, battery_life, fuel_usage).shape
+    sum_costs = np.zeros(shape)
+    sum_fuel = np.zeros(shape)
+    sum_el_gen = np.zeros(shape)
+    investment = np.zeros(shape)
 
-            fuel_costs = fuel_usage * diesel_price
-            om_costs = (wind_panel_size * wind_cost * wind_om + diesel_capacity * diesel_cost * diesel_om)
+    for year in range(project_life + 1):
+        salvage = np.zeros(shape)
 
-            inverter_investment = np.where(year % inverter_life == 0, max(load_curve) * inverter_cost, 0)
-            diesel_investment = np.where(year % diesel_life == 0, diesel_capacity * diesel_cost, 0)
-            wind_investment = np.where(year % wind_life == 0, wind_panel_size * wind_cost, 0)
-            battery_investment = np.where(year % battery_life == 0, battery_size * battery_cost / dod_max, 0)  # TODO Include dod_max here?
+        om_costs = (wind_panel_size * wind_cost * wind_om + diesel_capacity * diesel_cost * diesel_om)
 
-            if year == project_life:
-                salvage = (1 - (project_life % battery_life) / battery_life) * battery_cost * battery_size / dod_max + \
-                          (1 - (project_life % diesel_life) / diesel_life) * diesel_capacity * diesel_cost + \
-                          (1 - (project_life % wind_life) / wind_life) * wind_panel_size * wind_cost + \
-                          (1 - (project_life % inverter_life) / inverter_life) * max(load_curve) * inverter_cost
+        inverter_investment = np.where(year % inverter_life == 0, peak_load * inverter_cost, 0)
+        diesel_investment = np.where(year % diesel_life == 0, diesel_capacity * diesel_cost, 0)
+        wind_investment = np.where(year % wind_life == 0, wind_panel_size * wind_cost, 0)
+        battery_investment = np.where(year % battery_life == 0, battery_size * battery_cost / dod_max, 0)
 
-            investment += diesel_investment + wind_investment + battery_investment + inverter_investment - salvage
+        if year == project_life:
+            salvage = (1 - (project_life % battery_life) / battery_life) * battery_cost * battery_size / dod_max + \
+                      (1 - (project_life % diesel_life) / diesel_life) * diesel_capacity * diesel_cost + \
+                      (1 - (project_life % wind_life) / wind_life) * wind_panel_size * wind_cost + \
+                      (1 - (project_life % inverter_life) / inverter_life) * peak_load * inverter_cost
 
-            sum_costs += (fuel_costs + om_costs + battery_investment + diesel_investment + wind_investment - salvage) / ((1 + discount_rate) ** year)
+        investment += diesel_investment + wind_investment + battery_investment + inverter_investment - salvage
 
-            if year > 0:
-                sum_el_gen += energy_per_hh / ((1 + discount_rate) ** year)
+        sum_costs += (om_costs + battery_investment + diesel_investment + wind_investment - salvage) / \
+            ((1 + discount_rate) ** year)
+        sum_fuel += fuel_usage / ((1 + discount_rate) ** year)
 
-        return sum_costs / sum_el_gen, investment
+        if year > 0:
+            sum_el_gen += energy_per_hh / ((1 + discount_rate) ** year)
 
-    diesel_limit = 0.5
+    return sum_costs / sum_el_gen, sum_fuel / sum_el_gen, investment
+
+
+def wind_diesel_hybrid(
+        energy_per_hh,  # kWh/household/year as defined
+        wind_speed, # annual average wind speed
+        wind_curve,
+        tier,
+        start_year,
+        end_year,
+        battery_cost,  # =139 battery capital capital cost, USD/kWh of storage capacity
+        wind_cost,  # =2800,  # PV panel capital cost, USD/kW peak power
+        diesel_cost,  # 150, # diesel generator capital cost, USD/kW rated power
+        inverter_cost,  # 80+142
+        wind_life,  # 20
+        diesel_life,  # 10
+        inverter_life,
+        discount_rate,
+        wind_no=10,  # number of wind panel sizes simulated
+        diesel_no=10,  # number of diesel generators simulated
+        diesel_range=[0.7],
+        days=None  # number of representative days simulated, None for the whole year
+):
+    lpsp_max = 0.05  # maximum loss of load allowed over the year, in share of kWh
+    diesel_limit = 0.5  # maximum share of the demand met by the diesel generator
+
+    # The hourly dispatch is simulated (or re-used from earlier calls), only the costing below depends on prices
+    dispatch = wind_diesel_dispatch(energy_per_hh, wind_speed, wind_curve, tier, wind_no, diesel_no,
+                                    lpsp_max=lpsp_max, diesel_limit=diesel_limit, days=days)
+    wind_panel_size = dispatch.renewable_capacity
+    battery_size = dispatch.battery_size
+    diesel_capacity = dispatch.diesel_capacity
+    diesel_share = dispatch.diesel_share
+    battery_life = dispatch.battery_life
+    lpsp = dispatch.lpsp
+    fuel_usage = dispatch.fuel_usage
+    peak_load = dispatch.peak_load
+
+    lcoe_intercept, lcoe_slope, investment = \
+        wind_diesel_lcoe_lines(wind_panel_size, battery_size, diesel_capacity, battery_life, fuel_usage, peak_load,
+                               energy_per_hh, start_year, end_year, discount_rate, battery_cost, wind_cost,
+                               diesel_cost, inverter_cost, wind_life, diesel_life)
 
     min_lcoe_range = []
     investment_range = []
     capacity_range = []
     ren_share_range = []
 
-    for d in diesel_range:
-        lcoe, investment = calculate_hybrid_lcoe(d)
-        lcoe = np.where(lpsp > lpsp_max, 99, lcoe)
-        lcoe = np.where(diesel_share > diesel_limit, 99, lcoe)
+    infeasible = (lpsp > lpsp_max) | (diesel_share > diesel_limit)
+    lcoe_intercept = np.where(infeasible, 99, lcoe_intercept)
+    lcoe_slope = np.where(infeasible, 0, lcoe_slope)
+
+    # The lowest LCOE over all configurations is found on the lower envelope of the LCOE lines
+    envelope = LcoeEnvelope(lcoe_intercept, lcoe_slope)
+    min_lcoes, min_lcoe_indices = envelope.evaluate(diesel_range)
 
-        min_lcoe = np.min(lcoe)
-        min_lcoe_combination = np.unravel_index(np.argmin(lcoe, axis=None), lcoe.shape)
+    for min_lcoe, min_lcoe_index in zip(min_lcoes, min_lcoe_indices):
+        min_lcoe_combination = np.unravel_index(min_lcoe_index, envelope.shape)
         ren_share = 1 - diesel_share[min_lcoe_combination]
         capacity = wind_panel_size[min_lcoe_combination] + diesel_capacity[min_lcoe_combination]
         ren_capacity = wind_panel_size[min_lcoe_combination] / capacity
@@ -307,4 +605,127 @@ def wind_diesel_hybrid(
 
     return min_lcoe_range, investment_range, capacity_range #, ren_share_range  # , ren_capacity, excess_gen
 
+
+def wind_diesel_search_table(energy_per_hh, wind_speeds, wind_curve, tiers, diesel_range, start_year, end_year,
+                             discount_rate, battery_cost, wind_cost, diesel_cost, inverter_cost, wind_life,
+                             diesel_life, budget=150, lpsp_max=0.05, diesel_limit=0.5):
+    """Adaptive sizing of the wind hybrid system of every tier, wind speed and diesel price
+
+    Instead of the fixed sizing grid of wind_diesel_hybrid, the wind capacity, diesel capacity and battery size are
+    refined around the cheapest feasible configuration (see SizingSearch) within a budget of configurations per
+    search. The bounds of the search are those of the fixed grid, with the diesel capacity up to the peak load.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    wind_speeds : list
+        Annual average wind speeds (m/s)
+    wind_curve : numpy.ndarray
+        Hourly wind speed profile
+    tiers : list
+    diesel_range : list
+        Diesel prices (USD/litre)
+    budget : int
+        Maximum number of configurations evaluated for each tier, wind speed and diesel price
+    lpsp_max, diesel_limit : float
+        Limits of a feasible configuration
+
+    Returns
+    -------
+    table : numpy.ndarray
+        LCOE, investment and capacity of the cheapest configuration found for each tier, diesel price and wind
+        speed, shape (3, tiers, diesel prices, wind speeds)
+    simulations : int
+        Number of configurations simulated
+    """
+    tiers = list(tiers)
+    wind_power = np.hstack([wind_power_curve(wind_curve, wind_speed).reshape(len(wind_curve), -1)
+                            for wind_speed in wind_speeds])
+    load_curves = {tier: load_curve(tier, energy_per_hh) for tier in tiers}
+
+    searches = {}
+    for tier in tiers:
+        ref = 5 * load_curves[tier][19]
+        lower = [ref / 10, 0, 0.5 * energy_per_hh / 365]
+        upper = [ref, max(load_curves[tier]), 2 * energy_per_hh / 365]
+        for w_index in range(len(wind_speeds)):
+            for d_index in range(len(diesel_range)):
+                searches[tier, w_index, d_index] = SizingSearch(lower, upper, budget=budget)
+
+    def simulate(systems, sizes):
+        load_by_hour = np.array([load_curves[tier][:24] for tier, w_index in systems]).T
+        wind_index = np.array([w_index for tier, w_index in systems])
+        diesel_share, battery_life, lpsp, fuel_usage, excess_gen = \
+            wind_diesel_capacities(sizes[:, 0], sizes[:, 2], sizes[:, 1], load_by_hour, wind_power, wind_index,
+                                   energy_per_hh)
+        return np.column_stack((diesel_share, np.minimum(20, battery_life), lpsp, fuel_usage))
+
+    def cost(key, sizes, dispatch):
+        tier, w_index, d_index = key
+        diesel_share, battery_life, lpsp, fuel_usage = dispatch.T
+        lcoe_intercept, lcoe_slope, investment = \
+            wind_diesel_lcoe_lines(sizes[:, 0], sizes[:, 2], sizes[:, 1], battery_life, fuel_usage,
+                                   max(load_curves[tier]), energy_per_hh, start_year, end_year, discount_rate,
+                                   battery_cost, wind_cost, diesel_cost, inverter_cost, wind_life, diesel_life)
+        feasible = ~((lpsp > lpsp_max) | (diesel_share > diesel_limit))
+        lcoe = np.where(feasible, lcoe_intercept + lcoe_slope * diesel_range[d_index], 99)
+        return lcoe, feasible, np.column_stack((investment, sizes[:, 0] + sizes[:, 1]))
+
+    simulations = search_sizes(searches, simulate, cost)
+
+    table = np.zeros((3, len(tiers), len(diesel_range), len(wind_speeds)))
+    for (tier, w_index, d_index), search in searches.items():
+        best = search.best
+        table[0, tiers.index(tier), d_index, w_index] = search.lcoe[best]
+        table[1:, tiers.index(tier), d_index, w_index] = search.results[best]
+    return table, simulations
+
+
+def wind_diesel_days_error(energy_per_hh, wind_speeds, wind_curve, tiers, diesel_range, start_year, end_year,
+                           discount_rate, battery_cost, wind_cost, diesel_cost, inverter_cost, wind_life, diesel_life,
+                           inverter_life, days):
+    """Deviation of the least-cost LCOE simulated on representative days from the one of the whole year
+
+    Both dispatches of the calibration sample are kept in the dispatch store, so the sample is not simulated again
+    when the same wind speeds are used afterwards.
+
+    Arguments
+    ---------
+    energy_per_hh : float
+        kWh/household/year
+    wind_speeds : list
+        Annual average wind speeds of the calibration sample (m/s)
+    wind_curve : numpy.ndarray
+        Hourly wind speed profile
+    tiers : list
+    diesel_range : list
+        Diesel prices of the calibration sample (USD/l)
+    days : int
+        Number of representative days
+
+    Returns
+    -------
+    dict
+        Largest relative deviation of the LCOE over the sample, for each tier
+    """
+    wind_diesel_dispatch_table(energy_per_hh, wind_speeds, wind_curve, tiers)
+    wind_diesel_dispatch_table(energy_per_hh, wind_speeds, wind_curve, tiers, days=days)
+
+    deviation = {}
+    for tier in tiers:
+        full = []
+        reduced = []
+        for wind_speed in wind_speeds:
+            full += wind_diesel_hybrid(energy_per_hh, wind_speed, wind_curve, tier, start_year, end_year,
+                                       battery_cost, wind_cost, diesel_cost, inverter_cost, wind_life, diesel_life,
+                                       inverter_life, discount_rate, diesel_range=diesel_range)[0]
+            reduced += wind_diesel_hybrid(energy_per_hh, wind_speed, wind_curve, tier, start_year, end_year,
+                                          battery_cost, wind_cost, diesel_cost, inverter_cost, wind_life,
+                                          diesel_life, inverter_life, discount_rate, diesel_range=diesel_range,
+                                          days=days)[0]
+        deviation[tier] = np.max(np.abs(np.array(reduced) - np.array(full)) / np.array(full))
+    return deviation
+
+
 #wind_diesel_hybrid(1, 5, wind_curve, 1, 2018, 2030, diesel_price=0.3)
\ No newline at end of file
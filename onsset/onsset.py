@@ -1,15 +1,24 @@
+import hashlib
+import heapq
+import inspect
 import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from math import exp, log, pi
 from typing import Dict
 import scipy.spatial
 import os
 ## TODO activate if you are running via jupyter notebook
-#from onsset.hybrids_pv import read_environmental_data, pv_diesel_hybrid
-#from onsset.hybrids_wind import read_wind_environmental_data, wind_diesel_hybrid
+#from onsset.hybrids_pv import (read_environmental_data, pv_diesel_hybrid, pv_diesel_dispatch_table,
+#                               pv_diesel_search_table, pv_diesel_days_error)
+#from onsset.hybrids_wind import (read_wind_environmental_data, wind_diesel_hybrid, wind_diesel_dispatch_table,
+#                                 wind_diesel_search_table, wind_diesel_days_error)
 
 ## TODO activate if you are running via IDE (PyCharm)
-from hybrids_pv import read_environmental_data, pv_diesel_hybrid
-from hybrids_wind import read_wind_environmental_data, wind_diesel_hybrid
+from hybrids_pv import (read_environmental_data, pv_diesel_hybrid, pv_diesel_dispatch_table,
+                        pv_diesel_search_table, pv_diesel_days_error)
+from hybrids_wind import (read_wind_environmental_data, wind_diesel_hybrid, wind_diesel_dispatch_table,
+                          wind_diesel_search_table, wind_diesel_days_error)
 
 import numpy as np
 import pandas as pd
@@ -111,6 +120,97 @@ LHV_DIESEL = 9.9445485  # (kWh/l) lower heating value
 HOURS_PER_YEAR = 8760
 
 
+def discount_factors(project_life, step, reinvest_year, discount_rate):
+    """Present value factors used in the LCOE calculation
+
+    Arguments
+    ---------
+    project_life : int
+        Number of years in the analysis period
+    step : int
+        First year of operation within the period
+    reinvest_year : int
+        Year in which the technology is bought again, 0 if it outlives the period
+    discount_rate : float
+
+    Returns
+    -------
+    tuple
+        Present value of 1 USD spent at the investment (and re-investment), of 1 USD spent in every year of
+        operation and of 1 USD received at the end of the period
+    """
+    key = (project_life, step, reinvest_year, discount_rate)
+    if key not in _discount_factors:
+        discount_factor = (1 + discount_rate) ** np.arange(project_life)
+        investment_factor = 1 / discount_factor[step]
+        if reinvest_year:
+            investment_factor += 1 / discount_factor[reinvest_year]
+        operation_factor = np.sum(1 / discount_factor[step:])
+        salvage_factor = 1 / discount_factor[-1]
+        _discount_factors[key] = (investment_factor, operation_factor, salvage_factor)
+    return _discount_factors[key]
+
+
+_discount_factors = {}
+
+# Part of the T&D network of the settlements that does not depend on the connection distance, see
+# Technology.network_context. transmission holds the sizing of the lines connecting the total, existing and new
+# network (see TransmissionSizing)
+NetworkContext = namedtuple('NetworkContext', ['transmission', 'extended', 'grid_extended',
+                                               'mv_lines_distribution_length', 'total_lv_lines_length',
+                                               'num_transformers', 'total_nodes', 'generation_per_year', 'peak_load'])
+
+
+# Constants derived from the line and substation parameters of a Technology, see Technology.transmission_plan
+TransmissionPlan = namedtuple('TransmissionPlan', ['mv_line_capacity', 'hv_line_capacity', 'max_mv_load',
+                                                   'max_mv_line_length', 'mv_lv_sub_station_type',
+                                                   'hv_lv_sub_station_type'])
+
+
+# Distance independent sizing of the lines connecting the settlements (see Technology.transmission_sizing). Each is
+# an array with one row per settlement and one column each for the total, existing and new network
+TransmissionSizing = namedtuple('TransmissionSizing', ['mv_connection', 'mv_distribution', 'mv_lines', 'hv_lines',
+                                                       'mv_lv_subs', 'hv_lv_subs'])
+
+
+# Unit costs (Technology attributes) of the T&D network quantities, see Technology.network_quantities
+NETWORK_COSTS = ['hv_line_cost', 'mv_line_cost', 'lv_line_cost', 'service_transf_cost', 'connection_cost_per_hh',
+                 'hv_lv_sub_station_cost', 'hv_mv_sub_station_cost', 'mv_mv_sub_station_cost', 'mv_lv_sub_station_cost']
+
+
+# Demand and connections of the settlements, the part of the network shared by all technologies. energies and nodes
+# hold the whole settlement, the part already connected and the new connections (see Technology.demand_context)
+DemandContext = namedtuple('DemandContext', ['people', 'energy_per_cell', 'energies', 'nodes', 'extended',
+                                             'grid_extended'])
+
+
+# Network quantities, unit costs and costs of one technology in one year, stored per settlement to re-price the
+# network with other unit costs (see SettlementProcessor.record_cost_quantities and reprice_costs)
+CostQuantities = namedtuple('CostQuantities', ['unit_costs', 'quantities', 'lcoe', 'investment', 'generation',
+                                               'lcoe_slope', 'investment_slope'])
+
+
+# Costs and network of the settlements for one technology, see Technology.get_costs. All are arrays with one value
+# per settlement. The slopes are the change of the LCOE and investment per USD of T&D network investment before
+# penalties (see Technology.network_quantities)
+CostResult = namedtuple('CostResult', ['lcoe', 'investment', 'generation', 'peak_load', 'installed_capacity',
+                                       'td_investment', 'hv_km', 'mv_km', 'mv_distribution_km', 'lv_km',
+                                       'transformers', 'connections', 'lcoe_slope', 'investment_slope'])
+
+
+def take_rows(value, rows):
+    """Values of some settlements, given by position, out of a per-settlement array, Series or (named) tuple of them
+
+    Scalars are the same for all settlements and are returned as they are.
+    """
+    if isinstance(value, tuple):
+        values = [take_rows(item, rows) for item in value]
+        return type(value)(*values) if hasattr(value, '_fields') else tuple(values)
+    if np.ndim(value) == 0:
+        return value
+    return np.asarray(value)[rows]
+
+
 class Technology:
     """
     Used to define the parameters for each electricity access technology, and to calculate the LCOE depending on
@@ -144,6 +244,10 @@ class Technology:
         self.tech_life = tech_life
         self.om_costs = om_costs
         self.capital_cost = capital_cost
+        # The capital cost tiers as sorted upper capacity limits and the cost below each of them. Capacities above
+        # the highest limit have no capital cost
+        self.capital_cost_limits = np.array(sorted(capital_cost), dtype=float)
+        self.capital_cost_values = np.append([capital_cost[key] for key in sorted(capital_cost)], 0.)
         self.capacity_factor = capacity_factor
         self.grid_penalty_ratio = grid_penalty_ratio
         self.efficiency = efficiency
@@ -157,6 +261,7 @@ class Technology:
         self.diesel_truck_consumption = diesel_truck_consumption
         self.diesel_truck_volume = diesel_truck_volume
         self.om_of_td_lines = om_of_td_lines
+        self._transmission_plan = None
 
     @classmethod
     def set_default_values(cls, base_year, start_year, end_year, discount_rate, hv_line_type=66, hv_line_cost=43000,
@@ -164,7 +269,8 @@ class Technology:
                            lv_line_cost=12000, lv_line_max_length=0.5, service_transf_type=50, service_transf_cost=4250, # ToDo
                            max_nodes_per_serv_trans=300, mv_lv_sub_station_type=400, mv_lv_sub_station_cost=10000,
                            mv_mv_sub_station_cost=10000, hv_lv_sub_station_type=10000, hv_lv_sub_station_cost=25000,
-                           hv_mv_sub_station_cost=25000, power_factor=0.9, load_moment=9643):
+                           hv_mv_sub_station_cost=25000, power_factor=0.9, load_moment=9643,
+                           max_mv_line_length=50):
         """Initialises the class with parameter values common to all Technologies
         """
         cls.base_year = base_year
@@ -192,108 +298,162 @@ class Technology:
         cls.hv_mv_sub_station_cost = hv_mv_sub_station_cost  # $/unit
         cls.power_factor = power_factor
         cls.load_moment = load_moment  # for 50mm aluminum conductor under 5% voltage drop (kW m)
+        cls.max_mv_line_length = max_mv_line_length  # km, longer connections are built as HV lines
 
     def get_lcoe(self, energy_per_cell, people, num_people_per_hh, start_year, end_year, new_connections,
                  total_energy_per_cell, prev_code, grid_cell_area, base_to_peak, additional_mv_line_length=0.0,
                  capacity_factor=0.9, grid_penalty_ratio=1, fuel_cost=0, elec_loop=0, productive_nodes=0,
                  additional_transformer=0, penalty=1,
                  hybrid_lcoe=0, hybrid_investment=0,
-                 get_investment_cost=False, hybrid=False):
+                 get_investment_cost=False, hybrid=False, network=None, subset=None, demand=None):
         """Calculates the LCOE depending on the parameters. Optionally calculates the investment cost instead.
 
+        Same as get_costs, with the LCOE and investment cost returned as single column DataFrames.
+
         Parameters
         ----------
-        people : float or pandas.Series
+        See get_costs
+        get_investment_cost : bool
+
+        Returns
+        -------
+        lcoe or discounted investment cost
+        """
+
+        if get_investment_cost and np.ndim(people) == 0 and people == 0:
+            # If there are no people, the investment cost is zero.
+            return 0
+        if get_investment_cost and np.ndim(energy_per_cell) == 0 and energy_per_cell == 0:
+            return 0
+
+        costs = self.get_costs(energy_per_cell, people, num_people_per_hh, start_year, end_year, new_connections,
+                               total_energy_per_cell, prev_code, grid_cell_area, base_to_peak,
+                               additional_mv_line_length, capacity_factor, grid_penalty_ratio, fuel_cost, elec_loop,
+                               productive_nodes, additional_transformer, penalty, hybrid_lcoe, hybrid_investment,
+                               network, subset, demand)
+        lcoe = pd.DataFrame(np.atleast_1d(costs.lcoe)[:, np.newaxis])
+        investment_cost = pd.DataFrame(np.atleast_1d(costs.investment)[:, np.newaxis])
+
+        if get_investment_cost:
+            return investment_cost
+        else:
+            return lcoe, investment_cost
+
+    def get_costs(self, energy_per_cell, people, num_people_per_hh, start_year, end_year, new_connections,
+                  total_energy_per_cell, prev_code, grid_cell_area, base_to_peak, additional_mv_line_length=0.0,
+                  capacity_factor=0.9, grid_penalty_ratio=1, fuel_cost=0, elec_loop=0, productive_nodes=0,
+                  additional_transformer=0, penalty=1, hybrid_lcoe=0, hybrid_investment=0, network=None,
+                  subset=None, demand=None):
+        """Calculates the LCOE, investment cost and network of the settlements
+
+        Parameters
+        ----------
+        people : float or numpy.ndarray
             Number of people in settlement
-        new_connections : float or pandas.Series
+        new_connections : float or numpy.ndarray
             Number of new people in settlement to connect
-        prev_code : int or pandas.Series
+        prev_code : int or numpy.ndarray
             Code representation of previous supply technology in settlement
-        total_energy_per_cell : float or pandas.Series
+        total_energy_per_cell : float or numpy.ndarray
             Total annual energy demand in cell, including already met demand
-        energy_per_cell : float or pandas.Series
+        energy_per_cell : float or numpy.ndarray
             Annual energy demand in cell, excluding already met demand
-        num_people_per_hh : float or pandas.Series
+        num_people_per_hh : float or numpy.ndarray
             Number of people per household in settlement
-        grid_cell_area : float or pandas.Series
+        grid_cell_area : float or numpy.ndarray
             Area of settlement (km2)
-        additional_mv_line_length : float or pandas.Series
+        additional_mv_line_length : float or numpy.ndarray
             Distance to connect the settlement
         additional_transformer : int
             If a transformer is needed on other end to connect to HV line
-        productive_nodes : int or pandas.Series
+        productive_nodes : int or numpy.ndarray
             Additional connections (schools, health facilities, shops)
-        elec_loop : int or pandas.Series
+        elec_loop : int or numpy.ndarray
             Round of extension in grid extension algorithm
-        penalty : float or pandas.Series
+        penalty : float or numpy.ndarray
             Cost penalty factor for T&D network, e.g. https://www.mdpi.com/2071-1050/12/3/777
         start_year : int
         end_year : int
-        capacity_factor : float or pandas.Series
-        grid_penalty_ratio : float or pandas.Series
-        fuel_cost : float or pandas.Series
-        get_investment_cost : bool
+        capacity_factor : float or numpy.ndarray
+        grid_penalty_ratio : float or numpy.ndarray
+        fuel_cost : float or numpy.ndarray
+        hybrid_lcoe, hybrid_investment : float or numpy.ndarray
+            Generation cost (USD/kWh) and investment per kWh of the hybrid system, used by hybrid technologies
+        network : NetworkContext
+            Distance independent part of the T&D network of the same settlements (see network_context). If given,
+            only the distance dependent part is calculated here
+        subset : numpy.ndarray
+            Boolean mask or positions of the settlements to calculate. The results of the other settlements are NaN
+        demand : DemandContext
+            Demand and connections of the same settlements (see demand_context), shared with other technologies
+
+        Pandas Series can be given instead of arrays, they are used by position.
 
         Returns
         -------
-        lcoe or discounted investment cost
+        CostResult
         """
 
-        if type(people) == int or type(people) == float or type(people) == np.float64:
-            if people == 0:
-                # If there are no people, the investment cost is zero.
-                if get_investment_cost:
-                    return 0
-                # Otherwise we set the people low (prevent div/0 error) and continue.
-                else:
-                    people = 0.00001
-        else:
+        if subset is not None:
+            rows = np.asarray(subset)
+            rows = np.flatnonzero(rows) if rows.dtype == bool else rows.astype(int)
+            costs = self.get_costs(take_rows(energy_per_cell, rows), take_rows(people, rows),
+                                   take_rows(num_people_per_hh, rows), start_year, end_year,
+                                   take_rows(new_connections, rows), take_rows(total_energy_per_cell, rows),
+                                   take_rows(prev_code, rows), take_rows(grid_cell_area, rows),
+                                   take_rows(base_to_peak, rows), take_rows(additional_mv_line_length, rows),
+                                   take_rows(capacity_factor, rows), take_rows(grid_penalty_ratio, rows),
+                                   take_rows(fuel_cost, rows), take_rows(elec_loop, rows),
+                                   take_rows(productive_nodes, rows), additional_transformer,
+                                   take_rows(penalty, rows), take_rows(hybrid_lcoe, rows),
+                                   take_rows(hybrid_investment, rows),
+                                   None if network is None else take_rows(network, rows), None,
+                                   None if demand is None else take_rows(demand, rows))
+
+            # The results are scattered back to all settlements
+            results = []
+            for result in costs:
+                values = np.full(len(people), np.nan)
+                values[rows] = result
+                results.append(values)
+            return CostResult(*results)
+
+        people, energy_per_cell, num_people_per_hh, new_connections, total_energy_per_cell, prev_code, \
+            grid_cell_area, base_to_peak, additional_mv_line_length, capacity_factor, grid_penalty_ratio, fuel_cost, \
+            elec_loop, productive_nodes, penalty, hybrid_lcoe, hybrid_investment = \
+            (np.asarray(value) for value in (people, energy_per_cell, num_people_per_hh, new_connections,
+                                             total_energy_per_cell, prev_code, grid_cell_area, base_to_peak,
+                                             additional_mv_line_length, capacity_factor, grid_penalty_ratio,
+                                             fuel_cost, elec_loop, productive_nodes, penalty, hybrid_lcoe,
+                                             hybrid_investment))
+
+        # Settlements without people or demand are given a tiny value (prevent div/0 error)
+        if demand is None:
             people = np.maximum(people, 0.00001)
-
-        if type(energy_per_cell) == int or type(energy_per_cell) == float or type(energy_per_cell) == np.float64:
-            if energy_per_cell == 0:
-                # If there are no people, the investment cost is zero.
-                if get_investment_cost:
-                    return 0
-                # Otherwise we set the people low (prevent div/0 error) and continue.
-                else:
-                    energy_per_cell = 0.000000000001
-        else:
             energy_per_cell = np.maximum(energy_per_cell, 0.000000000001)
+        else:
+            people = demand.people
+            energy_per_cell = demand.energy_per_cell
 
         grid_penalty_ratio = np.maximum(1, grid_penalty_ratio)
 
-        generation_per_year, peak_load, td_investment_cost, mv_km, lv_km = self.td_network_cost(people,
-                                                                                  new_connections,
-                                                                                  prev_code,
-                                                                                  total_energy_per_cell,
-                                                                                  energy_per_cell,
-                                                                                  num_people_per_hh,
-                                                                                  grid_cell_area,
-                                                                                  base_to_peak,
-                                                                                  additional_mv_line_length,
-                                                                                  additional_transformer,
-                                                                                  productive_nodes,
-                                                                                  elec_loop,
-                                                                                  penalty)
-        generation_per_year = pd.Series(generation_per_year)
-        peak_load = pd.Series(peak_load)
-        td_investment_cost = pd.Series(td_investment_cost)
+        if network is None:
+            network = self.network_context(people, new_connections, prev_code, total_energy_per_cell, energy_per_cell,
+                                           num_people_per_hh, grid_cell_area, base_to_peak, productive_nodes, demand)
+        generation_per_year = network.generation_per_year
+        peak_load = network.peak_load
+        td_investment_cost, hv_km, mv_km = self.network_cost(network, additional_mv_line_length,
+                                                             additional_transformer, elec_loop, penalty)
 
         td_investment_cost = td_investment_cost * grid_penalty_ratio
 
         td_om_cost = td_investment_cost * self.om_of_td_lines * penalty
         installed_capacity = peak_load / capacity_factor
 
-        cap_cost = td_investment_cost * 0
-        cost_dict_list = self.capital_cost.keys()
-        cost_dict_list = sorted(cost_dict_list)
-        for key in cost_dict_list:
-            if self.standalone:
-                cap_cost.loc[((installed_capacity / (new_connections / num_people_per_hh)) < key) & (cap_cost == 0)] = \
-                    self.capital_cost[key]
-            else:
-                cap_cost.loc[(installed_capacity < key) & (cap_cost == 0)] = self.capital_cost[key]
+        if self.standalone:
+            cap_cost = self.unit_capital_cost(installed_capacity / (new_connections / num_people_per_hh))
+        else:
+            cap_cost = self.unit_capital_cost(installed_capacity)
 
         capital_investment = installed_capacity * cap_cost * penalty
         total_om_cost = td_om_cost + (cap_cost * penalty * self.om_costs * installed_capacity)
@@ -314,62 +474,63 @@ class Technology:
         if self.tech_life + step < project_life:
             reinvest_year = self.tech_life + step
 
-        year = np.arange(project_life)
-        el_gen = np.outer(np.asarray(generation_per_year), np.ones(project_life))
-        for s in range(step):
-            el_gen[:, s] = 0
-        discount_factor = (1 + self.discount_rate) ** year
-        investments = np.zeros(project_life)
-        investments[step] = 1
-        # Calculate the year of re-investment if tech_life is smaller than project life
-        if reinvest_year:
-            investments[reinvest_year] = 1
-        investments = np.outer(total_investment_cost, investments)
-
-        grid_capacity_investments = np.zeros(project_life)
-        grid_capacity_investments[step] = 1
-        # Calculate the year of re-investment if tech_life is smaller than project life
-        if reinvest_year:
-            grid_capacity_investments[reinvest_year] = 1
+        # Present value of a cost of 1 USD made at the (re-)investments, in every operating year and at the end of the
+        # project (salvage). Multiplying these with the cost of each settlement avoids settlement x year matrices.
+        investment_factor, operation_factor, salvage_factor = \
+            discount_factors(project_life, step, reinvest_year, self.discount_rate)
 
         if self.hybrid:
             # hybrid_investment = hybrid_investment * generation_per_year
-            grid_capacity_investments = np.outer(hybrid_investment * generation_per_year, grid_capacity_investments)
+            grid_capacity_investments = hybrid_investment * generation_per_year
         else:
-            grid_capacity_investments = np.outer(peak_load * self.grid_capacity_investment, grid_capacity_investments)
+            grid_capacity_investments = peak_load * self.grid_capacity_investment
 
         # Calculate salvage value if tech_life is bigger than project life
-        salvage = np.zeros(project_life)
         if reinvest_year > 0:
             used_life = (project_life - step) - self.tech_life
         else:
             used_life = project_life - step - 1
-        salvage[-1] = 1
-        salvage = np.outer(total_investment_cost * (1 - used_life / self.tech_life), salvage)
-
-        operation_and_maintenance = np.ones(project_life)
-        for s in range(step):
-            operation_and_maintenance[s] = 0
-        operation_and_maintenance = np.outer(total_om_cost, operation_and_maintenance)
-        fuel = np.outer(np.asarray(generation_per_year), np.zeros(project_life))
-        for p in range(project_life):
-            fuel[:, p] = el_gen[:, p] * fuel_cost
-
-        discounted_investments = investments / discount_factor
-        dicounted_grid_capacity_investments = grid_capacity_investments / discount_factor
-        investment_cost = np.sum(discounted_investments, axis=1) + np.sum(dicounted_grid_capacity_investments, axis=1)
-        discounted_costs = (investments + operation_and_maintenance + fuel - salvage) / discount_factor
-        discounted_generation = el_gen / discount_factor
-        lcoe = np.sum(discounted_costs, axis=1) / np.sum(discounted_generation, axis=1)
-        lcoe = pd.DataFrame(lcoe[:, np.newaxis])
-        investment_cost = pd.DataFrame(investment_cost[:, np.newaxis])
+        salvage = total_investment_cost * (1 - used_life / self.tech_life)
 
-        if get_investment_cost:
-            return investment_cost
-        elif self.hybrid:
-            return lcoe, investment_cost
-        else:
-            return lcoe, investment_cost
+        fuel = generation_per_year * fuel_cost
+
+        investment_cost = (total_investment_cost + grid_capacity_investments) * investment_factor
+        discounted_costs = total_investment_cost * investment_factor + \
+            (total_om_cost + fuel) * operation_factor - salvage * salvage_factor
+        discounted_generation = generation_per_year * operation_factor
+        lcoe = discounted_costs / discounted_generation
+
+        # The T&D network investment enters the investment, O&M and salvage value linearly
+        td_scale = penalty * grid_penalty_ratio
+        lcoe_slope = td_scale * (investment_factor + self.om_of_td_lines * penalty * operation_factor -
+                                 (1 - used_life / self.tech_life) * salvage_factor) / discounted_generation
+        investment_slope = td_scale * investment_factor
+
+        shape = np.shape(lcoe)
+        return CostResult(*(np.array(np.broadcast_to(value, shape), dtype=float) for value in (
+            lcoe, investment_cost, generation_per_year, peak_load, installed_capacity, td_investment_cost, hv_km, mv_km,
+            network.mv_lines_distribution_length, network.total_lv_lines_length, network.num_transformers,
+            network.total_nodes, lcoe_slope, investment_slope)))
+
+    def unit_capital_cost(self, capacity):
+        """Capital cost (USD/kW) of the tier each capacity falls in
+
+        Arguments
+        ---------
+        capacity : float or numpy.ndarray
+            Installed capacity (kW), per household for stand-alone systems
+
+        Returns
+        -------
+        numpy.ndarray
+            Cost of the lowest tier whose limit is above the capacity. Zero and negative capacities fall in the
+            lowest tier. Capacities above all limits, and undefined ones (e.g. stand-alone systems without new
+            households), have no capital cost
+        """
+        capacity = np.asarray(capacity, dtype=float)
+        tier = np.where(np.isnan(capacity), len(self.capital_cost_limits),
+                        np.searchsorted(self.capital_cost_limits, capacity, side='right'))
+        return self.capital_cost_values[tier]
 
     def transmission_network(self, peak_load, additional_mv_line_length=0, additional_transformer=0,
                              mv_distribution=False):
@@ -388,65 +549,116 @@ class Technology:
         mv_distribution : bool
             True if distribution network in settlement contains MV lines
 
+        Returns
+        -------
+        hv_km, mv_km, no_of_hv_mv_subs, no_of_mv_mv_subs, no_of_hv_lv_subs, no_of_mv_lv_subs
+
         Notes
         -----
         Based on: https://www.mdpi.com/1996-1073/12/7/1395
         """
+        sizing = self.transmission_sizing((peak_load,), (mv_distribution,))
+        hv_km, mv_km, no_of_hv_lv_subs, no_of_hv_mv_subs, no_of_mv_mv_subs, no_of_mv_lv_subs = \
+            (value[..., 0] for value in
+             self.transmission_components(sizing, additional_mv_line_length, additional_transformer))
 
-        mv_km = 0
-        hv_km = 0
-        no_of_hv_mv_subs = 0
-        no_of_mv_mv_subs = 0
-        no_of_hv_lv_subs = 0
-        no_of_mv_lv_subs = 0
+        return hv_km, mv_km, no_of_hv_mv_subs, no_of_mv_mv_subs, no_of_hv_lv_subs, no_of_mv_lv_subs
 
-        if not self.standalone:
-            # Sizing HV/MV
-            hv_to_mv_lines = self.hv_line_cost / self.mv_line_cost
-            max_mv_load = self.mv_line_amperage_limit * self.mv_line_type * hv_to_mv_lines
+    def transmission_plan(self):
+        """Constants of the transmission sizing derived from the line and substation parameters
 
+        They are calculated once, and again only if one of the parameters has changed (e.g. with set_default_values).
+
+        Returns
+        -------
+        TransmissionPlan
+        """
+        key = (self.hv_line_cost, self.mv_line_cost, self.mv_line_amperage_limit, self.mv_line_type,
+               self.hv_line_type, self.mv_lv_sub_station_type, self.hv_lv_sub_station_type, self.max_mv_line_length)
+        if self._transmission_plan is None or self._transmission_plan[0] != key:
             mv_amperage = self.mv_lv_sub_station_type / self.mv_line_type
-            no_of_mv_lines = np.ceil(peak_load / (mv_amperage * self.mv_line_type))
             hv_amperage = self.hv_lv_sub_station_type / self.hv_line_type
-            no_of_hv_lines = np.ceil(peak_load / (hv_amperage * self.hv_line_type))
+            hv_to_mv_lines = self.hv_line_cost / self.mv_line_cost
+            plan = TransmissionPlan(mv_line_capacity=mv_amperage * self.mv_line_type,
+                                    hv_line_capacity=hv_amperage * self.hv_line_type,
+                                    max_mv_load=self.mv_line_amperage_limit * self.mv_line_type * hv_to_mv_lines,
+                                    max_mv_line_length=self.max_mv_line_length,
+                                    mv_lv_sub_station_type=self.mv_lv_sub_station_type,
+                                    hv_lv_sub_station_type=self.hv_lv_sub_station_type)
+            self._transmission_plan = (key, plan)
+        return self._transmission_plan[1]
+
+    def transmission_sizing(self, peak_loads, mv_distributions):
+        """Number of lines and substations needed to connect the settlements, the part of the transmission network
+        that does not depend on the connection distance
 
-            if additional_transformer > 0:
-                mv_km = 0
-                hv_km = additional_mv_line_length * no_of_hv_lines
-            else:
-                mv_km = np.where((peak_load <= max_mv_load) & (additional_mv_line_length < 50),
-                                 additional_mv_line_length * no_of_mv_lines,
-                                 0)
-
-                hv_km = np.where((peak_load <= max_mv_load) & (additional_mv_line_length < 50),
-                                 0,
-                                 additional_mv_line_length * no_of_hv_lines)
-
-            no_of_hv_mv_subs = np.where(mv_distribution & (hv_km > 0),
-                                        np.ceil(peak_load / self.mv_lv_sub_station_type),
-                                        0)
-            no_of_mv_mv_subs = np.where(mv_distribution & (mv_km > 0),
-                                        np.ceil(peak_load / self.mv_lv_sub_station_type),
-                                        0)
-            no_of_hv_lv_subs = np.where(mv_distribution,
-                                        0,
-                                        np.where(hv_km > 0, np.ceil(peak_load / self.hv_lv_sub_station_type), 0))
-            if self.mini_grid:
-                no_of_mv_lv_subs = np.where(mv_km > 0,
-                                            np.ceil(peak_load / self.mv_lv_sub_station_type),
-                                            0)
-            else:
-                no_of_mv_lv_subs = np.where(mv_distribution,
-                                            np.where(hv_km == 0, np.where(
-                                                mv_km == 0, np.ceil(peak_load / self.mv_lv_sub_station_type), 0), 0),
-                                            np.ceil(peak_load / self.mv_lv_sub_station_type))
+        Arguments
+        ---------
+        peak_loads : tuple
+            Peak loads (kW) of the networks to connect, e.g. the total, existing and new network of the settlements
+        mv_distributions : tuple
+            True if the distribution network of each contains MV lines
+
+        Returns
+        -------
+        TransmissionSizing
+        """
+        plan = self.transmission_plan()
+        peak_load = np.stack(np.broadcast_arrays(*peak_loads), axis=-1)
+        mv_distribution = np.stack(np.broadcast_arrays(*mv_distributions), axis=-1)
 
-            no_of_hv_mv_subs += additional_transformer  # to connect the MV line to the HV grid
+        return TransmissionSizing(mv_connection=peak_load <= plan.max_mv_load,
+                                  mv_distribution=np.broadcast_to(mv_distribution, peak_load.shape),
+                                  mv_lines=np.ceil(peak_load / plan.mv_line_capacity),
+                                  hv_lines=np.ceil(peak_load / plan.hv_line_capacity),
+                                  mv_lv_subs=np.ceil(peak_load / plan.mv_lv_sub_station_type),
+                                  hv_lv_subs=np.ceil(peak_load / plan.hv_lv_sub_station_type))
 
-        return hv_km, mv_km, no_of_hv_mv_subs, no_of_mv_mv_subs, no_of_hv_lv_subs, no_of_mv_lv_subs
+    def transmission_components(self, sizing, additional_mv_line_length=0, additional_transformer=0):
+        """Lines and substations connecting the settlements for one connection distance, for all networks in the
+        sizing at once (see transmission_network)
+
+        Arguments
+        ---------
+        sizing : TransmissionSizing
+        additional_mv_line_length : float
+            Distance to connect the settlements
+        additional_transformer : int
+            If a transformer is needed on other end to connect to HV line
+
+        Returns
+        -------
+        hv_km, mv_km, no_of_hv_lv_subs, no_of_hv_mv_subs, no_of_mv_mv_subs, no_of_mv_lv_subs
+            Arrays of the same shape as the sizing
+        """
+        if self.standalone:
+            return tuple(np.zeros(np.shape(sizing.mv_lines)) for _ in range(6))
+
+        distance = np.asarray(additional_mv_line_length)[..., np.newaxis]
+        if additional_transformer > 0:
+            hv_km = distance * sizing.hv_lines
+            mv_km = np.zeros_like(hv_km)
+        else:
+            mv_line = sizing.mv_connection & (distance < self.max_mv_line_length)
+            mv_km = np.where(mv_line, distance * sizing.mv_lines, 0)
+            hv_km = np.where(mv_line, 0, distance * sizing.hv_lines)
+
+        mv_distribution = sizing.mv_distribution
+        no_of_hv_mv_subs = np.where(mv_distribution & (hv_km > 0), sizing.mv_lv_subs, 0)
+        no_of_mv_mv_subs = np.where(mv_distribution & (mv_km > 0), sizing.mv_lv_subs, 0)
+        no_of_hv_lv_subs = np.where(~mv_distribution & (hv_km > 0), sizing.hv_lv_subs, 0)
+        if self.mini_grid:
+            no_of_mv_lv_subs = np.where(mv_km > 0, sizing.mv_lv_subs, 0)
+        else:
+            no_of_mv_lv_subs = np.where(~mv_distribution | ((hv_km == 0) & (mv_km == 0)), sizing.mv_lv_subs, 0)
+
+        # A transformer connects the MV line to the HV grid
+        no_of_hv_mv_subs = no_of_hv_mv_subs + additional_transformer
+
+        return hv_km, mv_km, no_of_hv_lv_subs, no_of_hv_mv_subs, no_of_mv_mv_subs, no_of_mv_lv_subs
 
     def distribution_network(self, people, energy_per_cell, num_people_per_hh, grid_cell_area, base_to_peak,
-                             productive_nodes=0):
+                             productive_nodes=0, nodes=None):
         """This method calculates the required components for the distribution network
         This includes potentially MV lines, LV lines and service transformers
 
@@ -462,6 +674,8 @@ class Technology:
             Area of settlement (km2)
         productive_nodes : int
             Additional connections (schools, health facilities, shops)
+        nodes : tuple
+            The demand independent part of the network (see settlement_nodes), if already calculated
 
         Notes
         -----
@@ -478,17 +692,16 @@ class Technology:
             no_of_service_transf = 0
             total_nodes = 0
         else:
+            if nodes is None:
+                nodes = self.settlement_nodes(people, num_people_per_hh, grid_cell_area, productive_nodes)
+            total_nodes, min_service_transf, cluster_radius, transformer_lv_lines_length = nodes
+
             s_max = peak_load / self.power_factor
-            max_transformer_area = pi * self.lv_line_max_length ** 2
-            total_nodes = (people / num_people_per_hh) + productive_nodes
 
-            no_of_service_transf = np.ceil(
-                np.maximum(s_max / self.service_transf_type, np.maximum(total_nodes / self.max_nodes_per_serv_trans,
-                                                                        grid_cell_area / max_transformer_area)))
+            no_of_service_transf = np.ceil(np.maximum(s_max / self.service_transf_type, min_service_transf))
 
             transformer_radius = ((grid_cell_area / no_of_service_transf) / pi) ** 0.5
             transformer_load = peak_load / no_of_service_transf
-            cluster_radius = (grid_cell_area / pi) ** 0.5
 
             # Sizing lv lines in settlement
             cluster_lv_lines_length = np.where(2 / 3 * cluster_radius * transformer_load * 1000 < self.load_moment,
@@ -499,15 +712,80 @@ class Technology:
                                                2 * transformer_radius * no_of_service_transf,
                                                0)
 
-            hh_area = grid_cell_area / total_nodes
-            hh_diameter = 2 * ((hh_area / pi) ** 0.5)
-
-            transformer_lv_lines_length = hh_diameter * total_nodes
-
             lv_km = cluster_lv_lines_length + transformer_lv_lines_length
 
         return cluster_mv_lines_length, lv_km, no_of_service_transf, consumption, peak_load, total_nodes
 
+    @classmethod
+    def settlement_nodes(cls, people, num_people_per_hh, grid_cell_area, productive_nodes=0):
+        """The part of the distribution network that is the same for all technologies, as it does not depend on the
+        demand
+
+        Arguments
+        ---------
+        See distribution_network
+
+        Returns
+        -------
+        total_nodes
+            Number of connections
+        min_service_transf
+            Number of service transformers needed for the connections and area, regardless of the load
+        cluster_radius
+            Radius of the settlement (km)
+        transformer_lv_lines_length
+            Length of the LV lines from the service transformers to the households (km)
+        """
+        max_transformer_area = pi * cls.lv_line_max_length ** 2
+        total_nodes = (people / num_people_per_hh) + productive_nodes
+
+        min_service_transf = np.maximum(total_nodes / cls.max_nodes_per_serv_trans,
+                                        grid_cell_area / max_transformer_area)
+
+        cluster_radius = (grid_cell_area / pi) ** 0.5
+
+        hh_area = grid_cell_area / total_nodes
+        hh_diameter = 2 * ((hh_area / pi) ** 0.5)
+
+        transformer_lv_lines_length = hh_diameter * total_nodes
+
+        return total_nodes, min_service_transf, cluster_radius, transformer_lv_lines_length
+
+    @classmethod
+    def demand_context(cls, people, new_connections, prev_code, total_energy_per_cell, energy_per_cell,
+                       num_people_per_hh, grid_cell_area, productive_nodes=0):
+        """Demand and connections of the settlements, shared by the network of all technologies in a year
+
+        Parameters
+        ----------
+        See td_network_cost
+
+        Returns
+        -------
+        DemandContext
+        """
+        people = np.maximum(np.asarray(people), 0.00001)
+        energy_per_cell = np.maximum(np.asarray(energy_per_cell), 0.000000000001)
+        new_connections = np.asarray(new_connections)
+        total_energy_per_cell = np.asarray(total_energy_per_cell)
+        num_people_per_hh = np.asarray(num_people_per_hh)
+        grid_cell_area = np.asarray(grid_cell_area)
+        prev_code = np.asarray(prev_code)
+
+        # The whole settlement, the part already connected and the new connections. The first and last have the
+        # same connections
+        nodes = cls.settlement_nodes(people, num_people_per_hh, grid_cell_area, productive_nodes)
+        existing_nodes = cls.settlement_nodes(np.maximum((people - new_connections), 1), num_people_per_hh,
+                                              grid_cell_area, productive_nodes)
+
+        return DemandContext(
+            people=people,
+            energy_per_cell=energy_per_cell,
+            energies=(total_energy_per_cell, total_energy_per_cell - energy_per_cell, energy_per_cell),
+            nodes=(nodes, existing_nodes, nodes),
+            extended=(people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
+            grid_extended=(people != new_connections) & (prev_code < 2))
+
     def td_network_cost(self, people, new_connections, prev_code, total_energy_per_cell, energy_per_cell,
                         num_people_per_hh, grid_cell_area, base_to_peak, additional_mv_line_length=0, additional_transformer=0,
                         productive_nodes=0, elec_loop=0, penalty=1):
@@ -540,19 +818,54 @@ class Technology:
         penalty : float
             Cost penalty factor for T&D network, e.g. https://www.mdpi.com/2071-1050/12/3/777
         """
+        network = self.network_context(people, new_connections, prev_code, total_energy_per_cell, energy_per_cell,
+                                       num_people_per_hh, grid_cell_area, base_to_peak, productive_nodes)
+        td_investment_cost, hv_km, mv_km = self.network_cost(network, additional_mv_line_length,
+                                                             additional_transformer, elec_loop, penalty)
+
+        return network.generation_per_year, network.peak_load, td_investment_cost, \
+            network.mv_lines_distribution_length, network.total_lv_lines_length
+
+    def network_context(self, people, new_connections, prev_code, total_energy_per_cell, energy_per_cell,
+                        num_people_per_hh, grid_cell_area, base_to_peak, productive_nodes=0, demand=None):
+        """Calculates the part of the transmission and distribution network that does not depend on the distance
+        to the network
+
+        The distribution network, peak loads and generation of the settlements only change from one year to the
+        next. The grid extension evaluates many connection distances within a year, so it calculates this once and
+        only redoes network_cost for each distance.
+
+        Parameters
+        ----------
+        See td_network_cost
+        demand : DemandContext
+            Demand and connections of the same settlements (see demand_context). If given, the people, demand and
+            previous supply technology are taken from it
+
+        Returns
+        -------
+        NetworkContext
+        """
+
+        if demand is None:
+            nodes = (None, None, None)
+            energies = (total_energy_per_cell, total_energy_per_cell - energy_per_cell, energy_per_cell)
+        else:
+            nodes = demand.nodes
+            energies = demand.energies
+            people = demand.people
 
         # Start by calculating the distribution network required to meet all of the demand
         cluster_mv_lines_length_total, cluster_lv_lines_length_total, no_of_service_transf_total, \
         generation_per_year_total, peak_load_total, total_nodes_total = \
-            self.distribution_network(people, total_energy_per_cell, num_people_per_hh, grid_cell_area, base_to_peak,
-                                      productive_nodes)
+            self.distribution_network(people, energies[0], num_people_per_hh, grid_cell_area, base_to_peak,
+                                      productive_nodes, nodes[0])
 
         # Next calculate the network that is already there
         cluster_mv_lines_length_existing, cluster_lv_lines_length_existing, no_of_service_transf_existing, \
         generation_per_year_existing, peak_load_existing, total_nodes_existing = \
-            self.distribution_network(np.maximum((people - new_connections), 1),
-                                      (total_energy_per_cell - energy_per_cell),
-                                      num_people_per_hh, grid_cell_area, base_to_peak, productive_nodes)
+            self.distribution_network(np.maximum((people - new_connections), 1), energies[1], num_people_per_hh,
+                                      grid_cell_area, base_to_peak, productive_nodes, nodes[1])
 
         # Then calculate the difference between the two
         mv_lines_distribution_length_additional = \
@@ -567,93 +880,692 @@ class Technology:
         # Examine if there are any MV lines in the distribution network, used to determine transformer type
         mv_distribution = np.where(mv_lines_distribution_length_additional > 0, True, False)
 
-        # Then calculate the transmission network (HV or MV lines plus transformers) using the same methodology
-        hv_lines_total_length_total, mv_lines_connection_length_total, no_of_hv_mv_substation_total, \
-        no_of_mv_mv_substation_total, no_of_hv_lv_substation_total, no_of_mv_lv_substation_total = \
-            self.transmission_network(peak_load_total, additional_mv_line_length, additional_transformer,
-                                      mv_distribution=mv_distribution)
-
-        hv_lines_total_length_existing, mv_lines_connection_length_existing, no_of_hv_mv_substation_existing, \
-        no_of_mv_mv_substation_existing, no_of_hv_lv_substation_existing, no_of_mv_lv_substation_existing = \
-            self.transmission_network(peak_load_existing, additional_mv_line_length, additional_transformer,
-                                      mv_distribution=mv_distribution)
-
-        hv_lines_total_length_additional = np.maximum(hv_lines_total_length_total - hv_lines_total_length_existing, 0)
-        mv_lines_connection_length_additional = \
-            np.maximum(mv_lines_connection_length_total - mv_lines_connection_length_existing, 0)
-        no_of_hv_lv_substation_additional = \
-            np.maximum(no_of_hv_lv_substation_total - no_of_hv_lv_substation_existing, 0)
-        no_of_hv_mv_substation_additional = \
-            np.maximum(no_of_hv_mv_substation_total - no_of_hv_mv_substation_existing, 0)
-        no_of_mv_mv_substation_additional = \
-            np.maximum(no_of_mv_mv_substation_total - no_of_mv_mv_substation_existing, 0)
-        no_of_mv_lv_substation_additional = \
-            np.maximum(no_of_mv_lv_substation_total - no_of_mv_lv_substation_existing, 0)
-
         # If no distribution network is present, perform the calculations only once
         mv_lines_distribution_length_new, total_lv_lines_length_new, num_transformers_new, generation_per_year_new, \
-        peak_load_new, total_nodes_new = self.distribution_network(people, energy_per_cell, num_people_per_hh,
-                                                                   grid_cell_area, base_to_peak, productive_nodes)
-
-        mv_distribution = np.where(mv_lines_distribution_length_new > 0, True, False)
-
-        hv_lines_total_length_new, mv_lines_connection_length_new, no_of_hv_mv_substation_new, \
-        no_of_mv_mv_substation_new, no_of_hv_lv_substation_new, no_of_mv_lv_substation_new = \
-            self.transmission_network(peak_load_new, additional_mv_line_length, additional_transformer,
-                                      mv_distribution=mv_distribution)
-
-        mv_lines_distribution_length = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                                mv_lines_distribution_length_additional,
-                                                mv_lines_distribution_length_new)
-
-        hv_lines_total_length = np.where((people != new_connections) & (prev_code < 2),
-                                         hv_lines_total_length_additional,
-                                         hv_lines_total_length_new)
-        mv_lines_connection_length = np.where((people != new_connections) & (prev_code < 2),
-                                              mv_lines_connection_length_additional,
-                                              mv_lines_connection_length_new)
-        total_lv_lines_length = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                         total_lv_lines_length_additional,
-                                         total_lv_lines_length_new)
-        num_transformers = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                    num_transformers_additional,
-                                    num_transformers_new)
-        total_nodes = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                               total_nodes_additional,
-                               total_nodes_new)
-        no_of_hv_lv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_hv_lv_substation_additional,
-                                          no_of_hv_lv_substation_new)
-        no_of_hv_mv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_hv_mv_substation_additional,
-                                          no_of_hv_mv_substation_new)
-        no_of_mv_mv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_mv_mv_substation_additional,
-                                          no_of_mv_mv_substation_new)
-        no_of_mv_lv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_mv_lv_substation_additional,
-                                          no_of_mv_lv_substation_new)
-        generation_per_year = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                       generation_per_year_additional,
-                                       generation_per_year_new)
-        peak_load = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                             peak_load_additional,
-                             peak_load_new)
+        peak_load_new, total_nodes_new = self.distribution_network(people, energies[2], num_people_per_hh,
+                                                                   grid_cell_area, base_to_peak, productive_nodes,
+                                                                   nodes[2])
+
+        mv_distribution_new = np.where(mv_lines_distribution_length_new > 0, True, False)
+
+        # Settlements partly served already, where only the additional network is built
+        if demand is None:
+            extended = (people != new_connections) & ((prev_code < 2) | (prev_code > 3))
+            grid_extended = (people != new_connections) & (prev_code < 2)
+        else:
+            extended = demand.extended
+            grid_extended = demand.grid_extended
+
+        return NetworkContext(
+            transmission=self.transmission_sizing((peak_load_total, peak_load_existing, peak_load_new),
+                                                  (mv_distribution, mv_distribution, mv_distribution_new)),
+            extended=extended,
+            grid_extended=grid_extended,
+            mv_lines_distribution_length=np.where(extended, mv_lines_distribution_length_additional,
+                                                  mv_lines_distribution_length_new),
+            total_lv_lines_length=np.where(extended, total_lv_lines_length_additional, total_lv_lines_length_new),
+            num_transformers=np.where(extended, num_transformers_additional, num_transformers_new),
+            total_nodes=np.where(extended, total_nodes_additional, total_nodes_new),
+            generation_per_year=np.where(extended, generation_per_year_additional, generation_per_year_new),
+            peak_load=np.where(extended, peak_load_additional, peak_load_new))
+
+    def network_cost(self, network, additional_mv_line_length=0, additional_transformer=0, elec_loop=0, penalty=1):
+        """Calculates the T&D network investment of the settlements for one connection distance
+
+        Parameters
+        ----------
+        network : NetworkContext
+            Distance independent part of the network (see network_context)
+        additional_mv_line_length : float
+            Distance to connect the settlement
+        additional_transformer : int
+            If a transformer is needed on other end to connect to HV line
+        elec_loop : int
+            Round of extension in grid extension algorithm
+        penalty : float
+            Cost penalty factor for T&D network, e.g. https://www.mdpi.com/2071-1050/12/3/777
+
+        Returns
+        -------
+        td_investment_cost, hv_km, mv_km
+            Investment, and length of the HV and MV lines connecting the settlements
+        """
+
+        hv_lines_total_length, mv_lines_connection_length, no_of_hv_lv_substation, no_of_hv_mv_substation, \
+            no_of_mv_mv_substation, no_of_mv_lv_substation = \
+            self.connection_network(network, additional_mv_line_length, additional_transformer)
 
         td_investment_cost = (hv_lines_total_length * self.hv_line_cost * (
                 1 + self.existing_grid_cost_ratio * elec_loop) +
                               mv_lines_connection_length * self.mv_line_cost * (
                                       1 + self.existing_grid_cost_ratio * elec_loop) +
-                              total_lv_lines_length * self.lv_line_cost +
-                              mv_lines_distribution_length * self.mv_line_cost +
-                              num_transformers * self.service_transf_cost +
-                              total_nodes * self.connection_cost_per_hh +
+                              network.total_lv_lines_length * self.lv_line_cost +
+                              network.mv_lines_distribution_length * self.mv_line_cost +
+                              network.num_transformers * self.service_transf_cost +
+                              network.total_nodes * self.connection_cost_per_hh +
                               no_of_hv_lv_substation * self.hv_lv_sub_station_cost +
                               no_of_hv_mv_substation * self.hv_mv_sub_station_cost +
                               no_of_mv_mv_substation * self.mv_mv_sub_station_cost +
                               no_of_mv_lv_substation * self.mv_lv_sub_station_cost) * penalty
 
-        return generation_per_year, peak_load, td_investment_cost, mv_lines_distribution_length, total_lv_lines_length
+        return td_investment_cost, hv_lines_total_length, mv_lines_connection_length
+
+    def connection_network(self, network, additional_mv_line_length=0, additional_transformer=0):
+        """Calculates the lines and substations connecting the settlements for one connection distance
+
+        Parameters
+        ----------
+        See network_cost
+
+        Returns
+        -------
+        hv_km, mv_km, no_of_hv_lv_substation, no_of_hv_mv_substation, no_of_mv_mv_substation, no_of_mv_lv_substation
+        """
+
+        # Calculate the transmission network (HV or MV lines plus transformers) of the total, existing and new network
+        # at once
+        components = self.transmission_components(network.transmission, additional_mv_line_length,
+                                                  additional_transformer)
+
+        # Settlements partly served already only need the additional lines and substations
+        hv_lines_total_length, mv_lines_connection_length, no_of_hv_lv_substation, no_of_hv_mv_substation, \
+            no_of_mv_mv_substation, no_of_mv_lv_substation = \
+            (np.where(extended, np.maximum(component[..., 0] - component[..., 1], 0), component[..., 2])
+             for component, extended in zip(components, (network.grid_extended, network.grid_extended) +
+                                            (network.extended,) * 4))
+
+        return hv_lines_total_length, mv_lines_connection_length, no_of_hv_lv_substation, no_of_hv_mv_substation, \
+            no_of_mv_mv_substation, no_of_mv_lv_substation
+
+    def network_quantities(self, network, additional_mv_line_length=0, additional_transformer=0, elec_loop=0):
+        """Quantities of the T&D network of the settlements that are priced with the unit costs in NETWORK_COSTS
+
+        The network investment before penalties is the product of these with network_unit_costs. Lines connecting
+        to existing network are counted more than once if they are more expensive (see existing_grid_cost_ratio).
+
+        Parameters
+        ----------
+        See network_cost
+
+        Returns
+        -------
+        numpy.ndarray
+            One row per settlement and one column per unit cost in NETWORK_COSTS
+        """
+        hv_km, mv_km, no_of_hv_lv_substation, no_of_hv_mv_substation, no_of_mv_mv_substation, \
+            no_of_mv_lv_substation = self.connection_network(network, additional_mv_line_length,
+                                                             additional_transformer)
+        existing_grid = 1 + self.existing_grid_cost_ratio * np.asarray(elec_loop)
+
+        quantities = (hv_km * existing_grid,
+                      mv_km * existing_grid + network.mv_lines_distribution_length,
+                      network.total_lv_lines_length,
+                      network.num_transformers,
+                      network.total_nodes,
+                      no_of_hv_lv_substation,
+                      no_of_hv_mv_substation,
+                      no_of_mv_mv_substation,
+                      no_of_mv_lv_substation)
+        shape = np.broadcast(*quantities).shape
+        return np.column_stack([np.broadcast_to(quantity, shape) for quantity in quantities]).astype(float)
+
+    def network_unit_costs(self):
+        """Unit costs of the T&D network quantities (see network_quantities), in the order of NETWORK_COSTS"""
+        return np.array([getattr(self, name) for name in NETWORK_COSTS], dtype=float)
+
+    def break_even_distance(self, costs, additional_mv_line_length, target_lcoe):
+        """Connection distance up to which the LCOE of the settlements stays below a target LCOE
+
+        The lines and substations connecting a settlement depend on its peak load, and on whether the connection is
+        shorter than max_mv_line_length. On each side of that length the T&D network investment, and with it the LCOE,
+        grows linearly with the connection distance, so the costs at one distance give the LCOE at any other distance
+        on the same side.
+
+        Arguments
+        ---------
+        costs : CostResult
+            Costs of the settlements at one connection distance, without extension loop or additional transformer
+        additional_mv_line_length : float
+            The connection distance the costs are calculated at
+        target_lcoe : numpy.ndarray
+            LCOE to break even with, e.g. the minimum off-grid LCOE
+
+        Returns
+        -------
+        numpy.ndarray
+            The largest connection distance, multiplied with the extension loop factor (1 + existing_grid_cost_ratio *
+            elec_loop), where the LCOE is below the target. It is rounded up slightly, so that a settlement within it
+            may still have a higher LCOE when calculated, but no settlement beyond it has a lower one. Settlements whose
+            LCOE does not grow with the distance get inf if they are below the target and -inf otherwise
+        """
+        lcoe_per_km = self.lcoe_per_km(costs, additional_mv_line_length)
+        target_lcoe = np.asarray(target_lcoe, dtype=float) * (1 + 1e-9)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = additional_mv_line_length + (target_lcoe - costs.lcoe) / lcoe_per_km
+        flat = ~(lcoe_per_km > 0)
+        distance[flat] = np.where(costs.lcoe[flat] <= target_lcoe[flat], np.inf, -np.inf)
+        return distance
+
+    def lcoe_per_km(self, costs, additional_mv_line_length):
+        """Increase of the LCOE of the settlements per km of connection distance, multiplied with the extension loop
+        factor, on the same side of max_mv_line_length as the distance the costs are calculated at (see
+        break_even_distance)"""
+        return costs.lcoe_slope * (costs.hv_km * self.hv_line_cost + costs.mv_km * self.mv_line_cost) / \
+            additional_mv_line_length
+
+    def within_break_even_distance(self, break_even, additional_mv_line_length, elec_loop=0):
+        """Settlements whose connection distance is within their break-even distance
+
+        Arguments
+        ---------
+        break_even : tuple of numpy.ndarray
+            Break-even distances (see break_even_distance) for connections shorter than max_mv_line_length and for
+            the longer ones
+        additional_mv_line_length : numpy.ndarray
+            Distance to connect the settlements
+        elec_loop : int or numpy.ndarray
+            Round of extension in grid extension algorithm
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask of the settlements where the grid can be less costly than the target LCOE. Settlements that
+            need no connection line are always included
+        """
+        distance = np.asarray(additional_mv_line_length, dtype=float)
+        adjusted = distance * (1 + self.existing_grid_cost_ratio * np.asarray(elec_loop))
+        short_distance, long_distance = break_even
+        return (distance == 0) | np.where(distance < self.max_mv_line_length, adjusted <= short_distance,
+                                          adjusted <= long_distance)
+
+
+def technologies_costs(technologies, energy_per_cell, people, num_people_per_hh, start_year, end_year,
+                       new_connections, total_energy_per_cell, prev_code, grid_cell_area, base_to_peak,
+                       productive_nodes=0, options=None, demand=None):
+    """Costs of several technologies for the same settlements in one pass
+
+    The demand and connections of the settlements, and the part of the distribution network that depends only on
+    them, are calculated once and shared by all technologies.
+
+    Arguments
+    ---------
+    technologies : list of Technology
+    options : list of dict
+        Keyword arguments of Technology.get_costs for each technology, e.g. the connection distance or the capacity
+        factor. A base_to_peak given here replaces the common one
+    demand : DemandContext
+        Demand and connections of the settlements (see Technology.demand_context), if already calculated
+
+    See Technology.get_costs for the other arguments
+
+    Returns
+    -------
+    lcoes : numpy.ndarray
+        LCOE of each settlement (rows) and technology (columns)
+    costs : list of CostResult
+        All costs of each technology
+    """
+    if options is None:
+        options = [{}] * len(technologies)
+    if demand is None:
+        demand = Technology.demand_context(people, new_connections, prev_code, total_energy_per_cell,
+                                           energy_per_cell, num_people_per_hh, grid_cell_area, productive_nodes)
+
+    costs = []
+    for technology, option in zip(technologies, options):
+        option = dict(option)
+        costs.append(technology.get_costs(energy_per_cell=energy_per_cell, people=people,
+                                          num_people_per_hh=num_people_per_hh, start_year=start_year,
+                                          end_year=end_year, new_connections=new_connections,
+                                          total_energy_per_cell=total_energy_per_cell, prev_code=prev_code,
+                                          grid_cell_area=grid_cell_area,
+                                          base_to_peak=option.pop('base_to_peak', base_to_peak),
+                                          productive_nodes=productive_nodes, demand=demand, **option))
+
+    return np.column_stack([cost.lcoe for cost in costs]), costs
+
+
+def least_cost_technology(lcoes, technologies):
+    """Technology with the lowest LCOE in each settlement
+
+    Arguments
+    ---------
+    lcoes : numpy.ndarray
+        LCOE of each settlement (rows) and technology (columns), e.g. from technologies_costs
+    technologies : list
+        Name of each technology
+
+    Returns
+    -------
+    names : numpy.ndarray
+        Name of the least-cost technology, the first one in case of a tie. NaN LCOEs are left out, settlements
+        without any LCOE get NaN
+    min_lcoe : numpy.ndarray
+    """
+    lcoes = np.asarray(lcoes, dtype=float)
+    missing = np.isnan(lcoes)
+    undefined = missing.all(axis=1)
+
+    index = np.where(missing, np.inf, lcoes).argmin(axis=1)
+    names = np.array(technologies, dtype=object)[index]
+    names[undefined] = np.nan
+    min_lcoe = np.where(undefined, np.nan, lcoes[np.arange(len(lcoes)), index])
+
+    return names, min_lcoe
+
+
+def load_cost_quantities(path):
+    """Reads the network quantities and costs saved with SettlementProcessor.save_cost_quantities
+
+    Returns
+    -------
+    dict
+        CostQuantities per year and technology code
+    """
+    records = {}
+    with np.load(path) as arrays:
+        keys = sorted({tuple(int(part) for part in key.split('_')[:2]) for key in arrays.files})
+        for year, code in keys:
+            records.setdefault(year, {})[code] = CostQuantities(
+                *(arrays['{}_{}_{}'.format(year, code, field)] for field in CostQuantities._fields))
+    return records
+
+
+def reprice_costs(records, choices, cost_factors, rows=None):
+    """LCOE and investment of the settlements with other unit costs of the T&D network
+
+    The network quantities of the settlements are kept, only their prices change. This is one matrix product per
+    technology, instead of running the model again for every set of unit costs.
+
+    Arguments
+    ---------
+    records : dict
+        CostQuantities of one year per technology code (see SettlementProcessor.record_cost_quantities)
+    choices : numpy.ndarray
+        Technology code of each settlement, e.g. SET_ELEC_FINAL_CODE
+    cost_factors : numpy.ndarray
+        Sets of unit costs (rows) as factors of the unit costs of the run, one column per unit cost in NETWORK_COSTS
+    rows : numpy.ndarray
+        Positions of the settlements to re-price, all if None
+
+    Returns
+    -------
+    lcoe, investment : numpy.ndarray
+        One row per settlement and one column per set of unit costs. Settlements with a technology that is not in
+        the records are NaN
+    """
+    choices = np.asarray(choices)
+    cost_factors = np.atleast_2d(np.asarray(cost_factors, dtype=float))
+    if rows is None:
+        rows = np.arange(len(choices))
+    lcoe = np.full((len(rows), len(cost_factors)), np.nan)
+    investment = np.full((len(rows), len(cost_factors)), np.nan)
+
+    for code, record in records.items():
+        chosen = np.flatnonzero(choices[rows] == code)
+        if len(chosen) == 0:
+            continue
+        settlements = rows[chosen]
+        # Change of the network investment before penalties for each set of unit costs
+        td_change = record.quantities[settlements] @ ((cost_factors - 1) * record.unit_costs).T
+        lcoe[chosen] = record.lcoe[settlements, np.newaxis] + record.lcoe_slope[settlements, np.newaxis] * td_change
+        investment[chosen] = record.investment[settlements, np.newaxis] + \
+            record.investment_slope[settlements, np.newaxis] * td_change
+
+    return lcoe, investment
+
+
+def cost_distributions(records, choices, cost_factors, chunk_size=10000):
+    """Total investment and average LCOE of all settlements for many sets of unit costs of the T&D network
+
+    The settlements are re-priced (see reprice_costs) in chunks, so that the memory use does not grow with the
+    number of settlements.
+
+    Arguments
+    ---------
+    See reprice_costs
+    chunk_size : int
+        Number of settlements re-priced at once
+
+    Returns
+    -------
+    total_investment, average_lcoe : numpy.ndarray
+        One value per set of unit costs. The LCOE is weighted by the generation of the settlements. Settlements with
+        a technology that is not in the records are left out
+    """
+    cost_factors = np.atleast_2d(np.asarray(cost_factors, dtype=float))
+    total_investment = np.zeros(len(cost_factors))
+    total_cost = np.zeros(len(cost_factors))
+    total_generation = 0
+
+    for start in range(0, len(choices), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(choices)))
+        lcoe, investment = reprice_costs(records, choices, cost_factors, rows)
+        generation = np.full(len(rows), np.nan)
+        for code, record in records.items():
+            chosen = np.asarray(choices)[rows] == code
+            generation[chosen] = record.generation[rows[chosen]]
+        priced = ~np.isnan(lcoe[:, 0])
+        total_investment += investment[priced].sum(axis=0)
+        total_cost += generation[priced] @ lcoe[priced]
+        total_generation += generation[priced].sum()
+
+    return total_investment, total_cost / total_generation
+
+
+def python_round(values, decimals=0):
+    """Rounds every value like the built-in round() rounds a float
+
+    np.round scales the values by 10 ** decimals before rounding, which can move a value lying just next to a half
+    (e.g. 0.35, stored as 0.34999...) onto it. Those values are rounded one by one with round() instead.
+
+    Arguments
+    ---------
+    values : numpy.ndarray or pandas.Series
+    decimals : int
+    """
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, decimals)
+    scaled = values * 10.0 ** decimals
+    near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_half):
+        rounded.flat[i] = round(float(values.flat[i]), decimals)
+    return rounded
+
+
+def hybrid_table_lookup(table, resource_range, diesel_range, resource, diesel, tier):
+    """Reads the hybrid results of every settlement from a table computed per tier, diesel price and resource value
+
+    Arguments
+    ---------
+    table : numpy.ndarray
+        Results with shape (quantities, tiers, len(diesel_range), len(resource_range))
+    resource_range : numpy.ndarray
+        GHI or wind speed values of the table, in increasing order
+    diesel_range : numpy.ndarray
+        Diesel prices of the table, in increasing order
+    resource, diesel, tier : numpy.ndarray or pandas.Series
+        Rounded resource value, rounded diesel price and tier of each settlement
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (quantities, settlements)
+    """
+
+    def label_index(labels, values):
+        values = np.asarray(values, dtype=float)
+        index = np.minimum(np.searchsorted(labels, values), len(labels) - 1)
+        missing = labels[index] != values
+        if missing.any():
+            raise KeyError(values[missing][0])
+        return index
+
+    resource_index = label_index(np.asarray(resource_range, dtype=float), resource)
+    diesel_index = label_index(np.asarray(diesel_range, dtype=float), diesel)
+    tier_index = np.asarray(tier, dtype=int) - 1
+    return table[:, tier_index, diesel_index, resource_index]
+
+
+class SettlementIndex:
+    """Spatial index of the settlements on the unit sphere, so that nearest neighbours and distance queries follow
+    the great circle distance
+
+    The index is built once for a set of settlement coordinates and shared by all scenarios run on them (see
+    settlement_index). Queries are restricted to a subset of the settlements, e.g. the electrified ones, with masks.
+    """
+
+    radius = 6371  # Radius of earth in kilometers, as in SettlementProcessor.haversine_vector
+
+    def __init__(self, x_deg, y_deg):
+        lon = np.deg2rad(np.asarray(x_deg, dtype=float))
+        lat = np.deg2rad(np.asarray(y_deg, dtype=float))
+        self.points = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+        self.tree = scipy.spatial.cKDTree(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def chord(self, distance):
+        """Straight line distance through the unit sphere of a great circle distance (km)"""
+        return 2 * np.sin(np.minimum(np.asarray(distance, dtype=float) / self.radius, pi) / 2)
+
+    def nearest(self, sources, targets, distance_upper_bound=np.inf):
+        """The nearest of the source settlements to each target settlement
+
+        Arguments
+        ---------
+        sources : array-like
+            Positions of the settlements to search, e.g. the electrified settlements
+        targets : array-like
+            Positions of the settlements to find the nearest source for
+        distance_upper_bound : float
+            Great circle distance (km) beyond which sources are not searched
+
+        Returns
+        -------
+        numpy.ndarray
+            Position of the nearest source for each target, -1 if there is none within the distance
+        """
+        sources = np.asarray(sources, dtype=int)
+        targets = np.asarray(targets, dtype=int)
+        nearest = np.full(len(targets), -1)
+        if len(targets) == 0 or len(sources) == 0:
+            return nearest
+        # Rounded up, the distances of the sources found are checked by the caller
+        bound = self.chord(distance_upper_bound * (1 + 1e-9)) if np.isfinite(distance_upper_bound) else np.inf
+
+        # Few sources are searched on their own, otherwise the neighbours of the targets in the whole index are
+        # searched for a source, with more neighbours until one is found
+        neighbours = -(-len(self) // len(sources))
+        if neighbours > 16:
+            found = scipy.spatial.cKDTree(self.points[sources]).query(self.points[targets], workers=-1,
+                                                                      distance_upper_bound=bound)[1]
+            within = found < len(sources)
+            nearest[within] = sources[found[within]]
+            return nearest
+
+        is_source = np.zeros(len(self) + 1, dtype=bool)
+        is_source[sources] = True
+        pending = np.arange(len(targets))
+        while len(pending) > 0:
+            neighbours = min(neighbours, len(self))
+            found = self.tree.query(self.points[targets[pending]], k=neighbours, workers=-1,
+                                    distance_upper_bound=bound)[1]
+            found = found.reshape(len(pending), -1)
+            source = is_source[found]
+            has_source = source.any(axis=1)
+            nearest[pending[has_source]] = found[has_source, source[has_source].argmax(axis=1)]
+            # The targets with fewer neighbours within the distance than searched have no source within it
+            pending = pending[~has_source & (found[:, -1] < len(self))]
+            neighbours *= 4
+        return nearest
+
+    def nearest_below(self, values, targets, limits):
+        """The nearest settlement to each target settlement among the ones with a value below the limit of the
+        target, e.g. the settlements closer to the MV lines than each ring of settlements around them
+
+        All the targets are searched at once, with more neighbours in the whole index until one is found. The few
+        targets without one among their 256 nearest neighbours are searched with nearest, once for each limit.
+
+        Arguments
+        ---------
+        values : array-like
+            Value of each settlement in the index
+        targets : array-like
+            Positions of the settlements to find the nearest settlement for
+        limits : float or array-like
+            Limit for all or for each target
+
+        Returns
+        -------
+        numpy.ndarray
+            Position of the nearest settlement below the limit for each target, -1 if there is none
+        """
+        values = np.asarray(values, dtype=float)
+        targets = np.asarray(targets, dtype=int)
+        limits = np.broadcast_to(np.asarray(limits, dtype=float), len(targets))
+        nearest = np.full(len(targets), -1)
+
+        pending = np.arange(len(targets))
+        neighbours = 16
+        while len(pending) > 0 and neighbours <= 256:
+            found = self.tree.query(self.points[targets[pending]], k=min(neighbours, len(self)), workers=-1)[1]
+            found = found.reshape(len(pending), -1)
+            below = values[found] < limits[pending, np.newaxis]
+            has_below = below.any(axis=1)
+            nearest[pending[has_below]] = found[has_below, below[has_below].argmax(axis=1)]
+            pending = pending[~has_below]
+            neighbours *= 4
+
+        for limit in np.unique(limits[pending]):
+            sources = np.flatnonzero(values < limit)
+            if len(sources) > 0:
+                same = pending[limits[pending] == limit]
+                nearest[same] = self.nearest(sources, targets[same])
+        return nearest
+
+    def within(self, sources, distance):
+        """Settlements within a great circle distance of each source settlement
+
+        Arguments
+        ---------
+        sources : array-like
+            Positions of the settlements to search around
+        distance : float or numpy.ndarray
+            Distance (km) for all or for each source
+
+        Returns
+        -------
+        list of list
+            Positions of the settlements within the distance of each source, including the source itself
+        """
+        sources = np.asarray(sources, dtype=int)
+        return self.tree.query_ball_point(self.points[sources], np.broadcast_to(self.chord(distance), len(sources)),
+                                          workers=-1)
+
+
+def settlement_index(x_deg, y_deg):
+    """Spatial index of settlements (see SettlementIndex), built once for each set of coordinates"""
+    x_deg = np.ascontiguousarray(x_deg, dtype=float)
+    y_deg = np.ascontiguousarray(y_deg, dtype=float)
+    key = hashlib.sha1(x_deg.tobytes() + y_deg.tobytes()).hexdigest()
+    if key not in _settlement_indexes:
+        _settlement_indexes[key] = SettlementIndex(x_deg, y_deg)
+    return _settlement_indexes[key]
+
+
+_settlement_indexes = {}
+
+
+class GridExtensionState:
+    """State of the grid extension in a year (see SettlementProcessor.elec_extension), one array per settlement
+
+    The arrays are copies of the values they start from and are updated in place with boolean masks as settlements
+    are connected (see SettlementProcessor.update_grid_extension_info), so that only their final values are written
+    back to the settlements.
+
+    Attributes
+    ----------
+    electrified : numpy.ndarray
+        Boolean mask of the grid-connected settlements
+    elecorder : numpy.ndarray
+        Extension loop each settlement was connected in
+    cell_path_real : numpy.ndarray
+        MV line length (km) from the existing network up to each settlement
+    cell_path_adjusted : numpy.ndarray
+        Connection distance (km) of each settlement, including the grid penalty
+    new_lcoes : numpy.ndarray
+        Grid LCOE of each settlement
+    new_investment : numpy.ndarray
+        Grid investment cost of each settlement
+    grid_capacity_limit : numpy.ndarray
+        Remaining grid generation capacity (kW) that can be added, for all or for each settlement
+    grid_connect_limit : float
+        Remaining number of households that can be connected to the grid
+    """
+
+    def __init__(self, electrified, elecorder, cell_path_real, cell_path_adjusted, new_lcoes, new_investment,
+                 grid_capacity_limit=999999999, grid_connect_limit=999999999):
+        self.electrified = np.array(electrified, dtype=bool)
+        self.elecorder = np.array(elecorder)
+        self.cell_path_real = np.array(cell_path_real, dtype=float)
+        self.cell_path_adjusted = np.array(cell_path_adjusted, dtype=float)
+        self.new_lcoes = np.array(new_lcoes, dtype=float)
+        self.new_investment = np.array(new_investment, dtype=float)
+        self.grid_capacity_limit = np.array(grid_capacity_limit, dtype=float)
+        self.grid_connect_limit = float(grid_connect_limit)
+
+
+class GridNetwork:
+    """The grid-connected settlements at the end of a period and the nearest of them to every other settlement, to
+    warm-start the grid extension of the next period with (see SettlementProcessor.elec_extension)
+
+    Few settlements are connected to the grid or left out from one period to the next, so the nearest connected
+    settlements are found by searching only the ones connected since, instead of all of them.
+
+    Attributes
+    ----------
+    connected : numpy.ndarray
+        Boolean mask of the grid-connected settlements
+    nearest : numpy.ndarray
+        Position of the nearest connected settlement to each settlement not connected, -1 for the others
+    """
+
+    def __init__(self, settlements):
+        self.connected = np.zeros(settlements, dtype=bool)
+        self.nearest = np.full(settlements, -1)
+
+    def nearest_connected(self, index, connected, targets):
+        """The nearest of the connected settlements to each target settlement
+
+        Arguments
+        ---------
+        index : SettlementIndex
+        connected : numpy.ndarray
+            Boolean mask of the settlements connected now
+        targets : array-like
+            Positions of settlements not connected
+
+        Returns
+        -------
+        numpy.ndarray
+            Position of the nearest connected settlement to each target, -1 if there is none
+        """
+        connected = np.asarray(connected, dtype=bool)
+        targets = np.asarray(targets, dtype=int)
+        closest = self.nearest[targets]
+
+        # The targets that were connected, or whose nearest settlement is not connected any more, are searched again
+        stale = self.connected[targets] | np.where(closest >= 0, ~connected[closest], False)
+        kept = np.flatnonzero(~stale)
+        added = np.flatnonzero(connected & ~self.connected)
+        if len(added) > 0 and len(kept) > 0:
+            fresh = index.nearest(added, targets[kept])
+            current = closest[kept]
+            # Straight line distances through the sphere, as the ones compared by the index
+            nearer = (fresh >= 0) & ((current < 0) |
+                                     (((index.points[fresh] - index.points[targets[kept]]) ** 2).sum(axis=1) <
+                                      ((index.points[current] - index.points[targets[kept]]) ** 2).sum(axis=1)))
+            closest[kept] = np.where(nearer, fresh, current)
+        if stale.any():
+            closest[stale] = index.nearest(np.flatnonzero(connected), targets[stale]) if connected.any() else -1
+        return closest
+
+    def update(self, index, connected):
+        """Moves the network on to the settlements connected now"""
+        connected = np.array(connected, dtype=bool)
+        nearest = np.full(len(connected), -1)
+        nearest[~connected] = self.nearest_connected(index, connected, np.flatnonzero(~connected))
+        self.connected = connected
+        self.nearest = nearest
+
+
+def _extend_region(processor, defaults, arguments):
+    """Grid extension of the settlements of a region in a worker process, see
+    SettlementProcessor.partitioned_extension"""
+    Technology.set_default_values(**defaults)
+    return processor.extension_rounds(**arguments)
 
 
 class SettlementProcessor:
@@ -662,22 +1574,34 @@ class SettlementProcessor:
     """
 
     def __init__(self, path):
-        try:
-            self.df = pd.read_csv(path)
-        except FileNotFoundError:
-            print("Please make sure that the country name you provided and the .csv file, both have the same name")
-            raise
-
-        try:
-            self.df[SET_GHI]
-        except KeyError:
-            self.df = pd.read_csv(path, sep=';')
+        if isinstance(path, pd.DataFrame):
+            # The settlements are given already, e.g. a region of another SettlementProcessor
+            self.df = path
+        else:
             try:
-                self.df[SET_GHI]
-            except ValueError:
-                print('Colonne "GHI" introuvable, vérifiez les noms des colonnes dans le fichier csv calibré')
+                self.df = pd.read_csv(path)
+            except FileNotFoundError:
+                print("Please make sure that the country name you provided and the .csv file, both have the same name")
                 raise
 
+            try:
+                self.df[SET_GHI]
+            except KeyError:
+                self.df = pd.read_csv(path, sep=';')
+                try:
+                    self.df[SET_GHI]
+                except ValueError:
+                    print('Colonne "GHI" introuvable, vérifiez les noms des colonnes dans le fichier csv calibré')
+                    raise
+
+        # Network quantities and costs of the technologies per year and technology code, collected for the cost
+        # sensitivity analysis if this is set to a dict (see record_cost_quantities)
+        self.cost_quantities = None
+
+        # Grid-connected settlements of the last period and the nearest of them to the others, to warm-start the grid
+        # extension of the next period if this is set to a GridNetwork (see elec_extension)
+        self.grid_network = None
+
     @staticmethod
     def _diesel_fuel_cost_calculator(diesel_price: float,
                                      diesel_truck_consumption: float,  #
@@ -1321,7 +2245,7 @@ class SettlementProcessor:
         return elec_modelled, rural_elec_ratio, urban_elec_ratio
 
     def pre_electrification(self, grid_price, year, time_step, end_year, grid_calc, grid_capacity_limit=999999999,
-                            grid_connect_limit=999999999):
+                            grid_connect_limit=999999999, demand=None):
 
         """" ... """
 
@@ -1330,8 +2254,8 @@ class SettlementProcessor:
         prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].copy(deep=True)
 
         # Grid-electrified settlements
-        electrified_loce, electrified_investment = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year, grid_calc)
-        electrified_investment = electrified_investment[0]
+        electrified_loce, electrified_investment = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year, grid_calc,
+                                                                      demand=demand)
         grid_investment = np.where(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] == 1,
                                    electrified_investment, grid_investment)
 
@@ -1352,7 +2276,7 @@ class SettlementProcessor:
         grid_connect_limit -= sum(self.df.loc[prev_code == 1]['Densification_connections'])
         del self.df['Densification_connections']
 
-        return pd.Series(grid_investment), grid_capacity_limit, grid_connect_limit
+        return grid_investment, grid_capacity_limit, grid_connect_limit
 
     def current_mv_line_dist(self):
         # logging.info('Determine current MV line length')
@@ -1370,278 +2294,832 @@ class SettlementProcessor:
     def elec_extension(self, grid_calc, max_dist, year, start_year, end_year, time_step, new_investment,
                        grid_capacity_limit=999999999,
                        grid_connect_limit=999999999, auto_intensification=0, prioritization=0,
-                       threshold=999999999):
+                       threshold=999999999, demand=None):
         """
         Iterate through all electrified settlements and find which settlements can be economically connected to the grid
         Repeat with newly electrified settlements until no more are added
+
+        If grid_network is set (see GridNetwork), the first extension loop starts from the nearest electrified
+        settlements of the previous period, and the network is moved on to the settlements connected in this one
         """
 
+        state, hv_connected, first_rounds = \
+            self.extension_rounds(grid_calc, max_dist, year, start_year, end_year, time_step, new_investment,
+                                  grid_capacity_limit, grid_connect_limit, auto_intensification, prioritization,
+                                  threshold, demand)
+        return self.extension_results(state, hv_connected, first_rounds, year, time_step, end_year, grid_calc, demand)
+
+    def extension_rounds(self, grid_calc, max_dist, year, start_year, end_year, time_step, new_investment,
+                         grid_capacity_limit=999999999, grid_connect_limit=999999999, auto_intensification=0,
+                         prioritization=0, threshold=999999999, demand=None):
+        """Extends the grid from the MV and HV lines and then in loops from the electrified settlements, see
+        elec_extension
+
+        Returns
+        -------
+        state : GridExtensionState
+        hv_connected : numpy.ndarray
+            Boolean mask of the settlements connected from the HV lines
+        first_rounds : numpy.ndarray
+            Boolean mask of the settlements electrified before the extension loops
+        """
         prio = int(prioritization)
 
-        prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].copy(deep=True)
+        prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].to_numpy()
         if year - time_step == start_year:
-            elecorder = self.df[SET_ELEC_ORDER].copy(deep=True)
+            elecorder = self.df[SET_ELEC_ORDER]
         else:
-            elecorder = self.df[SET_ELEC_ORDER + "{}".format(year - time_step)].copy(deep=True)
-        grid_penalty_ratio = self.df[SET_GRID_PENALTY].copy(deep=True)
-        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].copy(deep=True)
-        new_lcoes = self.df[SET_LCOE_GRID + "{}".format(year)].copy(deep=True)
-        cell_path_real = self.df[SET_MV_CONNECT_DIST].copy(deep=True)
-        cell_path_adjusted = list(np.zeros(len(prev_code)).tolist())
-        mv_planned = self.df[SET_MV_DIST_PLANNED].copy(deep=True)
-        hv_planned = self.df[SET_HV_DIST_PLANNED].copy(deep=True)
-        mv_planned = np.minimum(mv_planned, hv_planned)
+            elecorder = self.df[SET_ELEC_ORDER + "{}".format(year - time_step)]
+        grid_penalty_ratio = self.df[SET_GRID_PENALTY].to_numpy()
+        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].to_numpy()
+        mv_planned = np.minimum(self.df[SET_MV_DIST_PLANNED], self.df[SET_HV_DIST_PLANNED]).to_numpy()
+
+        # The part of the grid LCOE that does not depend on the connection distance is the same in every round below
+        network = self.grid_network_context(year, time_step, grid_calc, demand)
 
         # Start by identifying which settlements are grid-connected already
-        electrified = np.where(prev_code == 1, 1, 0)
+        state = GridExtensionState(prev_code == 1, elecorder, self.df[SET_MV_CONNECT_DIST], np.zeros(len(prev_code)),
+                                   self.df[SET_LCOE_GRID + "{}".format(year)], new_investment, grid_capacity_limit,
+                                   grid_connect_limit)
 
         # The grid may be forced to expand around existing MV lines if this option has been selected, regardless
         # off-grid alternatives are less costly. The following section implements that
         if (prio == 2) or (prio == 4):
-            mv_dist_adjusted = np.nan_to_num(grid_penalty_ratio * mv_planned)
-            intensification_dist = mv_planned * 1
-            intensification_dist_adjusted = mv_dist_adjusted * 1
-
-            for i in range(int(auto_intensification + 1)):
-                if i > 1:
-                    closer_nodes = np.where(mv_planned < i, 1, 0)
-                    closer_nodes = np.array(closer_nodes)
-                    further_nodes = np.where((i + 1 > mv_planned) & (mv_planned > i) & (prev_code != 1))
-                    further_nodes = further_nodes[0].tolist()
-                    nearest_dist, nearest_elec_order, nearest_prev_dist, nearest_dist = \
-                        self.closest_electrified_settlement(closer_nodes, further_nodes, cell_path_real,
-                                                            grid_penalty_ratio, elecorder)
-
-                    nearest_dist_adjusted = nearest_dist * grid_penalty_ratio
-                    intensification_dist_adjusted = np.where(
-                        (nearest_dist_adjusted < intensification_dist_adjusted) & (nearest_dist_adjusted != 0),
-                        nearest_dist_adjusted, intensification_dist_adjusted)
-                    intensification_dist = np.where(
-                        (nearest_dist_adjusted < intensification_dist_adjusted) & (nearest_dist_adjusted != 0),
-                        nearest_dist, intensification_dist)
-                else:
-                    nearest_prev_dist = 0
-
-            intensification_lcoe, intensification_investment = \
-                self.get_grid_lcoe(dist_adjusted=intensification_dist_adjusted, elecorder=0, additional_transformer=0,
-                                   year=year,
-                                   time_step=time_step, end_year=end_year, grid_calc=grid_calc)
-            intensification_lcoe = new_lcoes.copy(deep=True)
-            # RUN_PARAM Generating cost of existing mini-grid
-            intensification_lcoe.loc[(mv_planned < auto_intensification) & (prev_code != 1)] = 0.01
-            intensification_lcoe = pd.DataFrame(intensification_lcoe)
-            intensification_lcoe.columns = [0]
-
-            grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
-            new_lcoes, new_investment \
-                = self.update_grid_extension_info(grid_lcoe=intensification_lcoe, dist=intensification_dist,
-                                                  dist_adjusted=intensification_dist_adjusted,
-                                                  prev_dist=nearest_prev_dist,
-                                                  elecorder=elecorder,
-                                                  new_elec_order=1, max_dist=max_dist, new_lcoes=new_lcoes,
-                                                  grid_capacity_limit=grid_capacity_limit,
-                                                  grid_connect_limit=grid_connect_limit, cell_path_real=cell_path_real,
-                                                  cell_path_adjusted=cell_path_adjusted, electrified=electrified,
-                                                  year=year, grid_calc=grid_calc,
-                                                  grid_investment=intensification_investment,
-                                                  new_investment=new_investment,
-                                                  threshold=threshold)
+            self.grid_intensification(grid_calc, max_dist, year, end_year, time_step, auto_intensification, threshold,
+                                      network, prev_code, grid_penalty_ratio, mv_planned, state)
 
         # Find the un-electrified settlements where grid can be less costly than off-grid
-        filter_lcoe, filter_investment = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year, grid_calc)
-        filter_lcoe = filter_lcoe[0]
-        filter_lcoe.loc[electrified == 1] = 99
-        unelectrified = np.where(filter_lcoe < min_code_lcoes)
-        unelectrified = unelectrified[0].tolist()
-
-        # logging.info('Initially {} electrified'.format(sum(electrified)))
+        filter_lcoe, filter_investment = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year, grid_calc, network)
+        filter_lcoe[state.electrified] = 99
+        unelectrified = filter_lcoe < min_code_lcoes
 
         # First round of extension from MV network
-        mv_dist = pd.Series(self.df[SET_MV_DIST_PLANNED])
+        mv_dist = self.df[SET_MV_DIST_PLANNED].to_numpy()
         mv_dist_adjusted = np.nan_to_num(grid_penalty_ratio * mv_dist)
 
+        # Only the settlements within their break-even distance can be less costly with the grid and are calculated
+        break_even = self.grid_break_even_distance(year, time_step, end_year, grid_calc, network, demand)
+        candidates = ~state.electrified & grid_calc.within_break_even_distance(break_even, mv_dist_adjusted)
         grid_lcoe, grid_investment = self.get_grid_lcoe(dist_adjusted=mv_dist_adjusted, elecorder=0,
                                                         additional_transformer=0, year=year, time_step=time_step,
-                                                        end_year=end_year, grid_calc=grid_calc)
-
-        grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
-        new_lcoes, new_investment \
-            = self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=mv_dist, dist_adjusted=mv_dist_adjusted,
-                                              prev_dist=0, elecorder=elecorder, new_elec_order=1, max_dist=max_dist,
-                                              new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
-                                              grid_connect_limit=grid_connect_limit, cell_path_real=cell_path_real,
-                                              cell_path_adjusted=cell_path_adjusted, electrified=electrified, year=year,
-                                              grid_calc=grid_calc, grid_investment=grid_investment,
-                                              new_investment=new_investment, threshold=999999999)
+                                                        end_year=end_year, grid_calc=grid_calc, network=network,
+                                                        subset=candidates)
+
+        self.update_grid_extension_info(state, grid_lcoe=grid_lcoe, dist=mv_dist, dist_adjusted=mv_dist_adjusted,
+                                        prev_dist=0, new_elec_order=1, max_dist=max_dist, year=year,
+                                        grid_calc=grid_calc, grid_investment=grid_investment)
 
         #  Second round of extension from HV lines
+        before_hv = state.electrified.copy()
         hv_dist = np.nan_to_num(self.df[SET_HV_DIST_PLANNED])
         hv_dist_adjusted = np.nan_to_num(hv_dist * grid_penalty_ratio)
 
         grid_lcoe, grid_investment = self.get_grid_lcoe(dist_adjusted=hv_dist_adjusted, elecorder=0,
                                                         additional_transformer=1, year=year, time_step=time_step,
-                                                        end_year=end_year, grid_calc=grid_calc)
-
-        grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
-        new_lcoes, new_investment \
-            = self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=hv_dist, dist_adjusted=hv_dist_adjusted,
-                                              prev_dist=0, elecorder=elecorder, new_elec_order=1, max_dist=999999,
-                                              new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
-                                              grid_connect_limit=grid_connect_limit, cell_path_real=cell_path_real,
-                                              cell_path_adjusted=cell_path_adjusted, electrified=electrified,
-                                              year=year, grid_calc=grid_calc, grid_investment=grid_investment,
-                                              new_investment=new_investment, threshold=999999999)
+                                                        end_year=end_year, grid_calc=grid_calc, network=network)
 
+        self.update_grid_extension_info(state, grid_lcoe=grid_lcoe, dist=hv_dist, dist_adjusted=hv_dist_adjusted,
+                                        prev_dist=0, new_elec_order=1, max_dist=999999, year=year,
+                                        grid_calc=grid_calc, grid_investment=grid_investment)
+        hv_connected = state.electrified & ~before_hv
+        first_rounds = state.electrified.copy()
+
+        self.extension_loops(state, unelectrified, break_even, grid_calc, max_dist, year, time_step, end_year, network,
+                             grid_penalty_ratio)
+        return state, hv_connected, first_rounds
+
+    def extension_loops(self, state, unelectrified, break_even, grid_calc, max_dist, year, time_step, end_year,
+                        network, grid_penalty_ratio, first_frontier=None):
+        """Extends the grid in loops from the electrified settlements, see elec_extension
+
+        Arguments
+        ---------
+        state : GridExtensionState
+            Updated in place
+        unelectrified : numpy.ndarray
+            Boolean mask of the settlements where grid can be less costly than off-grid
+        break_even : tuple
+            Break-even connection distances, see grid_break_even_distance
+        network : NetworkContext
+        grid_penalty_ratio : numpy.ndarray
+        first_frontier : numpy.ndarray
+            Boolean mask of the settlements that can be connected in the first loop, if not all
+        """
         # Third to last round of extension loops from electrified settlements. First considering all
         # electrified settlements up until this point, then from the newly electrified settlements in each round
-        prev_electrified = np.zeros(len(prev_code))
-        loops = 1
-        test = [1, 2]
-        while sum(electrified) > sum(prev_electrified) and len(test) > 0:
-            new_electrified = electrified - prev_electrified
-            prev_electrified = electrified
-            # logging.info('Electrification loop {} with {} electrified'.format(loops, int(sum(new_electrified))))
-            loops += 1
-
-            extension_nodes = np.where(new_electrified == 1)
-            extension_nodes = extension_nodes[0].tolist()
-            test = np.setdiff1d(unelectrified, extension_nodes).tolist()
-
-            if sum(new_electrified) > 1 and len(test) > 1:
+        prev_electrified = np.zeros(len(state.electrified), dtype=bool)
+        remaining = 2
+        while state.electrified.sum() > prev_electrified.sum() and remaining > 0:
+            first_loop = not prev_electrified.any()
+            new_electrified = state.electrified & ~prev_electrified
+            prev_electrified = state.electrified.copy()
+
+            remaining = np.count_nonzero(unelectrified & ~new_electrified)
+            # The settlements that can still be connected, fewer as the grid grows
+            frontier = unelectrified & ~state.electrified
+            if first_loop and first_frontier is not None:
+                frontier &= first_frontier
+
+            if new_electrified.sum() > 1 and remaining > 1:
+                # The first loop extends from all electrified settlements, the closest of which are mostly known from
+                # the previous period if the grid network is kept
+                closest_node = None
+                if first_loop and self.grid_network is not None:
+                    closest_node = np.full(len(state.electrified), -1)
+                    closest_node[frontier] = self.grid_network.nearest_connected(self.settlement_index(),
+                                                                                 state.electrified,
+                                                                                 np.flatnonzero(frontier))
+
                 # Calculating the distance and adjusted distance from each unelectrified settelement to the closest
                 # electrified settlement, as well as the electrification order an total MV distance to that electrified
-                # settlement
+                # settlement. Settlements beyond max_dist from all of them are not searched further
                 nearest_dist_adjusted, nearest_elec_order, prev_dist, nearest_dist = \
-                    self.closest_electrified_settlement(new_electrified, unelectrified, cell_path_real,
-                                                        grid_penalty_ratio, elecorder)
-
+                    self.closest_electrified_settlement(new_electrified, np.flatnonzero(frontier),
+                                                        state.cell_path_real, grid_penalty_ratio, state.elecorder,
+                                                        max_dist, closest_node)
+
+                # Only the settlements that can still be connected within max_dist and their break-even distance are
+                # calculated, the others are left out (NaN)
+                candidates = frontier & \
+                    grid_calc.within_break_even_distance(break_even, nearest_dist_adjusted, nearest_elec_order) & \
+                    ~(prev_dist + nearest_dist_adjusted > max_dist)
                 grid_lcoe, grid_investment = self.get_grid_lcoe(dist_adjusted=nearest_dist_adjusted,
                                                                 elecorder=nearest_elec_order,
                                                                 additional_transformer=0, year=year,
                                                                 time_step=time_step,
-                                                                end_year=end_year, grid_calc=grid_calc)
-
-                grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
-                new_lcoes, new_investment = \
-                    self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=nearest_dist,
-                                                    dist_adjusted=nearest_dist_adjusted,
-                                                    prev_dist=prev_dist, elecorder=elecorder,
-                                                    new_elec_order=nearest_elec_order, max_dist=max_dist,
-                                                    new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
-                                                    grid_connect_limit=grid_connect_limit,
-                                                    cell_path_real=cell_path_real,
-                                                    cell_path_adjusted=cell_path_adjusted, electrified=electrified,
-                                                    year=year, grid_calc=grid_calc, grid_investment=grid_investment,
-                                                    new_investment=new_investment, threshold=999999999)
-
-        return new_lcoes, cell_path_adjusted, elecorder, cell_path_real, pd.DataFrame(new_investment)
-
-    def get_grid_lcoe(self, dist_adjusted, elecorder, additional_transformer, year, time_step, end_year, grid_calc):
-        grid_lcoe, grid_investment = \
-            grid_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                               start_year=year - time_step,
-                               end_year=end_year,
-                               people=self.df[SET_POP + "{}".format(year)],
-                               new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                               total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                               prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                               num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                               grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
-                               base_to_peak=self.df[SET_BASE_TO_PEAK],
-                               additional_mv_line_length=dist_adjusted,
-                               elec_loop=elecorder,
-                               additional_transformer=additional_transformer)
-        return grid_lcoe, grid_investment
+                                                                end_year=end_year, grid_calc=grid_calc, network=network,
+                                                                subset=candidates)
+
+                self.update_grid_extension_info(state, grid_lcoe=grid_lcoe, dist=nearest_dist,
+                                                dist_adjusted=nearest_dist_adjusted, prev_dist=prev_dist,
+                                                new_elec_order=nearest_elec_order, max_dist=max_dist, year=year,
+                                                grid_calc=grid_calc, grid_investment=grid_investment)
+
+    def extension_results(self, state, hv_connected, first_rounds, year, time_step, end_year, grid_calc, demand=None):
+        """Records the grid network of the settlements connected and returns the values of elec_extension"""
+        # The network of the grid connected settlements, with the distance, transformer and extension round they were
+        # connected with
+        connection_loop = np.where(first_rounds, 0, state.elecorder)
+        for transformer, connected in ((0, state.electrified & ~hv_connected), (1, hv_connected)):
+            self.record_cost_quantities(year, time_step, end_year, 1, grid_calc, demand, subset=connected,
+                                        additional_mv_line_length=state.cell_path_adjusted,
+                                        additional_transformer=transformer, elec_loop=connection_loop)
+
+        if self.grid_network is not None:
+            self.grid_network.update(self.settlement_index(), state.electrified)
+
+        return state.new_lcoes, state.cell_path_adjusted, state.elecorder, state.cell_path_real, state.new_investment
+
+    def partitioned_extension(self, grid_calc, max_dist, year, start_year, end_year, time_step, new_investment,
+                              grid_capacity_limit=999999999, grid_connect_limit=999999999, auto_intensification=0,
+                              prioritization=0, threshold=999999999, demand=None, regions=None, tile_size=500,
+                              workers=1):
+        """Extends the grid region by region, optionally in parallel, for national datasets too large to extend at
+        once with elec_extension
+
+        The settlements are split in regions (see extension_regions) that are extended on their own, together with
+        the settlements within max_dist around them (halo). The halo settlements are not connected in the region, but
+        the grid-connected ones among them are extended from. The grid capacity and connection limits are shared out
+        between the regions by the demand of their settlements not connected yet. A final pass then extends the grid
+        across the borders of the regions from all the electrified settlements, within the rest of the limits.
+
+        The result is an approximation of elec_extension: the settlements near the borders may be connected in later
+        extension loops, and the limits are used up region by region instead of in settlement order.
+
+        Arguments
+        ---------
+        regions, tile_size
+            See extension_regions
+        workers : int
+            Number of processes. With 1 the regions are extended in the calling process
+
+        Other arguments and returned values are the same as for elec_extension
+        """
+        prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].to_numpy()
+        if year - time_step == start_year:
+            elecorder = self.df[SET_ELEC_ORDER]
+        else:
+            elecorder = self.df[SET_ELEC_ORDER + "{}".format(year - time_step)]
+        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].to_numpy()
+        if demand is None:
+            demand = self.settlement_demand(year, time_step)
+        regions = self.extension_regions(max_dist, regions, tile_size)
+
+        # The limits are shared out by the peak load and new connections of the settlements not connected yet in each
+        # region. The capacity limit may differ by settlement (see pre_electrification), each region gets its share
+        # of the limit of its own settlements
+        consumption = self.df[SET_ENERGY_PER_CELL + "{}".format(year)]  # kWh/year
+        average_load = consumption / (1 - grid_calc.distribution_losses) / HOURS_PER_YEAR  # kW
+        peak_load = (average_load / self.df[SET_BASE_TO_PEAK]).to_numpy()  # kW
+        households = (self.df[SET_NEW_CONNECTIONS + "{}".format(year)] / self.df[SET_NUM_PEOPLE_PER_HH]).to_numpy()
+        demands = np.array([[np.nansum(value[core][prev_code[core] != 1]) for value in (peak_load, households)]
+                            for core, halo in regions])
+        totals = demands.sum(axis=0)
+        shares = np.divide(demands, totals, out=np.full(demands.shape, 1 / len(regions)), where=totals > 0)
+        grid_capacity_limit = np.asarray(grid_capacity_limit, dtype=float)
+
+        processors = []
+        arguments = []
+        for (core, halo), (capacity_share, connect_share) in zip(regions, shares):
+            rows = np.concatenate([core, halo])
+            df = self.df.iloc[rows].reset_index(drop=True)
+            # The halo settlements are never less costly to connect than off-grid
+            df.loc[len(core):, SET_MIN_OFFGRID_LCOE + "{}".format(year)] = 0
+            processors.append(SettlementProcessor(df))
+            arguments.append(dict(grid_calc=grid_calc, max_dist=max_dist, year=year, start_year=start_year,
+                                  end_year=end_year, time_step=time_step,
+                                  new_investment=take_rows(new_investment, rows),
+                                  grid_capacity_limit=capacity_share * take_rows(grid_capacity_limit, rows),
+                                  grid_connect_limit=connect_share * grid_connect_limit,
+                                  auto_intensification=auto_intensification, prioritization=prioritization,
+                                  threshold=threshold, demand=take_rows(demand, rows)))
+
+        if workers > 1 and len(regions) > 1:
+            # The default values of the technologies are set again in the worker processes, if they are not forked
+            defaults = {name: getattr(Technology, name)
+                        for name in inspect.signature(Technology.set_default_values).parameters}
+            with ProcessPoolExecutor(max_workers=min(workers, len(regions))) as executor:
+                results = list(executor.map(_extend_region, processors, [defaults] * len(regions), arguments))
+        else:
+            results = [processor.extension_rounds(**region) for processor, region in zip(processors, arguments)]
+
+        # The regions are merged, each one with the limits it has not used
+        state = GridExtensionState(prev_code == 1, elecorder, self.df[SET_MV_CONNECT_DIST], np.zeros(len(prev_code)),
+                                   self.df[SET_LCOE_GRID + "{}".format(year)], new_investment, grid_capacity_limit,
+                                   grid_connect_limit)
+        hv_connected = np.zeros(len(prev_code), dtype=bool)
+        first_rounds = np.zeros(len(prev_code), dtype=bool)
+        border = np.zeros(len(prev_code), dtype=bool)
+        for (core, halo), (region, region_hv, region_first), (capacity_share, connect_share) in \
+                zip(regions, results, shares):
+            for name in ('electrified', 'elecorder', 'cell_path_real', 'cell_path_adjusted', 'new_lcoes',
+                         'new_investment'):
+                getattr(state, name)[core] = getattr(region, name)[:len(core)]
+            hv_connected[core] = region_hv[:len(core)]
+            first_rounds[core] = region_first[:len(core)]
+            border[halo] = True
+            # The capacity used is the same for all the settlements of the region
+            rows = np.concatenate([core, halo])
+            state.grid_capacity_limit -= np.max(capacity_share * take_rows(grid_capacity_limit, rows) -
+                                                region.grid_capacity_limit)
+            state.grid_connect_limit -= connect_share * grid_connect_limit - region.grid_connect_limit
+
+        # Final pass across the borders, first from all the electrified settlements to the ones in the halo of
+        # another region, then from the settlements connected in each loop as in elec_extension
+        network = self.grid_network_context(year, time_step, grid_calc, demand)
+        break_even = self.grid_break_even_distance(year, time_step, end_year, grid_calc, network, demand)
+        filter_lcoe, filter_investment = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year, grid_calc, network)
+        filter_lcoe[state.electrified] = 99
+        self.extension_loops(state, filter_lcoe < min_code_lcoes, break_even, grid_calc, max_dist, year, time_step,
+                             end_year, network, self.df[SET_GRID_PENALTY].to_numpy(), first_frontier=border)
+
+        return self.extension_results(state, hv_connected, first_rounds, year, time_step, end_year, grid_calc, demand)
+
+    def extension_regions(self, max_dist, regions=None, tile_size=500):
+        """Splits the settlements in regions for the partitioned grid extension, each one with the settlements around
+        it (halo)
+
+        Arguments
+        ---------
+        max_dist : float
+            Width (km) of the halo around the settlements of each region
+        regions : str
+            Column of the region of each settlement (e.g. 'Admin_1'). By default the settlements are split in square
+            tiles
+        tile_size : float
+            Side (km) of the tiles
+
+        Returns
+        -------
+        list of tuple
+            Positions of the settlements in each region and in its halo. The halo includes all the settlements within
+            max_dist of the region, and may include a few more
+        """
+        x = self.df[SET_X_DEG].to_numpy(dtype=float)
+        y = self.df[SET_Y_DEG].to_numpy(dtype=float)
+        km = SettlementIndex.radius * pi / 180  # Length of a degree of latitude
+
+        if regions is None:
+            # The length of a degree of longitude is the one at the mean latitude
+            tiles = np.column_stack([np.floor(x * km * np.cos(np.deg2rad(y.mean())) / tile_size),
+                                     np.floor(y * km / tile_size)])
+            labels = np.unique(tiles, axis=0, return_inverse=True)[1].ravel()
+        else:
+            labels = np.unique(self.df[regions].astype(str), return_inverse=True)[1].ravel()
+        order = np.argsort(labels, kind='stable')
+        cores = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+
+        # The halo of each region is the bounding box of its settlements widened by max_dist, with the length of a
+        # degree of longitude at its latitude furthest from the equator
+        margin = max_dist / km
+        result = []
+        for label, core in enumerate(cores):
+            south = y[core].min() - margin
+            north = y[core].max() + margin
+            lon_margin = margin / np.cos(np.deg2rad(min(max(abs(south), abs(north)), 89)))
+            west = x[core].min() - lon_margin
+            east = x[core].max() + lon_margin
+            halo = np.flatnonzero((labels != label) & (y >= south) & (y <= north) & (x >= west) & (x <= east))
+            result.append((core, halo))
+        return result
+
+    def grid_growth(self, grid_calc, max_dist, year, start_year, end_year, time_step, new_investment,
+                    grid_capacity_limit=999999999, grid_connect_limit=999999999, auto_intensification=0,
+                    prioritization=0, threshold=999999999, demand=None):
+        """Grows the grid from the least costly connection first, as an alternative to the rounds of elec_extension
+
+        Every settlement that can be connected has candidate connections in a priority queue, keyed by their grid
+        LCOE: from the MV lines, from the HV lines or from an electrified settlement nearby. The least costly
+        candidate is connected, and only the settlements around it get new candidates, so the grid grows in
+        O(N log N) instead of one pass over all settlements per round. The grid capacity and connection limits are
+        consumed in order of LCOE instead of settlement order.
+
+        The grid LCOE of a connection from an electrified settlement is linear in the distance (see
+        Technology.break_even_distance), and the costs of the connected settlements are calculated once at the end.
+
+        Arguments and returned values are the same as for elec_extension
+        """
+        prio = int(prioritization)
+
+        prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].to_numpy()
+        if year - time_step == start_year:
+            elecorder = self.df[SET_ELEC_ORDER]
+        else:
+            elecorder = self.df[SET_ELEC_ORDER + "{}".format(year - time_step)]
+        penalty = self.df[SET_GRID_PENALTY].to_numpy(dtype=float)
+        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].to_numpy()
+        mv_planned = np.minimum(self.df[SET_MV_DIST_PLANNED], self.df[SET_HV_DIST_PLANNED]).to_numpy()
+
+        network = self.grid_network_context(year, time_step, grid_calc, demand)
+        state = GridExtensionState(prev_code == 1, elecorder, self.df[SET_MV_CONNECT_DIST], np.zeros(len(prev_code)),
+                                   self.df[SET_LCOE_GRID + "{}".format(year)], new_investment, grid_capacity_limit,
+                                   grid_connect_limit)
+
+        if (prio == 2) or (prio == 4):
+            self.grid_intensification(grid_calc, max_dist, year, end_year, time_step, auto_intensification, threshold,
+                                      network, prev_code, penalty, mv_planned, state)
+
+        # The settlements that cannot be connected any more because of the limits are marked with -1
+        electrified = state.electrified.astype(int)
+        elecorder = state.elecorder
+        cell_path_real = state.cell_path_real
+        cell_path_adjusted = state.cell_path_adjusted
+        new_lcoes = state.new_lcoes
+        new_investment = state.new_investment
+
+        # Only the un-electrified settlements where grid can be less costly than off-grid are connected from other
+        # settlements
+        filter_lcoe, filter_investment = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year, grid_calc, network)
+        candidate = (electrified == 0) & (filter_lcoe < min_code_lcoes)
+
+        # The grid LCOE at any distance on each side of max_mv_line_length, and the largest distance where it can be
+        # less costly than off-grid
+        distance_costs = self.grid_distance_costs(year, time_step, end_year, grid_calc, network, demand)
+        break_even = tuple(grid_calc.break_even_distance(costs, distance, min_code_lcoes)
+                           for distance, costs in distance_costs)
+        (short_distance, short_costs), (long_distance, long_costs) = distance_costs
+        short_per_km, long_per_km = (grid_calc.lcoe_per_km(costs, distance) for distance, costs in distance_costs)
+        reach = np.nan_to_num(np.fmax(*break_even)[candidate], nan=-np.inf, posinf=np.inf, neginf=-np.inf)
+        reach = np.max(reach, initial=0)
+
+        def viable(lcoe):
+            return (lcoe < min_code_lcoes) & ~(lcoe > new_lcoes)
+
+        # Connections from the MV and HV lines, as in the first two rounds of elec_extension
+        mv_dist = self.df[SET_MV_DIST_PLANNED].to_numpy(dtype=float)
+        mv_dist_adjusted = np.nan_to_num(penalty * mv_dist)
+        hv_dist = np.nan_to_num(self.df[SET_HV_DIST_PLANNED].to_numpy(dtype=float))
+        hv_dist_adjusted = np.nan_to_num(hv_dist * penalty)
+
+        subset = (electrified == 0) & grid_calc.within_break_even_distance(break_even, mv_dist_adjusted)
+        mv_lcoe, mv_investment = self.get_grid_lcoe(mv_dist_adjusted, 0, 0, year, time_step, end_year, grid_calc,
+                                                    network, subset=subset)
+        hv_lcoe, hv_investment = self.get_grid_lcoe(hv_dist_adjusted, 0, 1, year, time_step, end_year, grid_calc,
+                                                    network, subset=electrified == 0)
+
+        # Candidate connections are (LCOE, source, settlement, distance), the source being the electrified settlement
+        # or -1 for the MV and -2 for the HV lines
+        best = np.where(viable(mv_lcoe) & ~(mv_dist_adjusted > max_dist), mv_lcoe, np.inf)
+        best = np.where(viable(hv_lcoe) & (hv_lcoe < best), hv_lcoe, best)
+        queue = [(mv_lcoe[node], -1, node, mv_dist[node]) for node in np.flatnonzero(best == mv_lcoe)]
+        queue += [(hv_lcoe[node], -2, node, hv_dist[node]) for node in np.flatnonzero(best == hv_lcoe)]
+        heapq.heapify(queue)
+
+        x = self.df[SET_X_DEG].to_numpy(dtype=float)
+        y = self.df[SET_Y_DEG].to_numpy(dtype=float)
+        index = self.settlement_index()
+
+        def push_neighbours(sources):
+            """Adds the connections from the electrified settlements to the candidates around them"""
+            loop = elecorder[sources] + 1
+            radius = np.fmin(max_dist - cell_path_real[sources],
+                             reach / (1 + grid_calc.existing_grid_cost_ratio * loop))
+            radius = np.maximum(radius, 0) * (1 + 1e-9)
+            for source, source_loop, nodes in zip(sources, loop, index.within(sources, radius)):
+                nodes = np.asarray(nodes, dtype=int)
+                nodes = nodes[candidate[nodes] & (electrified[nodes] == 0)]
+                if len(nodes) == 0:
+                    continue
+                dist = self.haversine_vector(x[source], y[source], x[nodes], y[nodes])
+                dist_adjusted = np.nan_to_num(dist * penalty[nodes])
+                distance = dist_adjusted * (1 + grid_calc.existing_grid_cost_ratio * source_loop)
+                lcoe = np.where(dist_adjusted < grid_calc.max_mv_line_length,
+                                short_costs.lcoe[nodes] + short_per_km[nodes] * (distance - short_distance),
+                                long_costs.lcoe[nodes] + long_per_km[nodes] * (distance - long_distance))
+                lcoe = np.where(dist_adjusted == 0, filter_lcoe[nodes], lcoe)
+                # The LCOE calculated at the end may differ from the linear one by rounding
+                better = (lcoe < min_code_lcoes[nodes] * (1 - 1e-9)) & ~(lcoe > new_lcoes[nodes]) & \
+                    ~(cell_path_real[source] + dist_adjusted > max_dist) & (lcoe < best[nodes])
+                for node, node_lcoe, node_dist in zip(nodes[better], lcoe[better], dist[better]):
+                    best[node] = node_lcoe
+                    heapq.heappush(queue, (node_lcoe, source, node, node_dist))
+
+        consumption = self.df[SET_ENERGY_PER_CELL + "{}".format(year)]  # kWh/year
+        average_load = consumption / (1 - grid_calc.distribution_losses) / HOURS_PER_YEAR  # kW
+        peak_load = (average_load / self.df[SET_BASE_TO_PEAK]).to_numpy()  # kW
+        new_grid_connections = (self.df[SET_NEW_CONNECTIONS + "{}".format(year)] /
+                                self.df[SET_NUM_PEOPLE_PER_HH]).to_numpy()
+
+        # The capacity limit may differ by settlement (see pre_electrification)
+        grid_capacity_limit = np.broadcast_to(state.grid_capacity_limit, len(electrified))
+        grid_connect_limit = state.grid_connect_limit
+        used_capacity = 0
+        used_connections = 0
+
+        connected = np.zeros(len(electrified), dtype=bool)
+        transformer = np.zeros(len(electrified), dtype=int)
+        connection_loop = np.zeros(len(electrified), dtype=int)
+        push_neighbours(np.flatnonzero(electrified == 1))
+        while queue:
+            lcoe, source, node, dist = heapq.heappop(queue)
+            if electrified[node] == 1:
+                continue
+            # The limits only decrease, a settlement that does not fit any more is left out for good
+            if used_capacity + peak_load[node] > grid_capacity_limit[node] or \
+                    used_connections + new_grid_connections[node] > grid_connect_limit:
+                electrified[node] = -1
+                continue
+            used_capacity += peak_load[node]
+            used_connections += new_grid_connections[node]
+
+            electrified[node] = 1
+            connected[node] = True
+            if source < 0:
+                transformer[node] = 1 if source == -2 else 0
+                cell_path_real[node] = dist
+                cell_path_adjusted[node] = hv_dist_adjusted[node] if source == -2 else mv_dist_adjusted[node]
+                elecorder[node] = 1
+            else:
+                cell_path_real[node] = cell_path_real[source] + dist
+                cell_path_adjusted[node] = np.nan_to_num(dist * penalty[node])
+                elecorder[node] = elecorder[source] + 1
+                connection_loop[node] = elecorder[node]
+            push_neighbours(np.array([node]))
+        electrified = np.maximum(electrified, 0)
+
+        # The costs of the connected settlements for their connection distance, transformer and extension loop
+        for additional_transformer in (0, 1):
+            rows = connected & (transformer == additional_transformer)
+            if rows.any():
+                costs = self.get_grid_costs(cell_path_adjusted, connection_loop, additional_transformer, year,
+                                            time_step, end_year, grid_calc, network, subset=rows, demand=demand)
+                new_lcoes[rows] = costs.lcoe[rows]
+                new_investment[rows] = costs.investment[rows]
+
+            self.record_cost_quantities(year, time_step, end_year, 1, grid_calc, demand,
+                                        subset=(electrified == 1) & (transformer == additional_transformer),
+                                        additional_mv_line_length=cell_path_adjusted,
+                                        additional_transformer=additional_transformer, elec_loop=connection_loop)
+
+        return new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment
+
+    def grid_intensification(self, grid_calc, max_dist, year, end_year, time_step, auto_intensification, threshold,
+                             network, prev_code, grid_penalty_ratio, mv_planned, state):
+        """Forces the grid to expand around existing MV lines, regardless off-grid alternatives are less costly
+        (prioritization 2 and 4)
+
+        Arguments
+        ---------
+        state : GridExtensionState
+            Updated in place with the settlements connected
+        """
+        mv_dist_adjusted = np.nan_to_num(grid_penalty_ratio * mv_planned)
+        intensification_dist = mv_planned * 1
+        intensification_dist_adjusted = mv_dist_adjusted * 1
+        nearest_prev_dist = 0
+
+        # From the third on, the settlements in each ring between i and i + 1 km from the MV lines are connected from
+        # the closest settlement less than i km from them, if it is closer than the MV lines. The distance without the
+        # grid penalty is left as the one to the MV lines. All rings are searched at once
+        rings = int(auto_intensification + 1)
+        ring = np.floor(mv_planned)
+        further_nodes = np.flatnonzero((ring >= 2) & (ring < rings) & (mv_planned > ring) & (prev_code != 1))
+        closest_node = self.settlement_index().nearest_below(mv_planned, further_nodes, ring[further_nodes])
+        further_nodes = further_nodes[closest_node >= 0]
+        closest_node = closest_node[closest_node >= 0]
+
+        x = self.df[SET_X_DEG].to_numpy()
+        y = self.df[SET_Y_DEG].to_numpy()
+        nearest_dist = np.zeros(len(mv_planned))
+        nearest_dist[further_nodes] = self.haversine_vector(x[closest_node], y[closest_node], x[further_nodes],
+                                                            y[further_nodes])
+        nearest_dist_adjusted = nearest_dist * grid_penalty_ratio
+        intensification_dist_adjusted = np.where(
+            (nearest_dist_adjusted < intensification_dist_adjusted) & (nearest_dist_adjusted != 0),
+            nearest_dist_adjusted, intensification_dist_adjusted)
+
+        # The MV line length up to the settlements they are connected from is kept for the outermost ring only
+        if rings > 2:
+            outermost = ring[further_nodes] == rings - 1
+            nearest_prev_dist = np.zeros(len(mv_planned))
+            nearest_prev_dist[further_nodes[outermost]] = state.cell_path_real[closest_node[outermost]]
+
+        intensification_lcoe, intensification_investment = \
+            self.get_grid_lcoe(dist_adjusted=intensification_dist_adjusted, elecorder=0, additional_transformer=0,
+                               year=year,
+                               time_step=time_step, end_year=end_year, grid_calc=grid_calc, network=network)
+        intensification_lcoe = state.new_lcoes.copy()
+        # RUN_PARAM Generating cost of existing mini-grid
+        intensification_lcoe[(mv_planned < auto_intensification) & (prev_code != 1)] = 0.01
+
+        self.update_grid_extension_info(state, grid_lcoe=intensification_lcoe, dist=intensification_dist,
+                                        dist_adjusted=intensification_dist_adjusted, prev_dist=nearest_prev_dist,
+                                        new_elec_order=1, max_dist=max_dist, year=year, grid_calc=grid_calc,
+                                        grid_investment=intensification_investment, threshold=threshold)
+
+    def get_grid_lcoe(self, dist_adjusted, elecorder, additional_transformer, year, time_step, end_year, grid_calc,
+                      network=None, subset=None, demand=None):
+        """Grid LCOE and investment cost (arrays) of all settlements, see Technology.get_costs"""
+        costs = self.get_grid_costs(dist_adjusted, elecorder, additional_transformer, year, time_step, end_year,
+                                    grid_calc, network, subset, demand)
+        return costs.lcoe, costs.investment
+
+    def get_grid_costs(self, dist_adjusted, elecorder, additional_transformer, year, time_step, end_year, grid_calc,
+                       network=None, subset=None, demand=None):
+        """Grid costs (CostResult) of all settlements, see Technology.get_costs"""
+        return grid_calc.get_costs(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                   start_year=year - time_step,
+                                   end_year=end_year,
+                                   people=self.df[SET_POP + "{}".format(year)],
+                                   new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                   total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                   prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                   num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                   grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
+                                   base_to_peak=self.df[SET_BASE_TO_PEAK],
+                                   additional_mv_line_length=dist_adjusted,
+                                   elec_loop=elecorder,
+                                   additional_transformer=additional_transformer,
+                                   network=network,
+                                   subset=subset,
+                                   demand=demand)
+
+    def grid_distance_costs(self, year, time_step, end_year, grid_calc, network=None, demand=None):
+        """Grid costs of all settlements at one connection distance on each side of max_mv_line_length
+
+        The grid costs at any other distance on the same side follow from them (see Technology.break_even_distance).
+
+        Returns
+        -------
+        list of tuple
+            The connection distance and the costs (CostResult) at it, for connections shorter than
+            max_mv_line_length and for the longer ones
+        """
+        return [(distance, self.get_grid_costs(distance, 0, 0, year, time_step, end_year, grid_calc, network,
+                                               demand=demand))
+                for distance in (grid_calc.max_mv_line_length / 2, grid_calc.max_mv_line_length)]
+
+    def grid_break_even_distance(self, year, time_step, end_year, grid_calc, network=None, demand=None):
+        """Break-even connection distances of the grid against the minimum off-grid LCOE of all settlements in a year
+
+        The extension rounds only calculate the grid LCOE of the settlements within their break-even distance (see
+        Technology.break_even_distance).
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Break-even distances for connections shorter than max_mv_line_length, and for the longer ones
+        """
+        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].to_numpy()
+        return tuple(grid_calc.break_even_distance(costs, distance, min_code_lcoes) for distance, costs in
+                     self.grid_distance_costs(year, time_step, end_year, grid_calc, network, demand))
+
+    def grid_network_context(self, year, time_step, grid_calc, demand=None):
+        """Distance independent part of the grid T&D network of all settlements in a year
+
+        It is calculated once and passed to get_grid_lcoe, so that each round of the grid extension only calculates
+        the part that depends on the connection distance. Population and demand are bounded as in get_lcoe.
+        """
+        if demand is None:
+            demand = self.settlement_demand(year, time_step)
+        return grid_calc.network_context(people=demand.people,
+                                         new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                         prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                         total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                         energy_per_cell=demand.energy_per_cell,
+                                         num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                         grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
+                                         base_to_peak=self.df[SET_BASE_TO_PEAK],
+                                         demand=demand)
+
+    def settlement_demand(self, year, time_step):
+        """Demand and connections of all settlements in a year, shared by the LCOE calculation of all technologies
+        (see Technology.demand_context)
+        """
+        return Technology.demand_context(people=self.df[SET_POP + "{}".format(year)],
+                                         new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                         prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                         total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                         energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                         num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                         grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP])
+
+    def record_cost_quantities(self, year, time_step, end_year, code, technology, demand=None, subset=None,
+                               base_to_peak=None, additional_mv_line_length=0, additional_transformer=0, elec_loop=0,
+                               **options):
+        """Stores the network quantities and costs of a technology in a year, if cost_quantities is collected
+
+        Arguments
+        ---------
+        code : int
+            Code of the technology, as in SET_ELEC_FINAL_CODE
+        technology : Technology
+        demand : DemandContext
+        subset : numpy.ndarray
+            Boolean mask of the settlements to store, the others are left as they are
+        base_to_peak : float
+            Base to peak load ratio of the technology, if not the one of the settlements
+        options
+            Other keyword arguments of Technology.get_costs (e.g. capacity_factor, hybrid_lcoe)
+        """
+        if self.cost_quantities is None:
+            return
+        if demand is None:
+            demand = self.settlement_demand(year, time_step)
+        if base_to_peak is None:
+            base_to_peak = self.df[SET_BASE_TO_PEAK]
+        if subset is None:
+            subset = np.ones(len(self.df), dtype=bool)
+        rows = np.flatnonzero(subset)
+
+        settlements = dict(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                           people=self.df[SET_POP + "{}".format(year)],
+                           new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                           total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                           prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                           num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                           grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
+                           base_to_peak=base_to_peak)
+        network = technology.network_context(demand=demand, **settlements)
+        costs = technology.get_costs(start_year=year - time_step, end_year=end_year,
+                                     additional_mv_line_length=additional_mv_line_length,
+                                     additional_transformer=additional_transformer, elec_loop=elec_loop,
+                                     network=network, subset=rows, demand=demand, **settlements, **options)
+        quantities = technology.network_quantities(take_rows(network, rows),
+                                                   take_rows(additional_mv_line_length, rows),
+                                                   additional_transformer, take_rows(elec_loop, rows))
+
+        records = self.cost_quantities.setdefault(year, {})
+        if code not in records:
+            records[code] = CostQuantities(technology.network_unit_costs(),
+                                           np.full((len(self.df), len(NETWORK_COSTS)), np.nan),
+                                           *(np.full(len(self.df), np.nan) for _ in range(5)))
+        record = records[code]
+        record.quantities[rows] = quantities
+        for stored, value in zip(record[2:], (costs.lcoe, costs.investment, costs.generation, costs.lcoe_slope,
+                                              costs.investment_slope)):
+            stored[rows] = value[rows]
+
+    def save_cost_quantities(self, path):
+        """Saves the collected network quantities and costs (see record_cost_quantities) to a .npz file"""
+        arrays = {}
+        for year, records in self.cost_quantities.items():
+            for code, record in records.items():
+                for field, value in zip(record._fields, record):
+                    arrays['{}_{}_{}'.format(year, code, field)] = value
+        np.savez_compressed(path, **arrays)
 
     def closest_electrified_settlement(self, new_electrified, unelectrified, cell_path_real, grid_penalty_ratio,
-                                       elecorder):
+                                       elecorder, max_dist=None, closest_node=None):
+        """Finds the closest of the newly electrified settlements to each un-electrified settlement
+
+        If max_dist is given, the un-electrified settlements that are further from all of them than the extension
+        can reach (prev_dist + nearest_dist_adjusted > max_dist) are not searched further, and get an infinite
+        distance. If closest_node is given, the position of the closest one to each settlement found already (e.g.
+        see GridNetwork), it is used instead of searching.
+        """
 
-        x = self.df[SET_X_DEG].copy(deep=True)
-        y = self.df[SET_Y_DEG].copy(deep=True)
+        x = self.df[SET_X_DEG].to_numpy()
+        y = self.df[SET_Y_DEG].to_numpy()
 
         # Identifies the electrified settlements from which to extend the network
-        extension_nodes = np.where(new_electrified == 1)
-        extension_nodes = extension_nodes[0].tolist()
-        # Creates an array of x, y coordinates of the electrified settlements
-        elec_nodes2 = np.transpose(np.array([x.loc[extension_nodes], y.loc[extension_nodes]]))
+        extension_nodes = np.flatnonzero(np.asarray(new_electrified) == 1)
 
-        closest_elec_node = np.zeros(len(x), dtype=int)
         nearest_dist = np.zeros(len(x))
         nearest_elec_order = np.zeros(len(x), dtype=int)
         prev_dist = np.zeros(len(x))
 
-        # Create an array of x-, y-coordinates of the (filtered) unelectrified settlements
-        unelectrified = np.setdiff1d(unelectrified, extension_nodes).tolist()
-        x_unelec = x.loc[unelectrified]
-        y_unelec = y.loc[unelectrified]
-        unelec_nodes = pd.DataFrame(np.transpose(np.array([x_unelec, y_unelec])))
-
-        # Calculate for each unelectrified settlement which is the closest electrified settlement
-        closest_node = self.do_kdtree(elec_nodes2, unelec_nodes)
+        # Calculate for each (filtered) unelectrified settlement which is the closest electrified settlement
+        unelectrified = np.setdiff1d(unelectrified, extension_nodes).astype(int)
+        if closest_node is not None:
+            closest_node = np.asarray(closest_node)[unelectrified]
+        else:
+            reach = np.inf
+            if max_dist is not None:
+                # The extension reaches max_dist from a settlement connected directly (prev_dist 0) with the lowest
+                # grid penalty
+                penalty = np.asarray(grid_penalty_ratio, dtype=float)[unelectrified]
+                path = np.asarray(cell_path_real, dtype=float)[extension_nodes]
+                if len(unelectrified) > 0 and (penalty > 0).all() and (path >= 0).all():
+                    reach = max_dist / penalty.min()
+            closest_node = self.settlement_index().nearest(extension_nodes, unelectrified, reach)
+        beyond_reach = unelectrified[closest_node < 0]
+        unelectrified = unelectrified[closest_node >= 0]
+        closest_node = closest_node[closest_node >= 0]
+        nearest_dist[beyond_reach] = np.inf
 
         # For each unelectrified settlement, find the electrifiecation order, distance to closest electrified
         # settlement, distance including grid penalty, and total mv length up until the electrrfied settlement
-        j = 0
-        for unelec in unelectrified:
-            closest_elec_node[unelec] = closest_node[j]
-            j += 1
-        extension_nodes = np.array(extension_nodes)
-        x_closest_elec = x.loc[extension_nodes[closest_elec_node[unelectrified]]]
-        x_closest_elec.index = x_unelec.index
-        y_closest_elec = y.loc[extension_nodes[closest_elec_node[unelectrified]]]
-        y_closest_elec.index = y_unelec.index
-        dist = self.haversine_vector(x_closest_elec, y_closest_elec, x_unelec, y_unelec)
-        nearest_dist[unelectrified] = dist[unelectrified]
+        nearest_dist[unelectrified] = self.haversine_vector(x[closest_node], y[closest_node], x[unelectrified],
+                                                            y[unelectrified])
         nearest_dist_adjusted = np.nan_to_num(nearest_dist * grid_penalty_ratio)
-        nearest_elec_order[unelectrified] = elecorder[extension_nodes[
-            closest_elec_node[unelectrified]]] + 1
-        prev_dist[unelectrified] = cell_path_real[
-            extension_nodes[closest_elec_node[unelectrified]]]
+        nearest_elec_order[unelectrified] = np.asarray(elecorder)[closest_node] + 1
+        prev_dist[unelectrified] = np.asarray(cell_path_real)[closest_node]
 
         return nearest_dist_adjusted, nearest_elec_order, prev_dist, nearest_dist
 
-    def update_grid_extension_info(self, grid_lcoe, dist, dist_adjusted, prev_dist, elecorder, new_elec_order,
-                                   max_dist, new_lcoes, grid_capacity_limit, grid_connect_limit, cell_path_real,
-                                   cell_path_adjusted, electrified, year, grid_calc, grid_investment, new_investment,
-                                   prio=2, threshold=999999999):
+    def settlement_index(self):
+        """Spatial index of the settlements, shared by all scenarios run on the same settlements (see
+        SettlementIndex)"""
+        return settlement_index(self.df[SET_X_DEG], self.df[SET_Y_DEG])
 
-        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].copy(deep=True)
+    def update_grid_extension_info(self, state, grid_lcoe, dist, dist_adjusted, prev_dist, new_elec_order, max_dist,
+                                   year, grid_calc, grid_investment, prio=2, threshold=999999999):
+        """Connects the settlements where the grid is less costly than off-grid, within max_dist and the grid limits
 
-        grid_lcoe = grid_lcoe[0]
-        grid_investment = grid_investment[0]
-        grid_lcoe.loc[electrified == 1] = 99
-        grid_lcoe.loc[prev_dist + dist_adjusted > max_dist] = 99
-        grid_lcoe.loc[grid_lcoe > new_lcoes] = 99
+        Arguments
+        ---------
+        state : GridExtensionState
+            Updated in place with the settlements connected and the limits they use up
+        grid_lcoe : numpy.ndarray
+            Grid LCOE of each settlement, NaN for the settlements left out of the calculation
+        dist, dist_adjusted : numpy.ndarray
+            Connection distance (km) of each settlement, without and with the grid penalty
+        prev_dist : float or numpy.ndarray
+            MV line length (km) up to the settlement each one is connected from
+        new_elec_order : int or numpy.ndarray
+            Extension loop of the connection of each settlement
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask of the settlements connected
+        """
+        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].to_numpy()
+        households = (self.df[SET_NEW_CONNECTIONS + "{}".format(year)] / self.df[SET_NUM_PEOPLE_PER_HH]).to_numpy()
+
+        grid_lcoe = np.array(grid_lcoe, dtype=float)
+        grid_investment = np.asarray(grid_investment)
+        grid_lcoe[state.electrified] = 99
+        grid_lcoe[np.asarray(prev_dist + dist_adjusted) > max_dist] = 99
+        grid_lcoe[grid_lcoe > state.new_lcoes] = 99
 
         if prio == 2:
-            households = self.df[SET_NEW_CONNECTIONS + "{}".format(year)] / self.df[SET_NUM_PEOPLE_PER_HH]
-            grid_lcoe.loc[grid_investment / households > threshold] = 99
+            grid_lcoe[grid_investment / households > threshold] = 99
 
         consumption = self.df[SET_ENERGY_PER_CELL + "{}".format(year)]  # kWh/year
         average_load = consumption / (1 - grid_calc.distribution_losses) / HOURS_PER_YEAR  # kW
-        peak_load = average_load / self.df[SET_BASE_TO_PEAK]  # kW
-        peak_load.loc[grid_lcoe >= min_code_lcoes] = 0
-        peak_load_cum_sum = np.cumsum(peak_load)
-        grid_lcoe.loc[peak_load_cum_sum > grid_capacity_limit] = 99
-        new_grid_connections = self.df[SET_NEW_CONNECTIONS + "{}".format(year)] / self.df[SET_NUM_PEOPLE_PER_HH]
-        new_grid_connections.loc[grid_lcoe >= min_code_lcoes] = 0
-        new_grid_connections_cum_sum = np.cumsum(new_grid_connections)
-        grid_lcoe.loc[new_grid_connections_cum_sum > grid_connect_limit] = 99
+        peak_load = (average_load / self.df[SET_BASE_TO_PEAK]).to_numpy()  # kW
+        # Settlements left out of the calculation (NaN) are not connected either
+        peak_load[~(grid_lcoe < min_code_lcoes)] = 0
+        grid_lcoe[self.cumulative_sum(peak_load) > state.grid_capacity_limit] = 99
+        new_grid_connections = households.copy()
+        new_grid_connections[~(grid_lcoe < min_code_lcoes)] = 0
+        grid_lcoe[self.cumulative_sum(new_grid_connections) > state.grid_connect_limit] = 99
+
+        connected = grid_lcoe < min_code_lcoes
 
         # Update limiting values
-        grid_capacity_limit -= peak_load.loc[grid_lcoe < min_code_lcoes].sum()
-        grid_connect_limit -= new_grid_connections.loc[grid_lcoe < min_code_lcoes].sum()
+        state.grid_capacity_limit -= np.nansum(peak_load[connected])
+        state.grid_connect_limit -= np.nansum(new_grid_connections[connected])
 
         # Update values for settlements that meet conditions
-        cell_path_real = np.where(grid_lcoe < min_code_lcoes, prev_dist + dist, cell_path_real)
-        cell_path_adjusted = np.where(grid_lcoe < min_code_lcoes, dist_adjusted, cell_path_adjusted)
-        elecorder = np.where(grid_lcoe < min_code_lcoes, new_elec_order, elecorder)
-        electrified = np.where(grid_lcoe < min_code_lcoes, 1, electrified)
-        new_lcoes = np.where(grid_lcoe < min_code_lcoes, grid_lcoe, new_lcoes)
-        new_investment = np.where(grid_lcoe < min_code_lcoes, grid_investment, new_investment)
+        settlements = len(grid_lcoe)
+        state.cell_path_real[connected] = np.broadcast_to(prev_dist + dist, settlements)[connected]
+        state.cell_path_adjusted[connected] = dist_adjusted[connected]
+        state.elecorder[connected] = np.broadcast_to(new_elec_order, settlements)[connected]
+        state.electrified[connected] = True
+        state.new_lcoes[connected] = grid_lcoe[connected]
+        state.new_investment[connected] = grid_investment[connected]
 
-        return grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, \
-               electrified, new_lcoes, new_investment
+        return connected
+
+    @staticmethod
+    def cumulative_sum(values):
+        """Cumulative sum skipping NaN values, which stay NaN, as pandas.Series.cumsum"""
+        cumulative = np.nancumsum(values)
+        cumulative[np.isnan(values)] = np.nan
+        return cumulative
 
     @staticmethod
     def haversine_vector(lon1, lat1, lon2, lat2):
@@ -1869,7 +3347,8 @@ class SettlementProcessor:
 
     def calculate_pv_hybrids_lcoe(self, year, start_year, end_year, time_step, mg_pv_hybrid_calc,
                                   pv_panel_investment, diesel_gen_investment, discount_rate, battery_cost,
-                                  inverter_cost, pv_life, diesel_life, inverter_life, min_pop):
+                                  inverter_cost, pv_life, diesel_life, inverter_life, min_pop, workers=1,
+                                  chunk_size=None, search_budget=None, representative_days=None, demand=None):
 
         ##TODO change path based on IDE run
         #path_7 = os.path.join('../onsset_Somaliland/Supplementary_files', 'Somaliland_PV.csv')
@@ -1884,165 +3363,92 @@ class SettlementProcessor:
         ghi_range = np.round(np.arange(ghi_min, ghi_max + 100, 100), -2)
         diesel_range = np.round(np.arange(diesel_min, diesel_max + 0.1, 0.1), 1)
 
-        pv_hybrid_lcoe_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                        columns=ghi_range, index=diesel_range)
-        pv_hybrid_lcoe_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                        columns=ghi_range, index=diesel_range)
-        pv_hybrid_lcoe_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                        columns=ghi_range, index=diesel_range)
-        pv_hybrid_lcoe_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                        columns=ghi_range, index=diesel_range)
-        pv_hybrid_lcoe_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                        columns=ghi_range, index=diesel_range)
-
-        pv_hybrid_investment_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                              columns=ghi_range, index=diesel_range)
-        pv_hybrid_investment_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                              columns=ghi_range, index=diesel_range)
-        pv_hybrid_investment_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                              columns=ghi_range, index=diesel_range)
-        pv_hybrid_investment_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                              columns=ghi_range, index=diesel_range)
-        pv_hybrid_investment_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                              columns=ghi_range, index=diesel_range)
-
-        pv_hybrid_capacity_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                            columns=ghi_range, index=diesel_range)
-        pv_hybrid_capacity_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                            columns=ghi_range, index=diesel_range)
-        pv_hybrid_capacity_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                            columns=ghi_range, index=diesel_range)
-        pv_hybrid_capacity_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                            columns=ghi_range, index=diesel_range)
-        pv_hybrid_capacity_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                            columns=ghi_range, index=diesel_range)
-
-        pv_hybrid_ren_share_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                             columns=ghi_range, index=diesel_range)
-        pv_hybrid_ren_share_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                             columns=ghi_range, index=diesel_range)
-        pv_hybrid_ren_share_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                             columns=ghi_range, index=diesel_range)
-        pv_hybrid_ren_share_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                             columns=ghi_range, index=diesel_range)
-        pv_hybrid_ren_share_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(ghi_range))),
-                                             columns=ghi_range, index=diesel_range)
-
-        for g in ghi_range:
-            pv_hybrid_lcoe_1[g][:], \
-            pv_hybrid_investment_1[g][:], \
-            pv_hybrid_capacity_1[g][:], \
-            pv_hybrid_ren_share_1[g][:] = pv_diesel_hybrid(1, g, ghi_curve_7, temp_7, 1, start_year, end_year,
-                                                           discount_rate, battery_cost, pv_panel_investment,
-                                                           diesel_gen_investment, inverter_cost,
-                                                           pv_life, diesel_life, inverter_life,
-                                                           diesel_range=diesel_range,
-                                                           )
-
-            pv_hybrid_lcoe_2[g][:], \
-            pv_hybrid_investment_2[g][:], \
-            pv_hybrid_capacity_2[g][:], \
-            pv_hybrid_ren_share_2[g][:] = pv_diesel_hybrid(1, g, ghi_curve_7, temp_7, 2, start_year, end_year,
-                                                           discount_rate, battery_cost, pv_panel_investment,
-                                                           diesel_gen_investment, inverter_cost,
-                                                           pv_life, diesel_life, inverter_life,
-                                                           diesel_range=diesel_range
-                                                           )
-
-            pv_hybrid_lcoe_3[g][:], \
-            pv_hybrid_investment_3[g][:], \
-            pv_hybrid_capacity_3[g][:], \
-            pv_hybrid_ren_share_3[g][:] = pv_diesel_hybrid(1, g, ghi_curve_7, temp_7, 3, start_year, end_year,
-                                                           discount_rate, battery_cost, pv_panel_investment,
-                                                           diesel_gen_investment, inverter_cost,
-                                                           pv_life, diesel_life, inverter_life,
-                                                           diesel_range=diesel_range
-                                                           )
-
-            pv_hybrid_lcoe_4[g][:], \
-            pv_hybrid_investment_4[g][:], \
-            pv_hybrid_capacity_4[g][:], \
-            pv_hybrid_ren_share_4[g][:] = pv_diesel_hybrid(1, g, ghi_curve_7, temp_7, 4, start_year, end_year,
-                                                           discount_rate, battery_cost, pv_panel_investment,
-                                                           diesel_gen_investment, inverter_cost,
-                                                           pv_life, diesel_life, inverter_life,
-                                                           diesel_range=diesel_range
-                                                           )
-
-            pv_hybrid_lcoe_5[g][:], \
-            pv_hybrid_investment_5[g][:], \
-            pv_hybrid_capacity_5[g][:], \
-            pv_hybrid_ren_share_5[g][:] = pv_diesel_hybrid(1, g, ghi_curve_7, temp_7, 5, start_year, end_year,
-                                                           discount_rate, battery_cost, pv_panel_investment,
-                                                           diesel_gen_investment, inverter_cost,
-                                                           pv_life, diesel_life, inverter_life,
-                                                           diesel_range=diesel_range
-                                                           )
-
-        def local_hybrid(ghi, diesel, tier):
-            ghi = round(ghi, -2)
-            diesel = round(diesel, 1)
-
-            if tier == 1:
-                hybrid_lcoe = pv_hybrid_lcoe_1[ghi][diesel]
-                hybrid_investment = pv_hybrid_investment_1[ghi][diesel]
-                hybrid_capacity = pv_hybrid_capacity_1[ghi][diesel]
-                hybrid_renewable = pv_hybrid_ren_share_1[ghi][diesel]
-            elif tier == 2:
-                hybrid_lcoe = pv_hybrid_lcoe_2[ghi][diesel]
-                hybrid_investment = pv_hybrid_investment_2[ghi][diesel]
-                hybrid_capacity = pv_hybrid_capacity_2[ghi][diesel]
-                hybrid_renewable = pv_hybrid_ren_share_2[ghi][diesel]
-            elif tier == 3:
-                hybrid_lcoe = pv_hybrid_lcoe_3[ghi][diesel]
-                hybrid_investment = pv_hybrid_investment_3[ghi][diesel]
-                hybrid_capacity = pv_hybrid_capacity_3[ghi][diesel]
-                hybrid_renewable = pv_hybrid_ren_share_3[ghi][diesel]
-            elif tier == 4:
-                hybrid_lcoe = pv_hybrid_lcoe_4[ghi][diesel]
-                hybrid_investment = pv_hybrid_investment_4[ghi][diesel]
-                hybrid_capacity = pv_hybrid_capacity_4[ghi][diesel]
-                hybrid_renewable = pv_hybrid_ren_share_4[ghi][diesel]
-            elif tier == 5:
-                hybrid_lcoe = pv_hybrid_lcoe_5[ghi][diesel]
-                hybrid_investment = pv_hybrid_investment_5[ghi][diesel]
-                hybrid_capacity = pv_hybrid_capacity_5[ghi][diesel]
-                hybrid_renewable = pv_hybrid_ren_share_5[ghi][diesel]
-
-            return hybrid_lcoe, hybrid_investment, hybrid_capacity, hybrid_renewable
-
-        hybrid_series = self.df.apply(
-            lambda row: local_hybrid(row[SET_GHI], row[SET_MG_DIESEL_FUEL + "{}".format(year)], row[SET_TIER]), axis=1,
-            result_type='expand')
+        tiers = [1, 2, 3, 4, 5]
+
+        # LCOE, investment, capacity and renewable share of the least-cost PV hybrid system for each
+        # tier, diesel price and GHI value
+        if search_budget is not None:
+            # Adaptive sizing search instead of the fixed sizing grid
+            pv_hybrid_table, simulations = pv_diesel_search_table(1, ghi_range, ghi_curve_7, temp_7, tiers,
+                                                                  diesel_range, start_year, end_year, discount_rate,
+                                                                  battery_cost, pv_panel_investment,
+                                                                  diesel_gen_investment, inverter_cost, pv_life,
+                                                                  diesel_life, budget=search_budget)
+            # The searches without a feasible configuration keep the LCOE of 99 and are left out of the average
+            feasible = pv_hybrid_table[0] < 99
+            print('{} PV hybrid configurations simulated in the sizing search, average least-cost LCOE of '
+                  '{:.3f} USD/kWh, {} of {} searches without a feasible configuration'
+                  .format(simulations, pv_hybrid_table[0][feasible].mean() if feasible.any() else np.nan,
+                          feasible.size - feasible.sum(), feasible.size))
+        else:
+            pv_hybrid_table = np.zeros((4, len(tiers), len(diesel_range), len(ghi_range)))
+
+            if representative_days is not None:
+                # Only some representative days are simulated. Their error is measured on the middle GHI value
+                deviation = pv_diesel_days_error(1, ghi_range[[len(ghi_range) // 2]], ghi_curve_7, temp_7, tiers,
+                                                 diesel_range, start_year, end_year, discount_rate, battery_cost,
+                                                 pv_panel_investment, diesel_gen_investment, inverter_cost, pv_life,
+                                                 diesel_life, representative_days)
+                for tier in tiers:
+                    print('PV hybrid LCOE of tier {} on {} representative days deviates up to {:.1%} from the whole '
+                          'year'.format(tier, representative_days, deviation[tier]))
+
+            # The dispatch of all tiers and GHI values is simulated in one pass, the costing below re-uses it. With
+            # more than one worker the pass is split over several processes
+            pv_diesel_dispatch_table(1, ghi_range, ghi_curve_7, temp_7, tiers, workers=workers, chunk_size=chunk_size,
+                                     days=representative_days)
+
+            for g_index, g in enumerate(ghi_range):
+                for tier in tiers:
+                    pv_hybrid_table[:, tier - 1, :, g_index] = pv_diesel_hybrid(1, g, ghi_curve_7, temp_7, tier,
+                                                                                start_year, end_year, discount_rate,
+                                                                                battery_cost, pv_panel_investment,
+                                                                                diesel_gen_investment, inverter_cost,
+                                                                                pv_life, diesel_life,
+                                                                                diesel_range=diesel_range,
+                                                                                days=representative_days)
+
+        hybrid_lcoe, hybrid_investment, hybrid_capacity, hybrid_ren_share = \
+            hybrid_table_lookup(pv_hybrid_table, ghi_range, diesel_range,
+                                python_round(self.df[SET_GHI], -2),
+                                python_round(self.df[SET_MG_DIESEL_FUEL + "{}".format(year)], 1),
+                                self.df[SET_TIER])
+        hybrid_series = [pd.Series(values, index=self.df.index) for values in
+                         (hybrid_lcoe, hybrid_investment, hybrid_capacity, hybrid_ren_share)]
 
         pv_hybrid_capacity = hybrid_series[2]
         self.df['PVHybridGenLCOE' + "{}".format(year)] = hybrid_series[0]
 
         # logging.info('Calculate minigrid PV hybrid LCOE')
-        self.df[SET_LCOE_MG_PV_HYBRID + "{}".format(year)], pv_hybrid_investment= \
-            mg_pv_hybrid_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                       start_year=year - time_step,
-                                       end_year=end_year,
-                                       people=self.df[SET_POP + "{}".format(year)],
-                                       new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                       total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                       prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                       num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                       grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
-                                       base_to_peak=self.df[SET_BASE_TO_PEAK],
-                                       hybrid_lcoe=hybrid_series[0],
-                                       hybrid_investment=hybrid_series[1])
+        pv_hybrid_costs = \
+            mg_pv_hybrid_calc.get_costs(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                        start_year=year - time_step,
+                                        end_year=end_year,
+                                        people=self.df[SET_POP + "{}".format(year)],
+                                        new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                        total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                        prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                        num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                        grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
+                                        base_to_peak=self.df[SET_BASE_TO_PEAK],
+                                        hybrid_lcoe=hybrid_series[0],
+                                        hybrid_investment=hybrid_series[1],
+                                        demand=demand)
+        self.df[SET_LCOE_MG_PV_HYBRID + "{}".format(year)] = pv_hybrid_costs.lcoe
+        self.record_cost_quantities(year, time_step, end_year, 8, mg_pv_hybrid_calc, demand,
+                                    hybrid_lcoe=hybrid_series[0], hybrid_investment=hybrid_series[1])
 
         self.df.loc[(self.df[SET_POP_CALIB] < min_pop) & (
                 self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] != 8), SET_LCOE_MG_PV_HYBRID + "{}".format(
             year)] = 99
 
-        return pv_hybrid_investment, pv_hybrid_capacity
+        return pv_hybrid_costs.investment, pv_hybrid_capacity
 
     def calculate_wind_hybrids_lcoe(self, year, start_year, end_year, time_step, mg_wind_hybrid_calc,
                                     battery_cost, wind_cost, diesel_cost, inverter_cost,
                                     wind_life, diesel_life, inverter_life, discount_rate,
-                                    min_pop):
+                                    min_pop, workers=1, chunk_size=None, search_budget=None,
+                                    representative_days=None, demand=None):
 
         wind_curve = read_wind_environmental_data()
 
@@ -2053,165 +3459,123 @@ class SettlementProcessor:
         wind_range = np.round(np.arange(wind_min, wind_max + 1))
         diesel_range = np.round(np.arange(diesel_min, diesel_max + 0.1, 0.1), 1)
 
-        wind_hybrid_lcoe_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                          columns=wind_range, index=diesel_range)
-        wind_hybrid_lcoe_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                          columns=wind_range, index=diesel_range)
-        wind_hybrid_lcoe_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                          columns=wind_range, index=diesel_range)
-        wind_hybrid_lcoe_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                          columns=wind_range, index=diesel_range)
-        wind_hybrid_lcoe_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                          columns=wind_range, index=diesel_range)
-
-        wind_hybrid_investment_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                                columns=wind_range, index=diesel_range)
-        wind_hybrid_investment_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                                columns=wind_range, index=diesel_range)
-        wind_hybrid_investment_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                                columns=wind_range, index=diesel_range)
-        wind_hybrid_investment_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                                columns=wind_range, index=diesel_range)
-        wind_hybrid_investment_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                                columns=wind_range, index=diesel_range)
-
-        wind_hybrid_capacity_1 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                              columns=wind_range, index=diesel_range)
-        wind_hybrid_capacity_2 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                              columns=wind_range, index=diesel_range)
-        wind_hybrid_capacity_3 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                              columns=wind_range, index=diesel_range)
-        wind_hybrid_capacity_4 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                              columns=wind_range, index=diesel_range)
-        wind_hybrid_capacity_5 = pd.DataFrame(np.outer(np.zeros(len(diesel_range)), np.zeros(len(wind_range))),
-                                              columns=wind_range, index=diesel_range)
-
         tiers = [1, 2, 3, 4, 5]
 
-        for w in wind_range:
-            wind_hybrid_lcoe_1[w][:], \
-            wind_hybrid_investment_1[w][:], \
-            wind_hybrid_capacity_1[w][:] = wind_diesel_hybrid(1, w, wind_curve, 1, start_year, end_year, battery_cost, wind_cost, diesel_cost, inverter_cost,
-                                    wind_life, diesel_life, inverter_life, discount_rate,
-                                                              diesel_range=diesel_range)
-
-            wind_hybrid_lcoe_2[w][:], \
-            wind_hybrid_investment_2[w][:], \
-            wind_hybrid_capacity_2[w][:] = wind_diesel_hybrid(1, w, wind_curve, 2, start_year, end_year, battery_cost, wind_cost, diesel_cost, inverter_cost,
-                                    wind_life, diesel_life, inverter_life, discount_rate,
-                                                              diesel_range=diesel_range)
-
-            wind_hybrid_lcoe_3[w][:], \
-            wind_hybrid_investment_3[w][:], \
-            wind_hybrid_capacity_3[w][:] = wind_diesel_hybrid(1, w, wind_curve, 3, start_year, end_year, battery_cost, wind_cost, diesel_cost, inverter_cost,
-                                    wind_life, diesel_life, inverter_life, discount_rate,
-                                                              diesel_range=diesel_range)
-
-            wind_hybrid_lcoe_4[w][:], \
-            wind_hybrid_investment_4[w][:], \
-            wind_hybrid_capacity_4[w][:] = wind_diesel_hybrid(1, w, wind_curve, 4, start_year, end_year, battery_cost, wind_cost, diesel_cost, inverter_cost,
-                                    wind_life, diesel_life, inverter_life, discount_rate,
-                                                              diesel_range=diesel_range)
-
-            wind_hybrid_lcoe_5[w][:], \
-            wind_hybrid_investment_5[w][:], \
-            wind_hybrid_capacity_5[w][:] = wind_diesel_hybrid(1, w, wind_curve, 5, start_year, end_year, battery_cost, wind_cost, diesel_cost, inverter_cost,
-                                    wind_life, diesel_life, inverter_life, discount_rate,
-                                                              diesel_range=diesel_range)
-
-
-        def local_hybrid(wind_vel, diesel, tier):
-            wind_vel = round(wind_vel)
-            diesel = round(diesel, 1)
-
-            if tier == 1:
-                hybrid_lcoe = wind_hybrid_lcoe_1[wind_vel][diesel]
-                hybrid_investment = wind_hybrid_investment_1[wind_vel][diesel]
-                hybrid_capacity = wind_hybrid_capacity_1[wind_vel][diesel]
-            elif tier == 2:
-                hybrid_lcoe = wind_hybrid_lcoe_2[wind_vel][diesel]
-                hybrid_investment = wind_hybrid_investment_2[wind_vel][diesel]
-                hybrid_capacity = wind_hybrid_capacity_2[wind_vel][diesel]
-            elif tier == 3:
-                hybrid_lcoe = wind_hybrid_lcoe_3[wind_vel][diesel]
-                hybrid_investment = wind_hybrid_investment_3[wind_vel][diesel]
-                hybrid_capacity = wind_hybrid_capacity_3[wind_vel][diesel]
-            elif tier == 4:
-                hybrid_lcoe = wind_hybrid_lcoe_4[wind_vel][diesel]
-                hybrid_investment = wind_hybrid_investment_4[wind_vel][diesel]
-                hybrid_capacity = wind_hybrid_capacity_4[wind_vel][diesel]
-            elif tier == 5:
-                hybrid_lcoe = wind_hybrid_lcoe_5[wind_vel][diesel]
-                hybrid_investment = wind_hybrid_investment_5[wind_vel][diesel]
-                hybrid_capacity = wind_hybrid_capacity_5[wind_vel][diesel]
-
-            return hybrid_lcoe, hybrid_investment, hybrid_capacity
-
-        hybrid_series = self.df.apply(
-            lambda row: local_hybrid(row[SET_WINDVEL], row[SET_MG_DIESEL_FUEL + "{}".format(year)], row[SET_TIER]),
-            axis=1, result_type='expand')
+        # LCOE, investment and capacity of the least-cost wind hybrid system for each tier, diesel price and wind speed
+        if search_budget is not None:
+            # Adaptive sizing search instead of the fixed sizing grid
+            wind_hybrid_table, simulations = wind_diesel_search_table(1, wind_range, wind_curve, tiers, diesel_range,
+                                                                      start_year, end_year, discount_rate,
+                                                                      battery_cost, wind_cost, diesel_cost,
+                                                                      inverter_cost, wind_life, diesel_life,
+                                                                      budget=search_budget)
+            # The searches without a feasible configuration keep the LCOE of 99 and are left out of the average
+            feasible = wind_hybrid_table[0] < 99
+            print('{} wind hybrid configurations simulated in the sizing search, average least-cost LCOE of '
+                  '{:.3f} USD/kWh, {} of {} searches without a feasible configuration'
+                  .format(simulations, wind_hybrid_table[0][feasible].mean() if feasible.any() else np.nan,
+                          feasible.size - feasible.sum(), feasible.size))
+        else:
+            wind_hybrid_table = np.zeros((3, len(tiers), len(diesel_range), len(wind_range)))
+
+            if representative_days is not None:
+                # Only some representative days are simulated. Their error is measured on the middle wind speed
+                deviation = wind_diesel_days_error(1, wind_range[[len(wind_range) // 2]], wind_curve, tiers,
+                                                   diesel_range, start_year, end_year, discount_rate, battery_cost,
+                                                   wind_cost, diesel_cost, inverter_cost, wind_life, diesel_life,
+                                                   inverter_life, representative_days)
+                for tier in tiers:
+                    print('Wind hybrid LCOE of tier {} on {} representative days deviates up to {:.1%} from the '
+                          'whole year'.format(tier, representative_days, deviation[tier]))
+
+            # The dispatch of all tiers and wind speeds is simulated in one pass, the costing below re-uses it. With
+            # more than one worker the pass is split over several processes
+            wind_diesel_dispatch_table(1, wind_range, wind_curve, tiers, workers=workers, chunk_size=chunk_size,
+                                       days=representative_days)
+
+            for w_index, w in enumerate(wind_range):
+                for tier in tiers:
+                    wind_hybrid_table[:, tier - 1, :, w_index] = wind_diesel_hybrid(1, w, wind_curve, tier,
+                                                                                    start_year, end_year,
+                                                                                    battery_cost, wind_cost,
+                                                                                    diesel_cost, inverter_cost,
+                                                                                    wind_life, diesel_life,
+                                                                                    inverter_life, discount_rate,
+                                                                                    diesel_range=diesel_range,
+                                                                                    days=representative_days)
+
+        hybrid_lcoe, hybrid_investment, hybrid_capacity = \
+            hybrid_table_lookup(wind_hybrid_table, wind_range, diesel_range,
+                                python_round(self.df[SET_WINDVEL]),
+                                python_round(self.df[SET_MG_DIESEL_FUEL + "{}".format(year)], 1),
+                                self.df[SET_TIER])
+        hybrid_series = [pd.Series(values, index=self.df.index) for values in
+                         (hybrid_lcoe, hybrid_investment, hybrid_capacity)]
 
         wind_hybrid_capacity = hybrid_series[2]
 
         # logging.info('Calculate minigrid Wind hybrid LCOE')
-        self.df[SET_LCOE_MG_WIND_HYBRID + "{}".format(year)], wind_hybrid_investment = \
-            mg_wind_hybrid_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                         start_year=year - time_step,
-                                         end_year=end_year,
-                                         people=self.df[SET_POP + "{}".format(year)],
-                                         new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                         total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                         prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                         num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                         grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
-                                         base_to_peak=self.df[SET_BASE_TO_PEAK],
-                                         hybrid_lcoe=hybrid_series[0],
-                                         hybrid_investment=hybrid_series[1])
+        wind_hybrid_costs = \
+            mg_wind_hybrid_calc.get_costs(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                          start_year=year - time_step,
+                                          end_year=end_year,
+                                          people=self.df[SET_POP + "{}".format(year)],
+                                          new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                          total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                          prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                          num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                          grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
+                                          base_to_peak=self.df[SET_BASE_TO_PEAK],
+                                          hybrid_lcoe=hybrid_series[0],
+                                          hybrid_investment=hybrid_series[1],
+                                          demand=demand)
+        self.df[SET_LCOE_MG_WIND_HYBRID + "{}".format(year)] = wind_hybrid_costs.lcoe
+        self.record_cost_quantities(year, time_step, end_year, 9, mg_wind_hybrid_calc, demand,
+                                    hybrid_lcoe=hybrid_series[0], hybrid_investment=hybrid_series[1])
 
         self.df.loc[(self.df[SET_POP_CALIB] < min_pop) & (
                 self.df[
                     SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] != 9), SET_LCOE_MG_WIND_HYBRID + "{}".format(
             year)] = 99
 
-        return wind_hybrid_investment, wind_hybrid_capacity
+        return wind_hybrid_costs.investment, wind_hybrid_capacity
 
-    def calculate_off_grid_lcoes(self, mg_hydro_calc, sa_pv_calc, year, end_year, time_step, min_mini_grid_pop):
+    def calculate_off_grid_lcoes(self, mg_hydro_calc, sa_pv_calc, year, end_year, time_step, min_mini_grid_pop,
+                                 demand=None):
         """
         Calculate the LCOEs for all off-grid technologies
 
         """
 
-        # logging.info('Calculate minigrid hydro LCOE')
-        self.df[SET_LCOE_MG_HYDRO + "{}".format(year)], mg_hydro_investment = \
-            mg_hydro_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                   start_year=year - time_step,
-                                   end_year=end_year,
-                                   people=self.df[SET_POP + "{}".format(year)],
-                                   new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                   total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                   prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                   num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                   grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
-                                   base_to_peak=self.df[SET_BASE_TO_PEAK],
-                                   additional_mv_line_length=self.df[SET_HYDRO_DIST])
+        # logging.info('Calculate minigrid hydro and standalone PV LCOE')
+        lcoes, (mg_hydro_costs, sa_pv_costs) = \
+            technologies_costs([mg_hydro_calc, sa_pv_calc],
+                               energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                               start_year=year - time_step,
+                               end_year=end_year,
+                               people=self.df[SET_POP + "{}".format(year)],
+                               new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                               total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                               prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                               num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                               grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
+                               base_to_peak=self.df[SET_BASE_TO_PEAK],
+                               options=[dict(additional_mv_line_length=self.df[SET_HYDRO_DIST]),
+                                        dict(base_to_peak=sa_pv_calc.base_to_peak_load_ratio,
+                                             capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)],
+                               demand=demand)
+        self.df[SET_LCOE_MG_HYDRO + "{}".format(year)] = lcoes[:, 0]
+        self.record_cost_quantities(year, time_step, end_year, 7, mg_hydro_calc, demand,
+                                    additional_mv_line_length=self.df[SET_HYDRO_DIST])
+        self.record_cost_quantities(year, time_step, end_year, 3, sa_pv_calc, demand,
+                                    base_to_peak=sa_pv_calc.base_to_peak_load_ratio,
+                                    capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)
 
         self.df.loc[(self.df[SET_POP_CALIB] < min_mini_grid_pop) & (
                 self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] != 7), SET_LCOE_MG_HYDRO + "{}".format(
             year)] = 99
 
-        # logging.info('Calculate standalone PV LCOE')
-        self.df[SET_LCOE_SA_PV + "{}".format(year)], sa_pv_investment = \
-            sa_pv_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                start_year=year - time_step,
-                                end_year=end_year,
-                                people=self.df[SET_POP + "{}".format(year)],
-                                new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                grid_cell_area=self.df[SET_GRID_CELL_AREA_TEMP],
-                                base_to_peak=sa_pv_calc.base_to_peak_load_ratio,
-                                capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)
+        self.df[SET_LCOE_SA_PV + "{}".format(year)] = lcoes[:, 1]
         self.df.loc[self.df[SET_GHI] <= 1000, SET_LCOE_SA_PV + "{}".format(year)] = 99
 
         self.df.loc[(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] > 3) & (
@@ -2220,7 +3584,7 @@ class SettlementProcessor:
 
         self.choose_minimum_off_grid_tech(year, mg_hydro_calc)
 
-        return sa_pv_investment, mg_hydro_investment
+        return sa_pv_costs.investment, mg_hydro_costs.investment
 
     def choose_minimum_off_grid_tech(self, year, mg_hydro_calc):
         """Choose minimum LCOE off-grid technology
@@ -2235,10 +3599,10 @@ class SettlementProcessor:
         """
 
         # logging.info('Determine minimum technology (off-grid)')
-        self.df[SET_MIN_OFFGRID + "{}".format(year)] = self.df[[SET_LCOE_SA_PV + "{}".format(year),
-                                                                SET_LCOE_MG_HYDRO + "{}".format(year),
-                                                                SET_LCOE_MG_PV_HYBRID + "{}".format(year),
-                                                                SET_LCOE_MG_WIND_HYBRID + "{}".format(year)]].T.idxmin()
+        off_grid_lcoes = [SET_LCOE_SA_PV + "{}".format(year), SET_LCOE_MG_HYDRO + "{}".format(year),
+                          SET_LCOE_MG_PV_HYBRID + "{}".format(year), SET_LCOE_MG_WIND_HYBRID + "{}".format(year)]
+        self.df[SET_MIN_OFFGRID + "{}".format(year)], _ = least_cost_technology(self.df[off_grid_lcoes].to_numpy(),
+                                                                                 off_grid_lcoes)
 
         # A df with all hydro-power sites, to ensure that they aren't assigned more capacity than is available
         hydro_used = 'HydropowerUsed'  # the amount of the hydro potential that has been assigned
@@ -2265,17 +3629,9 @@ class SettlementProcessor:
 
         self.df.loc[self.df[SET_HYDRO_DIST] > max_hydro_dist, SET_LCOE_MG_HYDRO + "{}".format(year)] = 99
 
-        self.df[SET_MIN_OFFGRID + "{}".format(year)] = self.df[[SET_LCOE_SA_PV + "{}".format(year),
-                                                                SET_LCOE_MG_HYDRO + "{}".format(year),
-                                                                SET_LCOE_MG_PV_HYBRID + "{}".format(year),
-                                                                SET_LCOE_MG_WIND_HYBRID + "{}".format(year)]].T.idxmin()
-
         # logging.info('Determine minimum tech LCOE')
-        self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)] = self.df[[SET_LCOE_SA_PV + "{}".format(year),
-                                                                     SET_LCOE_MG_HYDRO + "{}".format(year),
-                                                                     SET_LCOE_MG_PV_HYBRID + "{}".format(year),
-                                                                     SET_LCOE_MG_WIND_HYBRID + "{}".format(
-                                                                         year)]].T.min()
+        self.df[SET_MIN_OFFGRID + "{}".format(year)], self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)] = \
+            least_cost_technology(self.df[off_grid_lcoes].to_numpy(), off_grid_lcoes)
 
         codes = {SET_LCOE_MG_HYDRO + "{}".format(year): 7,
                  SET_LCOE_MG_WIND + "{}".format(year): 6,
@@ -2363,15 +3719,15 @@ class SettlementProcessor:
 
         self.df[SET_INVESTMENT_COST + "{}".format(year)] = 0
 
-        grid = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 1, 1, 0))
-        sa_diesel = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 2, 1, 0))
-        sa_pv = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 3, 1, 0))
-        mg_diesel = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 4, 1, 0))
-        mg_pv = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 5, 1, 0))
-        mg_wind = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 6, 1, 0))
-        mg_hydro = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 7, 1, 0))
-        mg_pv_hybrid = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 8, 1, 0))
-        mg_wind_hybrid = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 9, 1, 0))
+        grid = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 1, 1, 0)
+        sa_diesel = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 2, 1, 0)
+        sa_pv = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 3, 1, 0)
+        mg_diesel = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 4, 1, 0)
+        mg_pv = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 5, 1, 0)
+        mg_wind = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 6, 1, 0)
+        mg_hydro = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 7, 1, 0)
+        mg_pv_hybrid = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 8, 1, 0)
+        mg_wind_hybrid = np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 9, 1, 0)
 
         if expanding_MGs == 1:
             self.df[
@@ -2,10 +2,11 @@
 
 import logging
 import os
+from functools import partial
 
 import pandas as pd
 from onsset import (SET_ELEC_ORDER, SET_LCOE_GRID, SET_MIN_GRID_DIST, SET_GRID_PENALTY,
-                    SET_MV_CONNECT_DIST, SET_WINDCF, SettlementProcessor, Technology)
+                    SET_MV_CONNECT_DIST, SET_WINDCF, GridNetwork, SettlementProcessor, Technology)
 
 try:
     from onsset.specs import (SPE_COUNTRY, SPE_ELEC, SPE_ELEC_MODELLED,
@@ -245,6 +246,32 @@ def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder):
         eleclimits = {2025: five_year_target, 2030: 1}
         time_steps = {2025: 5, 2030: 5}
 
+        # RUN_PARAM: Number of processes used to simulate the dispatch of the PV and wind hybrid mini-grids
+        hybrid_workers = 1
+        # RUN_PARAM: Number of configurations evaluated by the adaptive sizing search of the hybrid mini-grids, for
+        # each tier, resource value and diesel price. Set to None to use the fixed sizing grid
+        hybrid_search_budget = None
+        # RUN_PARAM: Number of representative days simulated for the hybrid mini-grids instead of the whole year, for
+        # faster screening runs. The deviation from the whole year is printed for each tier. Set to None to simulate
+        # all 365 days
+        hybrid_representative_days = None
+        # RUN_PARAM: Store the network quantities and costs of the technologies in each settlement and year, to
+        # re-price them with other unit costs of the T&D network afterwards (see onsset.cost_distributions)
+        save_cost_quantities = False
+        # RUN_PARAM: Grow the grid from the least costly connection first instead of in rounds of extension from the
+        # settlements electrified in the previous round (see SettlementProcessor.grid_growth)
+        grid_growth_queue = False
+        # RUN_PARAM: Keep the grid network of each period to start the extension of the next one from, instead of
+        # searching from all electrified settlements again. Worth it with more than two periods (see GridNetwork)
+        warm_start_extension = False
+        # RUN_PARAM: Extend the grid region by region in this number of processes, for national datasets too large to
+        # extend at once (see SettlementProcessor.partitioned_extension). The regions are square tiles of
+        # extension_tile_size km, or given by the column extension_regions (e.g. 'Admin_1'). 0 extends the grid over
+        # the whole country at once
+        extension_workers = 0
+        extension_regions = None
+        extension_tile_size = 500
+
         elements = ["1.Population", "2.New_Connections", "3.Capacity", "4.Investment"]
         techs = ["Grid", "SA_PV_mobile", "SA_PV", "MG_Diesel", "MG_PV", "MG_Wind", "MG_Hydro", "MG_PV_Hybrid",
                  "MG_Wind_Hybrid"]
@@ -258,6 +285,10 @@ def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder):
             df_summary.loc[sumtechs[row]] = "Nan"
 
         onsseter.grid_cell_area()
+        if save_cost_quantities:
+            onsseter.cost_quantities = {}
+        if warm_start_extension:
+            onsseter.grid_network = GridNetwork(len(onsseter.df))
 
         for year in yearsofanalysis:
             eleclimit = eleclimits[year]
@@ -276,19 +307,28 @@ def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder):
 
             onsseter.diesel_cost_columns(sa_diesel_cost, mg_diesel_cost, year)
 
+            # The demand and connections of the settlements are shared by the LCOE calculation of all technologies
+            demand = onsseter.settlement_demand(year, time_step)
+
             mg_wind_hybrid_investment, mg_wind_hybrid_capacity = \
                 onsseter.calculate_wind_hybrids_lcoe(year, year - time_step, end_year, time_step,
                                                      mg_wind_hybrid_calc, battery_cost=139, wind_cost=2800,
                                                      diesel_cost=150, inverter_cost=142, wind_life=20,
                                                      diesel_life=10, inverter_life=10, discount_rate=discount_rate,
-                                                     min_pop=min_mini_grid_pop)
+                                                     min_pop=min_mini_grid_pop, workers=hybrid_workers,
+                                                     search_budget=hybrid_search_budget,
+                                                     representative_days=hybrid_representative_days,
+                                                     demand=demand)
 
             mg_pv_hybrid_investment, mg_pv_hybrid_capacity = \
                 onsseter.calculate_pv_hybrids_lcoe(year, year - time_step, end_year, time_step, mg_pv_hybrid_calc,
                                                    pv_panel_cost, diesel_gen_investment=150,
                                                    discount_rate=discount_rate,
                                                    battery_cost=139, inverter_cost=142, pv_life=25, diesel_life=10,
-                                                   inverter_life=10, min_pop=min_mini_grid_pop)
+                                                   inverter_life=10, min_pop=min_mini_grid_pop,
+                                                   workers=hybrid_workers, search_budget=hybrid_search_budget,
+                                                   representative_days=hybrid_representative_days,
+                                                   demand=demand)
 
             grid_calc = onsseter.grid_option(grid_option, auto_intensification, year, distribution_om=0.02,
                                              distribution_losses=0.05, grid_losses=0.10,
@@ -302,17 +342,25 @@ def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder):
 
             sa_pv_investment, mg_hydro_investment = onsseter.calculate_off_grid_lcoes(mg_hydro_calc, sa_pv_calc, year,
                                                                                       end_year, time_step,
-                                                                                      min_mini_grid_pop)
+                                                                                      min_mini_grid_pop, demand)
 
             grid_investment, grid_cap_gen_limit, grid_connect_limit = \
                 onsseter.pre_electrification(grid_price, year, time_step, end_year, grid_calc, grid_cap_gen_limit,
-                                             grid_connect_limit)
+                                             grid_connect_limit, demand)
+
+            if grid_growth_queue:
+                extension = onsseter.grid_growth
+            elif extension_workers > 0:
+                extension = partial(onsseter.partitioned_extension, regions=extension_regions,
+                                    tile_size=extension_tile_size, workers=extension_workers)
+            else:
+                extension = onsseter.elec_extension
 
             onsseter.df[SET_LCOE_GRID + "{}".format(year)], onsseter.df[SET_MIN_GRID_DIST + "{}".format(year)], \
             onsseter.df[SET_ELEC_ORDER + "{}".format(year)], onsseter.df[SET_MV_CONNECT_DIST], grid_investment = \
-                onsseter.elec_extension(grid_calc, max_grid_extension_dist, year, start_year, end_year,
-                                        time_step, grid_investment, grid_cap_gen_limit, grid_connect_limit,
-                                        auto_intensification, prioritization, threshold)
+                extension(grid_calc, max_grid_extension_dist, year, start_year, end_year, time_step, grid_investment,
+                          grid_cap_gen_limit, grid_connect_limit, auto_intensification, prioritization, threshold,
+                          demand)
 
             onsseter.results_columns(year, time_step, prioritization, auto_intensification)
 
@@ -336,5 +384,7 @@ def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder):
         # Export result as csv
         df_summary.to_csv(summary_csv, index=sumtechs)
         onsseter.df.to_csv(settlements_out_csv, index=False)
+        if save_cost_quantities:
+            onsseter.save_cost_quantities(settlements_out_csv.replace('.csv', '_cost_quantities.npz'))
 
         # logging.info('Finished')
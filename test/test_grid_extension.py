@@ -0,0 +1,252 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from pandas import DataFrame
+from pytest import fixture
+
+from onsset import SET_BASE_TO_PEAK, SET_ELEC_FINAL_CODE, SET_ELEC_ORDER, SET_ENERGY_PER_CELL, SET_GHI, \
+    SET_GRID_CELL_AREA_TEMP, SET_GRID_PENALTY, SET_HV_DIST_PLANNED, SET_LCOE_GRID, SET_MIN_OFFGRID_LCOE, \
+    SET_MV_CONNECT_DIST, SET_MV_DIST_PLANNED, SET_NEW_CONNECTIONS, SET_NUM_PEOPLE_PER_HH, SET_POP, \
+    SET_TOTAL_ENERGY_PER_CELL, SET_X_DEG, SET_Y_DEG, GridExtensionState, GridNetwork, SettlementProcessor, \
+    Technology, settlement_index
+
+
+class TestSettlementIndex:
+
+    @fixture
+    def setup_coordinates(self):
+        rng = np.random.default_rng(5)
+        return rng.uniform(41, 44, size=2000), rng.uniform(8, 11.5, size=2000)
+
+    def test_index_is_built_once(self, setup_coordinates):
+        x, y = setup_coordinates
+
+        assert settlement_index(x, y) is settlement_index(x.copy(), y.copy())
+        assert settlement_index(x, y) is not settlement_index(x, y + 1)
+
+    def test_nearest_matches_great_circle_distance(self, setup_coordinates):
+        x, y = setup_coordinates
+        index = settlement_index(x, y)
+        targets = np.arange(0, 2000, 7)
+
+        for sources in (np.arange(1, 2000, 7), np.arange(1, 2000, 300)):
+            distances = SettlementProcessor.haversine_vector(x[sources][np.newaxis, :], y[sources][np.newaxis, :],
+                                                             x[targets][:, np.newaxis], y[targets][:, np.newaxis])
+            assert_array_equal(index.nearest(sources, targets), sources[distances.argmin(axis=1)])
+
+    def test_nearest_within_distance(self, setup_coordinates):
+        x, y = setup_coordinates
+        index = settlement_index(x, y)
+        targets = np.arange(0, 2000, 7)
+
+        for sources in (np.arange(1, 2000, 7), np.arange(1, 2000, 300)):
+            distances = SettlementProcessor.haversine_vector(x[sources][np.newaxis, :], y[sources][np.newaxis, :],
+                                                             x[targets][:, np.newaxis], y[targets][:, np.newaxis])
+            expected = np.where(distances.min(axis=1) <= 15, sources[distances.argmin(axis=1)], -1)
+            assert_array_equal(index.nearest(sources, targets, 15), expected)
+            assert (expected < 0).any() and (expected >= 0).any()
+
+    def test_nearest_without_sources(self, setup_coordinates):
+        x, y = setup_coordinates
+        index = settlement_index(x, y)
+
+        assert_array_equal(index.nearest([], [1, 2]), [-1, -1])
+        assert_array_equal(index.nearest([], [1, 2], 15), [-1, -1])
+
+    def test_nearest_below_matches_nearest(self, setup_coordinates):
+        x, y = setup_coordinates
+        index = settlement_index(x, y)
+        values = np.random.default_rng(7).uniform(0, 10, size=2000)
+        targets = np.arange(0, 2000, 7)
+        limits = np.floor(values[targets])
+
+        nearest = index.nearest_below(values, targets, limits)
+
+        for limit in np.unique(limits):
+            sources = np.flatnonzero(values < limit)
+            expected = index.nearest(sources, targets[limits == limit]) if len(sources) > 0 else -1
+            assert_array_equal(nearest[limits == limit], expected)
+        assert (nearest[limits == 0] == -1).all()
+
+    def test_within_matches_great_circle_distance(self, setup_coordinates):
+        x, y = setup_coordinates
+        index = settlement_index(x, y)
+        sources = np.array([3, 500, 1999])
+        distances = np.array([10., 25., 50.])
+
+        for source, distance, nodes in zip(sources, distances, index.within(sources, distances)):
+            expected = np.flatnonzero(SettlementProcessor.haversine_vector(x[source], y[source], x, y) <= distance)
+            assert_array_equal(np.sort(nodes), expected)
+
+
+def line_of_settlements(tmp_path, settlements, connected):
+    """Settlements about 5 km apart on a line, the first ones connected to the grid already and the others far from
+    the MV and HV lines"""
+    DataFrame({
+        SET_X_DEG: 42 + 0.045 * np.arange(settlements),
+        SET_Y_DEG: np.full(settlements, 10.),
+        SET_GHI: np.full(settlements, 2000.),
+        SET_ELEC_FINAL_CODE + '2020': [1] * connected + [99] * (settlements - connected),
+        SET_ELEC_ORDER: np.zeros(settlements, dtype=int),
+        SET_GRID_PENALTY: np.ones(settlements),
+        SET_MIN_OFFGRID_LCOE + '2025': np.full(settlements, 0.5),
+        SET_LCOE_GRID + '2025': [0.1] * connected + [99] * (settlements - connected),
+        SET_MV_CONNECT_DIST: np.zeros(settlements),
+        SET_MV_DIST_PLANNED: np.full(settlements, 200.),
+        SET_HV_DIST_PLANNED: np.full(settlements, 500.),
+        SET_ENERGY_PER_CELL + '2025': np.full(settlements, 500000.),
+        SET_POP + '2025': np.full(settlements, 1000.),
+        SET_NEW_CONNECTIONS + '2025': [100.] * connected + [1000.] * (settlements - connected),
+        SET_TOTAL_ENERGY_PER_CELL: np.full(settlements, 500000.),
+        SET_NUM_PEOPLE_PER_HH: np.full(settlements, 5.),
+        SET_GRID_CELL_AREA_TEMP: np.full(settlements, 1.),
+        SET_BASE_TO_PEAK: np.full(settlements, 0.5),
+    }).to_csv(tmp_path / 'settlements.csv', index=False)
+
+    Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08)
+    grid_calc = Technology(om_costs=0.1, distribution_losses=0.1, connection_cost_per_hh=100,
+                           capacity_factor=1, tech_life=30, grid_capacity_investment=2000, grid_price=0.1)
+    return SettlementProcessor(str(tmp_path / 'settlements.csv')), grid_calc
+
+
+@fixture
+def setup_settlements(tmp_path):
+    """Six settlements on a line, the first one connected to the grid"""
+    return line_of_settlements(tmp_path, 6, 1)
+
+
+class TestGridNetwork:
+
+    def test_nearest_follows_connected_settlements(self):
+        rng = np.random.default_rng(11)
+        x, y = rng.uniform(41, 44, size=2000), rng.uniform(8, 11.5, size=2000)
+        index = settlement_index(x, y)
+        network = GridNetwork(2000)
+
+        connected = rng.uniform(size=2000) < 0.05
+        for _ in range(3):
+            network.update(index, connected)
+            targets = np.flatnonzero(~connected)
+            assert_array_equal(network.nearest[targets], index.nearest(np.flatnonzero(connected), targets))
+            assert (network.nearest[connected] == -1).all()
+
+            # Some settlements are connected in the next period, and a few are left out
+            connected = (connected | (rng.uniform(size=2000) < 0.02)) & (rng.uniform(size=2000) > 0.01)
+
+
+class TestGridGrowth:
+
+    def grow(self, onsseter, grid_calc, max_dist=50, **limits):
+        return onsseter.grid_growth(grid_calc, max_dist, 2025, 2020, 2030, 5, np.zeros(len(onsseter.df)), **limits)
+
+    def test_grid_grows_from_cheapest_connection(self, setup_settlements):
+        onsseter, grid_calc = setup_settlements
+
+        new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment = self.grow(onsseter, grid_calc)
+
+        # Each settlement is connected from its neighbour, the shortest connection
+        assert_array_equal(elecorder, [0, 1, 2, 3, 4, 5])
+        assert_allclose(np.diff(cell_path_real), cell_path_adjusted[1:])
+        assert (new_lcoes[1:] < 0.5).all()
+
+        expected, investment = onsseter.get_grid_lcoe(cell_path_adjusted, elecorder, 0, 2025, 5, 2030, grid_calc)
+        assert_allclose(new_lcoes[1:], expected[1:], rtol=1e-12)
+        assert_allclose(new_investment[1:], investment[1:], rtol=1e-12)
+
+    def test_grid_growth_limits(self, setup_settlements):
+        onsseter, grid_calc = setup_settlements
+
+        elecorder = self.grow(onsseter, grid_calc, max_dist=12)[2]
+        assert_array_equal(elecorder, [0, 1, 2, 0, 0, 0])
+
+        elecorder = self.grow(onsseter, grid_calc, grid_connect_limit=600)[2]
+        assert_array_equal(elecorder, [0, 1, 2, 3, 0, 0])
+
+
+class TestGridExtensionState:
+
+    def test_state_updated_in_place(self, setup_settlements):
+        onsseter, grid_calc = setup_settlements
+        state = GridExtensionState([True] + [False] * 5, np.zeros(6, dtype=int), np.zeros(6), np.zeros(6),
+                                   [0.1] + [99] * 5, np.zeros(6), grid_connect_limit=450)
+        elecorder = state.elecorder
+
+        connected = onsseter.update_grid_extension_info(state, np.full(6, 0.2), np.full(6, 5.), np.full(6, 5.), 0,
+                                                        1, 50, 2025, grid_calc, np.full(6, 100.))
+
+        # The connections are consumed in settlement order, the first settlement is connected already
+        assert_array_equal(connected, [False, True, True, False, False, False])
+        assert_array_equal(state.electrified, [True, True, True, False, False, False])
+        assert_array_equal(state.elecorder, [0, 1, 1, 0, 0, 0])
+        assert elecorder is state.elecorder
+        assert_array_equal(state.new_lcoes, [0.1, 0.2, 0.2, 99, 99, 99])
+        assert state.grid_connect_limit == 50
+
+
+class TestPartitionedExtension:
+
+    @fixture
+    def setup_line(self, tmp_path):
+        """Sixteen settlements on a line, the first two connected to the grid"""
+        return line_of_settlements(tmp_path, 16, 2)
+
+    def extend(self, onsseter, grid_calc, **options):
+        return onsseter.partitioned_extension(grid_calc, 50, 2025, 2020, 2030, 5, np.zeros(len(onsseter.df)),
+                                              **options)
+
+    def test_regions_with_halo(self, setup_line):
+        onsseter, grid_calc = setup_line
+        x = onsseter.df[SET_X_DEG].to_numpy()
+        y = onsseter.df[SET_Y_DEG].to_numpy()
+
+        regions = onsseter.extension_regions(12, tile_size=20)
+
+        assert len(regions) > 1
+        assert_array_equal(np.sort(np.concatenate([core for core, halo in regions])), np.arange(16))
+        for core, halo in regions:
+            distance = SettlementProcessor.haversine_vector(x[core][:, np.newaxis], y[core][:, np.newaxis], x, y)
+            around = np.flatnonzero((distance.min(axis=0) <= 12) & ~np.isin(np.arange(16), core))
+            assert np.isin(around, halo).all()
+            assert not np.isin(halo, core).any()
+
+    def test_single_region_matches_whole_extension(self, setup_line):
+        onsseter, grid_calc = setup_line
+
+        whole = onsseter.elec_extension(grid_calc, 50, 2025, 2020, 2030, 5, np.zeros(16))
+        partitioned = self.extend(onsseter, grid_calc, tile_size=10000)
+
+        for actual, expected in zip(partitioned, whole):
+            assert_array_equal(actual, expected)
+
+    def test_single_region_matches_whole_extension_with_capacity_limit(self, setup_line):
+        onsseter, grid_calc = setup_line
+        onsseter.df[SET_BASE_TO_PEAK] = np.linspace(0.3, 0.6, 16)
+        # The capacity limit differs by settlement, as the one of pre_electrification
+        grid_capacity_limit = 1000 - 200 / onsseter.df[SET_BASE_TO_PEAK]
+
+        whole = onsseter.elec_extension(grid_calc, 50, 2025, 2020, 2030, 5, np.zeros(16),
+                                        grid_capacity_limit=grid_capacity_limit)
+        partitioned = self.extend(onsseter, grid_calc, tile_size=10000, grid_capacity_limit=grid_capacity_limit)
+
+        assert 0 < (whole[0] < 0.5)[2:].sum() < 14
+        for actual, expected in zip(partitioned, whole):
+            assert_array_equal(actual, expected)
+
+    def test_regions_extended_across_borders(self, setup_line):
+        onsseter, grid_calc = setup_line
+
+        whole = onsseter.elec_extension(grid_calc, 50, 2025, 2020, 2030, 5, np.zeros(16))
+        serial = self.extend(onsseter, grid_calc, tile_size=20)
+        parallel = self.extend(onsseter, grid_calc, tile_size=20, workers=2)
+
+        assert_array_equal(serial[0] < 0.5, whole[0] < 0.5)
+        for actual, expected in zip(parallel, serial):
+            assert_array_equal(actual, expected)
+
+    def test_limits_shared_between_regions(self, setup_line):
+        onsseter, grid_calc = setup_line
+
+        new_lcoes = self.extend(onsseter, grid_calc, tile_size=20, grid_connect_limit=1500)[0]
+
+        # 200 households in each settlement
+        connected = (new_lcoes < 0.5)[2:]
+        assert 0 < connected.sum() <= 7
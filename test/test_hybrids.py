@@ -0,0 +1,315 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from pytest import fixture, raises
+
+from onsset import hybrid_table_lookup, python_round
+from onsset.hybrids_common import DispatchStore, LcoeEnvelope, SizingSearch, profile_hash, representative_days
+from onsset.hybrids_pv import pv_diesel_days_error, pv_diesel_dispatch, pv_diesel_dispatch_table, pv_diesel_hybrid, \
+    pv_diesel_search_table
+from onsset.hybrids_wind import wind_diesel_dispatch, wind_diesel_dispatch_table, wind_diesel_search_table
+
+
+class TestDispatchStore:
+
+    @fixture
+    def setup_profile(self):
+        """A synthetic year with a sinusoidal daily irradiance profile and constant temperature"""
+        hours = np.arange(8760)
+        ghi_curve = np.maximum(np.sin((hours % 24 - 6) / 12 * np.pi), 0).reshape(-1, 1) * 800
+        temp = np.full((8760, 1), 25.0)
+        return ghi_curve, temp
+
+    def test_profile_hash(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        assert profile_hash(ghi_curve, temp) == profile_hash(ghi_curve.copy(), temp.copy())
+        assert profile_hash(ghi_curve, temp) != profile_hash(ghi_curve * 1.01, temp)
+
+    def test_dispatch_is_simulated_once(self, setup_profile):
+        ghi_curve, temp = setup_profile
+        store = DispatchStore()
+
+        first = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=3, diesel_no=3, store=store)
+        second = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=3, diesel_no=3, store=store)
+
+        assert first is second
+        assert store.misses == 1
+        assert store.hits == 1
+
+        pv_diesel_dispatch(1, 2100, ghi_curve, temp, 3, pv_no=3, diesel_no=3, store=store)
+        assert len(store) == 2
+
+    def test_stored_dispatch_matches_simulation(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        stored = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 2, pv_no=3, diesel_no=3, store=DispatchStore())
+        simulated = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 2, pv_no=3, diesel_no=3, store=None)
+
+        for actual, expected in zip(stored, simulated):
+            assert_array_equal(actual, expected)
+
+    def test_costing_with_different_prices(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        lcoe, investment, capacity, ren_share = pv_diesel_hybrid(1, 2000, ghi_curve, temp, 2, 2020, 2030, 0.1, 139,
+                                                                  1000, 150, 142, 25, 10, pv_no=3, diesel_no=3,
+                                                                  diesel_range=[0.5, 1.0])
+        assert len(lcoe) == 2
+        assert lcoe[0] <= lcoe[1]
+
+    def test_dispatch_table_matches_single_dispatch(self, setup_profile):
+        ghi_curve, temp = setup_profile
+        store = DispatchStore()
+
+        table = pv_diesel_dispatch_table(1, [1900, 2200], ghi_curve, temp, tiers=[1, 4], pv_no=3, diesel_no=3,
+                                         store=store)
+        assert len(table) == 4
+        assert len(store) == 4
+
+        for (tier, ghi), result in table.items():
+            single = pv_diesel_dispatch(1, ghi, ghi_curve, temp, tier, pv_no=3, diesel_no=3, store=None)
+            for actual, expected in zip(result, single):
+                assert_array_equal(actual, expected)
+
+    def test_parallel_table_matches_serial(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        serial = pv_diesel_dispatch_table(1, [1900, 2200], ghi_curve, temp, tiers=[1, 4], pv_no=3, diesel_no=3,
+                                          store=None)
+        parallel = pv_diesel_dispatch_table(1, [1900, 2200], ghi_curve, temp, tiers=[1, 4], pv_no=3, diesel_no=3,
+                                            store=None, workers=2, chunk_size=1)
+
+        assert list(parallel) == list(serial)
+        for pair, result in parallel.items():
+            for actual, expected in zip(result, serial[pair]):
+                assert_array_equal(actual, expected)
+
+    def test_stopped_configurations_are_infeasible(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        stopped = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=4, diesel_no=4, store=None)
+        full = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=4, diesel_no=4, store=None, lpsp_max=None,
+                                  diesel_limit=None)
+
+        infeasible = (full.lpsp > 0.05) | (full.diesel_share > 0.5)
+        assert infeasible.any() and not infeasible.all()
+        assert_array_equal((stopped.lpsp > 0.05) | (stopped.diesel_share > 0.5), infeasible)
+        for actual, expected in zip(stopped[3:8], full[3:8]):
+            assert_array_equal(actual[~infeasible], expected[~infeasible])
+            assert_array_equal(actual[0, 0, 0], expected[0, 0, 0])
+
+    def test_dispatch_matches_reference_kernel(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        result = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=3, diesel_no=3, store=None, lpsp_max=None,
+                                    diesel_limit=None)
+
+        # Results of the hourly loop of pv_diesel_hybrid before it was batched, for the middle battery size
+        assert_allclose(result.diesel_share[1], [[0, 0, 0], [0, 0, 0], [0, 0.320162097423, 0.440218252821]],
+                        rtol=1e-10, atol=1e-15)
+        assert_allclose(result.battery_life[1], [[9, 9, 9], [9, 9, 9], [-7, -278, 12]], rtol=0)
+        assert_allclose(result.lpsp[1], [[0, 0, 0], [0, 0, 0], [0.479068408477, 0.134156002147, 2.81285566608e-18]],
+                        rtol=1e-10, atol=1e-15)
+        assert_allclose(result.fuel_usage[1], [[0, 0, 0], [0, 0, 0], [0, 0.107550534579, 0.151499460975]],
+                        rtol=1e-10, atol=1e-15)
+
+    def test_search_table(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        table, simulations = pv_diesel_search_table(1, [2000], ghi_curve, temp, [3], [0.5, 1.0], 2020, 2030, 0.1,
+                                                    139, 1000, 150, 142, 25, 10, budget=40)
+
+        assert table.shape == (4, 1, 2, 1)
+        assert simulations <= 2 * 40
+        assert (table[0] < 99).all()
+
+
+class TestWindDispatch:
+
+    @fixture
+    def setup_profile(self):
+        """A synthetic year with daily and seasonal cycles of the wind speed"""
+        hours = np.arange(8760)
+        return (6 + 3 * np.sin((hours % 24) / 12 * np.pi) + 2 * np.sin(hours / 2190 * np.pi)).reshape(-1, 1)
+
+    def test_dispatch_table_matches_single_dispatch(self, setup_profile):
+        wind_curve = setup_profile
+        store = DispatchStore()
+
+        table = wind_diesel_dispatch_table(1, [5, 7], wind_curve, tiers=[1, 4], wind_no=3, diesel_no=3, store=store)
+        assert len(table) == 4
+        assert len(store) == 4
+
+        for (tier, wind_speed), result in table.items():
+            single = wind_diesel_dispatch(1, wind_speed, wind_curve, tier, wind_no=3, diesel_no=3, store=None)
+            for actual, expected in zip(result, single):
+                assert_array_equal(actual, expected)
+
+    def test_parallel_table_matches_serial(self, setup_profile):
+        wind_curve = setup_profile
+
+        serial = wind_diesel_dispatch_table(1, [5, 7], wind_curve, tiers=[1, 4], wind_no=3, diesel_no=3, store=None)
+        parallel = wind_diesel_dispatch_table(1, [5, 7], wind_curve, tiers=[1, 4], wind_no=3, diesel_no=3,
+                                              store=None, workers=2, chunk_size=1)
+
+        assert list(parallel) == list(serial)
+        for pair, result in parallel.items():
+            for actual, expected in zip(result, serial[pair]):
+                assert_array_equal(actual, expected)
+
+    def test_stopped_configurations_are_infeasible(self, setup_profile):
+        wind_curve = setup_profile
+
+        stopped = wind_diesel_dispatch(1, 6, wind_curve, 3, wind_no=4, diesel_no=4, store=None)
+        full = wind_diesel_dispatch(1, 6, wind_curve, 3, wind_no=4, diesel_no=4, store=None, lpsp_max=None,
+                                    diesel_limit=None)
+
+        infeasible = (full.lpsp > 0.05) | (full.diesel_share > 0.5)
+        assert infeasible.any() and not infeasible.all()
+        assert_array_equal((stopped.lpsp > 0.05) | (stopped.diesel_share > 0.5), infeasible)
+        for actual, expected in zip(stopped[3:8], full[3:8]):
+            assert_array_equal(actual[~infeasible], expected[~infeasible])
+            assert_array_equal(actual[0, 0, 0], expected[0, 0, 0])
+
+    def test_dispatch_matches_reference_kernel(self, setup_profile):
+        wind_curve = setup_profile
+
+        result = wind_diesel_dispatch(1, 6, wind_curve, 3, wind_no=3, diesel_no=3, store=None, lpsp_max=None,
+                                      diesel_limit=None)
+
+        # Results of the hourly loop of wind_diesel_hybrid before it was batched, for the middle battery size
+        assert_allclose(result.diesel_share[1], [[0, 0, 0], [0, 0.0254218076237, 0.0406425077297],
+                                                 [0, 0.122961205725, 0.201413858247]], rtol=1e-10, atol=1e-15)
+        assert_allclose(result.battery_life[1], [[14, 14, 14], [15, 13, 12], [-31, 20, 17]], rtol=0)
+        assert_allclose(result.lpsp[1], [[0, 0, 0], [0.047033737886, 0.0176659184281, 0.000489553813198],
+                                         [0.260838326816, 0.11663158642, 0.0273473491491]], rtol=1e-10, atol=1e-15)
+        assert_allclose(result.fuel_usage[1], [[0, 0, 0], [0, 0.0083243709064, 0.0133083891561],
+                                               [0, 0.0404498191539, 0.0676557222185]], rtol=1e-10, atol=1e-15)
+
+    def test_search_table(self, setup_profile):
+        wind_curve = setup_profile
+
+        table, simulations = wind_diesel_search_table(1, [6], wind_curve, [3], [0.5, 1.0], 2020, 2030, 0.1, 139,
+                                                      2800, 150, 142, 20, 10, budget=40)
+
+        assert table.shape == (3, 1, 2, 1)
+        assert simulations <= 2 * 40
+        assert (table[0] < 99).all()
+
+    def test_all_days_match_the_whole_year(self, setup_profile):
+        wind_curve = setup_profile
+
+        full = wind_diesel_dispatch(1, 6, wind_curve, 3, wind_no=3, diesel_no=3, store=None)
+        days = wind_diesel_dispatch(1, 6, wind_curve, 3, wind_no=3, diesel_no=3, store=None, days=365)
+
+        for actual, expected in zip(days, full):
+            assert_array_equal(actual, expected)
+
+
+class TestRepresentativeDays:
+
+    @fixture
+    def setup_profile(self):
+        """A synthetic year with a sinusoidal daily irradiance profile scaled by random cloudiness every day"""
+        rng = np.random.default_rng(3)
+        hours = np.arange(8760)
+        clouds = np.repeat(rng.uniform(0.3, 1, size=365), 24)
+        ghi_curve = (np.maximum(np.sin((hours % 24 - 6) / 12 * np.pi), 0) * clouds).reshape(-1, 1) * 800
+        temp = np.full((8760, 1), 25.0)
+        return ghi_curve, temp
+
+    def test_days_cover_the_year(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        representatives, weights = representative_days([ghi_curve, temp], 12)
+
+        assert len(representatives) == 12
+        assert (np.diff(representatives) > 0).all()
+        assert weights.sum() == 365
+
+    def test_all_days_match_the_whole_year(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        full = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=3, diesel_no=3, store=None)
+        days = pv_diesel_dispatch(1, 2000, ghi_curve, temp, 3, pv_no=3, diesel_no=3, store=None, days=365)
+
+        for actual, expected in zip(days, full):
+            assert_array_equal(actual, expected)
+
+    def test_days_error(self, setup_profile):
+        ghi_curve, temp = setup_profile
+
+        deviation = pv_diesel_days_error(1, [2000], ghi_curve, temp, [2, 4], [0.5, 1.0], 2020, 2030, 0.1, 139, 1000,
+                                         150, 142, 25, 10, 24)
+
+        assert list(deviation) == [2, 4]
+        assert all(0 <= value < 0.2 for value in deviation.values())
+
+
+class TestSizingSearch:
+
+    def test_search_finds_minimum(self):
+        search = SizingSearch([0, 0, 0], [10, 10, 10], budget=200)
+        target = np.array([3.3, 7.1, 5.0])
+        while not search.done:
+            sizes = search.candidates
+            lcoe = ((sizes - target) ** 2).sum(axis=1)
+            search.update(lcoe, sizes[:, 0] > 1, sizes)
+
+        assert search.used <= 200
+        np.testing.assert_allclose(search.results[search.best], target, atol=0.1)
+
+    def test_search_stops_without_feasible_configuration(self):
+        search = SizingSearch([0, 0, 0], [10, 10, 10])
+        sizes = search.candidates
+        search.update(np.full(len(sizes), 99), np.zeros(len(sizes), dtype=bool), sizes)
+
+        assert search.done
+        assert search.best == 0
+
+
+class TestLcoeEnvelope:
+
+    def test_envelope_matches_minimum_of_all_lines(self):
+        rng = np.random.default_rng(1)
+        intercept = rng.uniform(0.2, 1, size=(3, 4, 5))
+        slope = rng.uniform(0, 0.5, size=(3, 4, 5))
+        intercept[0] = 99
+        slope[0] = 0
+        prices = np.round(np.arange(0, 3, 0.1), 1)
+
+        min_lcoe, index = LcoeEnvelope(intercept, slope).evaluate(prices)
+
+        lcoe = intercept.ravel() + slope.ravel() * prices[:, None]
+        np.testing.assert_allclose(min_lcoe, lcoe.min(axis=1))
+        assert_array_equal(index, lcoe.argmin(axis=1))
+
+    def test_ties_resolve_to_lowest_index(self):
+        envelope = LcoeEnvelope(np.array([1.0, 0.5, 0.5, 99]), np.array([0.0, 0.5, 0.5, 0]))
+
+        min_lcoe, index = envelope.evaluate([0.2, 1.0, 2.0])
+
+        assert_array_equal(min_lcoe, [0.6, 1.0, 1.0])
+        assert_array_equal(index, [1, 0, 0])
+
+
+class TestHybridTableLookup:
+
+    def test_python_round(self):
+        values = np.array([0.35, 0.25, 1.04999, 2249.9, 2250, 2350, -0.35])
+
+        assert_array_equal(python_round(values, 1), [round(float(v), 1) for v in values])
+        assert_array_equal(python_round(values, -2), [round(float(v), -2) for v in values])
+
+    def test_lookup_per_settlement(self):
+        ghi_range = np.array([1900., 2000., 2100.])
+        diesel_range = np.round(np.arange(0.5, 0.8, 0.1), 1)
+        table = np.arange(2 * 5 * 3 * 3).reshape((2, 5, 3, 3)).astype(float)
+
+        result = hybrid_table_lookup(table, ghi_range, diesel_range, [2100, 1900], [0.5, 0.7], [5, 1])
+
+        assert_array_equal(result, [[table[0, 4, 0, 2], table[0, 0, 2, 0]],
+                                    [table[1, 4, 0, 2], table[1, 0, 2, 0]]])
+
+        with raises(KeyError):
+            hybrid_table_lookup(table, ghi_range, diesel_range, [2200], [0.5], [1])
@@ -0,0 +1,309 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from pandas import DataFrame, Series
+from pytest import fixture
+
+from onsset import NETWORK_COSTS, CostQuantities, Technology, cost_distributions, least_cost_technology, \
+    reprice_costs, technologies_costs
+
+
+def explicit_lcoe(tech, total_investment_cost, total_om_cost, generation, fuel_cost, grid_capacity_investments,
+                  start_year, end_year):
+    """Year by year discounted cash flow of one settlement, used as reference for the closed-form calculation"""
+    project_life = end_year - start_year + 1
+    reinvest_year = tech.tech_life if tech.tech_life < project_life else 0
+    used_life = project_life - tech.tech_life if reinvest_year else project_life - 1
+
+    costs = 0
+    discounted_generation = 0
+    investment = 0
+    for year in range(project_life):
+        discount_factor = (1 + tech.discount_rate) ** year
+        invest = total_investment_cost if year == 0 or year == reinvest_year else 0
+        salvage = total_investment_cost * (1 - used_life / tech.tech_life) if year == project_life - 1 else 0
+        costs += (invest + total_om_cost + generation * fuel_cost - salvage) / discount_factor
+        discounted_generation += generation / discount_factor
+        if year == 0 or year == reinvest_year:
+            investment += (total_investment_cost + grid_capacity_investments) / discount_factor
+    return costs / discounted_generation, investment
+
+
+def sample_settlements(extra=None, **columns):
+    """Three settlements of growing size, the last one connected to the grid already, as keyword arguments of
+    Technology.get_costs, with the extra settlement (dict of its values) and the given columns added or replaced"""
+    Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08)
+    settlements = dict(energy_per_cell=[2000., 50000., 800000.],
+                       people=[50., 1200., 15000.],
+                       num_people_per_hh=[5., 5., 6.],
+                       new_connections=[50., 1000., 9000.],
+                       total_energy_per_cell=[2000., 60000., 1200000.],
+                       prev_code=[99, 99, 1],
+                       grid_cell_area=[0.5, 2., 10.],
+                       base_to_peak=[0.3, 0.5, 0.5])
+    if extra is not None:
+        settlements = {name: values + [extra[name]] for name, values in settlements.items()}
+    settlements.update(columns)
+    return {name: Series(values) for name, values in settlements.items()}
+
+
+def grid_technology(**options):
+    """The grid of the tests, with the given options replaced"""
+    return Technology(**dict(dict(tech_life=30, om_costs=0.02, capital_cost={float("inf"): 3000},
+                                  distribution_losses=0.05, connection_cost_per_hh=100, om_of_td_lines=0.02,
+                                  grid_capacity_investment=1000), **options))
+
+
+class TestGetLcoe:
+
+    @fixture
+    def setup_settlements(self):
+        return sample_settlements()
+
+    def test_lcoe_matches_yearly_cash_flow(self, setup_settlements):
+        for tech_life in (5, 30):
+            tech = grid_technology(tech_life=tech_life, capacity_factor=0.5, base_to_peak_load_ratio=0.5)
+
+            lcoe, investment = tech.get_lcoe(start_year=2020, end_year=2030, fuel_cost=0.1, **setup_settlements)
+
+            generation, peak_load, td_investment_cost, mv_km, lv_km = tech.td_network_cost(
+                setup_settlements['people'], setup_settlements['new_connections'], setup_settlements['prev_code'],
+                setup_settlements['total_energy_per_cell'], setup_settlements['energy_per_cell'],
+                setup_settlements['num_people_per_hh'], setup_settlements['grid_cell_area'],
+                setup_settlements['base_to_peak'])
+            installed_capacity = peak_load / 0.9
+            total_investment_cost = td_investment_cost + installed_capacity * 3000
+            total_om_cost = td_investment_cost * 0.02 + 3000 * 0.02 * installed_capacity
+
+            expected_lcoe, expected_investment = explicit_lcoe(tech, total_investment_cost, total_om_cost,
+                                                               generation, 0.1, peak_load * 1000, 2020, 2030)
+
+            assert_allclose(lcoe[0], expected_lcoe, rtol=1e-12)
+            assert_allclose(investment[0], expected_investment, rtol=1e-12)
+
+    def test_lcoe_with_network_context(self, setup_settlements):
+        tech = grid_technology(base_to_peak_load_ratio=0.5)
+        network = tech.network_context(setup_settlements['people'], setup_settlements['new_connections'],
+                                       setup_settlements['prev_code'], setup_settlements['total_energy_per_cell'],
+                                       setup_settlements['energy_per_cell'], setup_settlements['num_people_per_hh'],
+                                       setup_settlements['grid_cell_area'], setup_settlements['base_to_peak'])
+
+        for distance, transformer, loop in ((0, 0, 0), (Series([5., 60., 20.]), 0, 2), (Series([5., 60., 20.]), 1, 0)):
+            expected = tech.get_lcoe(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                                     additional_transformer=transformer, elec_loop=loop, **setup_settlements)
+            actual = tech.get_lcoe(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                                   additional_transformer=transformer, elec_loop=loop, network=network,
+                                   **setup_settlements)
+
+            assert_allclose(actual[0], expected[0], rtol=0)
+            assert_allclose(actual[1], expected[1], rtol=0)
+
+    def test_lcoe_of_subset(self, setup_settlements):
+        tech = grid_technology(base_to_peak_load_ratio=0.5)
+        distance = Series([5., 60., 20.])
+
+        lcoe, investment = tech.get_lcoe(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                                         elec_loop=Series([1, 0, 3]), **setup_settlements)
+        subset_lcoe, subset_investment = tech.get_lcoe(start_year=2020, end_year=2030,
+                                                       additional_mv_line_length=distance,
+                                                       elec_loop=Series([1, 0, 3]), subset=[0, 2],
+                                                       **setup_settlements)
+
+        assert_allclose(subset_lcoe[0], [lcoe[0][0], np.nan, lcoe[0][2]], rtol=0)
+        assert_allclose(subset_investment[0], [investment[0][0], np.nan, investment[0][2]], rtol=0)
+
+    def test_costs_match_lcoe_and_network(self, setup_settlements):
+        tech = grid_technology(base_to_peak_load_ratio=0.5)
+        distance = Series([5., 60., 20.])
+
+        costs = tech.get_costs(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                               **setup_settlements)
+        lcoe, investment = tech.get_lcoe(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                                         **setup_settlements)
+        generation, peak_load, td_investment_cost, mv_km, lv_km = tech.td_network_cost(
+            additional_mv_line_length=distance, **setup_settlements)
+
+        for value in costs:
+            assert isinstance(value, np.ndarray) and value.shape == (3,)
+        assert_allclose(costs.lcoe, lcoe[0], rtol=0)
+        assert_allclose(costs.investment, investment[0], rtol=0)
+        assert_allclose(costs.generation, generation, rtol=0)
+        assert_allclose(costs.td_investment, td_investment_cost, rtol=0)
+        assert_allclose(costs.mv_distribution_km, mv_km, rtol=0)
+        assert_allclose(costs.lv_km, lv_km, rtol=0)
+        assert_allclose(costs.mv_km + costs.hv_km, distance, rtol=0)
+        assert_allclose(costs.installed_capacity, peak_load / 0.9, rtol=0)
+
+
+class TestUnitCapitalCost:
+
+    def test_capital_cost_tiers(self):
+        tech = Technology(capital_cost={float("inf"): 2700, 1: 2700, 0.200: 2700, 0.080: 2600, 0.030: 2200,
+                                        0.006: 9200}, standalone=True)
+        capacity = np.array([-1, 0, 0.005, 0.006, 0.05, 0.08, 0.5, 3, np.inf, np.nan])
+
+        assert_allclose(tech.unit_capital_cost(capacity), [9200, 9200, 9200, 2200, 2600, 2700, 2700, 2700, 0, 0])
+        assert tech.unit_capital_cost(0.01) == 2200
+
+    def test_capacity_above_all_tiers(self):
+        tech = Technology(capital_cost={10: 1000, 100: 800})
+
+        assert_allclose(tech.unit_capital_cost([5, 10, 50, 100, 500]), [1000, 800, 800, 0, 0])
+
+
+class TestTechnologiesCosts:
+
+    @fixture
+    def setup_settlements(self):
+        """The sample settlements and an empty one"""
+        return sample_settlements(dict(energy_per_cell=0., people=0., num_people_per_hh=5., new_connections=0.,
+                                       total_energy_per_cell=0., prev_code=3, grid_cell_area=1., base_to_peak=0.5))
+
+    def test_matrix_matches_single_technologies(self, setup_settlements):
+        grid = grid_technology()
+        hydro = Technology(tech_life=30, om_costs=0.03, capital_cost={1: 7000, 100: 5000, float("inf"): 4000},
+                           distribution_losses=0.05, connection_cost_per_hh=100, capacity_factor=0.5,
+                           mini_grid=True)
+        sa_pv = Technology(tech_life=25, om_costs=0.02, capital_cost={0.02: 6000, float("inf"): 4000},
+                           base_to_peak_load_ratio=0.9, standalone=True)
+        options = [dict(additional_mv_line_length=Series([3., 20., 8., 1.])),
+                   dict(additional_mv_line_length=Series([1., 4., 2., 1.])),
+                   dict(base_to_peak=0.9, capacity_factor=Series([0.2, 0.21, 0.22, 0.2]))]
+
+        lcoes, costs = technologies_costs([grid, hydro, sa_pv], start_year=2020, end_year=2030, options=options,
+                                          **setup_settlements)
+
+        assert lcoes.shape == (4, 3)
+        for column, (technology, option) in enumerate(zip([grid, hydro, sa_pv], options)):
+            settlements = dict(setup_settlements, **option)
+            expected = technology.get_costs(start_year=2020, end_year=2030, **settlements)
+            assert_allclose(lcoes[:, column], expected.lcoe, rtol=0)
+            for actual, value in zip(costs[column], expected):
+                assert_allclose(actual, value, rtol=0)
+
+    def test_least_cost_technology_matches_pandas(self):
+        lcoes = DataFrame({'a': [0.3, 0.2, np.nan, np.nan, 0.5],
+                           'b': [0.1, 0.2, 0.4, np.nan, np.inf],
+                           'c': [0.2, 0.3, 0.1, np.nan, 99]})
+
+        names, min_lcoe = least_cost_technology(lcoes.to_numpy(), list(lcoes.columns))
+
+        assert list(names[:3]) == list(lcoes.T.idxmin()[:3]) == ['b', 'a', 'c']
+        assert np.isnan(names[3]) and np.isnan(lcoes.T.idxmin()[3])
+        assert names[4] == 'a'
+        assert_allclose(min_lcoe, lcoes.T.min(), rtol=0)
+
+
+class TestCostSensitivity:
+
+    @fixture
+    def setup_settlements(self):
+        return sample_settlements(additional_mv_line_length=[5., 60., 20.], elec_loop=[2, 0, 1], penalty=[1., 1.2, 1.],
+                                  grid_penalty_ratio=[1., 1., 1.5])
+
+    def setup_record(self, tech, settlements):
+        costs = tech.get_costs(start_year=2020, end_year=2030, **settlements)
+        network = tech.network_context(settlements['people'], settlements['new_connections'],
+                                       settlements['prev_code'], settlements['total_energy_per_cell'],
+                                       settlements['energy_per_cell'], settlements['num_people_per_hh'],
+                                       settlements['grid_cell_area'], settlements['base_to_peak'])
+        quantities = tech.network_quantities(network, settlements['additional_mv_line_length'],
+                                             elec_loop=settlements['elec_loop'])
+        return costs, quantities, CostQuantities(tech.network_unit_costs(), quantities, costs.lcoe, costs.investment,
+                                                 costs.generation, costs.lcoe_slope, costs.investment_slope)
+
+    def test_quantities_price_the_network(self, setup_settlements):
+        tech = grid_technology()
+
+        costs, quantities, record = self.setup_record(tech, setup_settlements)
+
+        assert quantities.shape == (3, len(NETWORK_COSTS))
+        assert_allclose(quantities @ tech.network_unit_costs() * setup_settlements['penalty'] *
+                        setup_settlements['grid_penalty_ratio'], costs.td_investment, rtol=1e-12)
+
+    def test_repriced_costs_match_new_run(self, setup_settlements):
+        tech = grid_technology(tech_life=20, om_of_td_lines=0.03)
+        costs, quantities, record = self.setup_record(tech, setup_settlements)
+        factors = np.ones((2, len(NETWORK_COSTS)))
+        factors[1, NETWORK_COSTS.index('mv_line_cost')] = 1.5
+        factors[1, NETWORK_COSTS.index('connection_cost_per_hh')] = 2
+
+        lcoe, investment = reprice_costs({1: record}, [1, 1, 99], factors)
+
+        Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08,
+                                      mv_line_cost=22000 * 1.5)
+        tech.connection_cost_per_hh = 200
+        expected = tech.get_costs(start_year=2020, end_year=2030, **setup_settlements)
+        Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08)
+
+        assert_allclose(lcoe[:2, 0], costs.lcoe[:2], rtol=0)
+        assert_allclose(lcoe[:2, 1], expected.lcoe[:2], rtol=1e-12)
+        assert_allclose(investment[:2, 1], expected.investment[:2], rtol=1e-12)
+        assert np.isnan(lcoe[2]).all()
+
+        total_investment, average_lcoe = cost_distributions({1: record}, np.array([1, 1, 99]), factors, chunk_size=1)
+        assert_allclose(total_investment, investment[:2].sum(axis=0), rtol=1e-12)
+        assert_allclose(average_lcoe, costs.generation[:2] @ lcoe[:2] / costs.generation[:2].sum(), rtol=1e-12)
+
+
+class TestBreakEvenDistance:
+
+    @fixture
+    def setup_settlements(self):
+        """The sample settlements and a large one not electrified yet"""
+        return sample_settlements(dict(energy_per_cell=3e6, people=30000., num_people_per_hh=6., new_connections=30000.,
+                                       total_energy_per_cell=3e6, prev_code=99, grid_cell_area=20., base_to_peak=0.6))
+
+    def test_break_even_matches_lcoe(self, setup_settlements):
+        grid = grid_technology(grid_price=0.1)
+        # The settlements break even at different distances, on both sides of max_mv_line_length
+        target = grid.get_costs(start_year=2020, end_year=2030, additional_mv_line_length=np.array([10, 40, 70, 100]),
+                                **setup_settlements).lcoe
+
+        break_even = []
+        for distance in (25, 50):
+            costs = grid.get_costs(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                                   **setup_settlements)
+            break_even.append(grid.break_even_distance(costs, distance, target))
+
+        distances = np.arange(0, 150, 0.5)
+        for elec_loop in (0, 1, 3):
+            for distance in distances:
+                lcoe = grid.get_costs(start_year=2020, end_year=2030, additional_mv_line_length=distance,
+                                      elec_loop=elec_loop, **setup_settlements).lcoe
+                within = grid.within_break_even_distance(break_even, np.full(4, distance), elec_loop)
+                # Every settlement less costly than the target is within its break-even distance
+                assert within[lcoe < target].all()
+                # and the connected settlements within it are not more costly, except right at the break-even distance
+                if distance > 0:
+                    assert (lcoe[within] < target[within] * (1 + 1e-3)).all()
+
+
+class TestTransmissionPlan:
+
+    def test_plan_follows_default_values(self):
+        Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08)
+        grid = Technology(tech_life=30, base_to_peak_load_ratio=0.5, distribution_losses=0.05)
+        plan = grid.transmission_plan()
+
+        assert grid.transmission_plan() is plan
+        assert plan.max_mv_load == 8.0 * 11 * 43000 / 22000
+
+        Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08,
+                                      mv_line_cost=11000)
+        assert grid.transmission_plan().max_mv_load == 2 * plan.max_mv_load
+        Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08)
+
+    def test_transmission_network(self):
+        Technology.set_default_values(base_year=2020, start_year=2020, end_year=2030, discount_rate=0.08)
+        grid = Technology(tech_life=30, base_to_peak_load_ratio=0.5, distribution_losses=0.05)
+        peak_load = np.array([10., 500., 10.])
+        distance = np.array([10., 10., 60.])
+
+        # Loads up to 172 kW are connected with MV lines if closer than 50 km, the others with HV lines
+        expected = [[0, 10, 60], [10, 0, 0], [0, 0, 0], [0, 0, 0], [0, 1, 1], [1, 2, 1]]
+        for actual, values in zip(grid.transmission_network(peak_load, distance), expected):
+            assert_array_equal(actual, values)
+
+        expected = [[10, 10, 60], [0, 0, 0], [1, 1, 1], [0, 0, 0], [1, 1, 1], [1, 2, 1]]
+        for actual, values in zip(grid.transmission_network(peak_load, distance, 1), expected):
+            assert_array_equal(actual, values)